@@ -0,0 +1,120 @@
+## Copyright (c) 2010 by Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by the
+## Free Software Foundation, either version 3 of the License, or (at your option
+## any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program. If not, see <http://www.gnu.org/licenses/agpl.txt>.
+##
+## This license is also included in the file COPYING
+##
+## AUTHOR: Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+
+""" This module keeps in memory the borders between the areas of each
+setting, so that the adjacency of two areas is checked without queries.
+
+The graph of a setting is built with two queries, the first time that it
+is needed, and kept in ``scenario_cache`` until an area or a border of the
+setting is saved or deleted.
+"""
+
+import array
+
+from django.core.exceptions import ObjectDoesNotExist
+
+from condottieri_scenarios.scenario_cache import register_cache
+
+class Adjacency(object):
+        """ The borders of the areas of a setting.
+
+        The areas are numbered from 0, and the neighbours of each area are
+        kept in two flat arrays: the neighbours of the area i are
+        ``targets[offsets[i]:offsets[i + 1]]``. Besides, each area has two
+        bitsets, with the bit j set if the area j is a neighbour: ``land``
+        has every border and ``fleet`` only the borders that a fleet can
+        cross, those not marked as only_land in any direction.
+        """
+        __slots__ = ('areas', 'index', 'offsets', 'targets', 'land', 'fleet')
+
+        def __init__(self, areas, borders):
+                """ ``areas`` are the primary keys of the areas, and ``borders``
+                tuples of (from_area, to_area, only_land) """
+                self.areas = array.array('q', areas)
+                self.index = dict((pk, i) for i, pk in enumerate(self.areas))
+                neighbours = [[] for pk in self.areas]
+                land_only = set()
+                for from_area, to_area, only_land in borders:
+                        i, j = self.index[from_area], self.index[to_area]
+                        neighbours[i].append(j)
+                        if only_land:
+                                land_only.update(((i, j), (j, i)))
+                self.offsets = array.array('l', [0])
+                self.targets = array.array('l')
+                self.land = []
+                self.fleet = []
+                for i, targets in enumerate(neighbours):
+                        targets.sort()
+                        self.targets.extend(targets)
+                        self.offsets.append(len(self.targets))
+                        land = fleet = 0
+                        for j in targets:
+                                land |= 1 << j
+                                if not (i, j) in land_only:
+                                        fleet |= 1 << j
+                        self.land.append(land)
+                        self.fleet.append(fleet)
+
+        def is_adjacent(self, from_area, to_area, fleet=False):
+                """ Returns True if there is a border from one area to the other,
+                given by their primary keys. With ``fleet``, the border must be
+                passable by fleets. """
+                i = self.index.get(from_area)
+                j = self.index.get(to_area)
+                if i is None or j is None:
+                        return False
+                bits = self.fleet[i] if fleet else self.land[i]
+                return bool(bits >> j & 1)
+
+        def neighbours(self, area, fleet=False):
+                """ Returns the primary keys of the neighbours of an area """
+                i = self.index.get(area)
+                if i is None:
+                        return []
+                targets = self.targets[self.offsets[i]:self.offsets[i + 1]]
+                if fleet:
+                        targets = [j for j in targets if self.fleet[i] >> j & 1]
+                return [self.areas[j] for j in targets]
+
+def build_adjacency(setting_id, version=None):
+        from condottieri_scenarios.models import Area, Border
+
+        areas = Area.objects.filter(setting=setting_id).order_by('pk').values_list('pk', flat=True)
+        borders = Border.objects.filter(from_area__setting=setting_id,
+                to_area__setting=setting_id).values_list('from_area', 'to_area', 'only_land')
+        return Adjacency(list(areas), borders)
+
+cache = register_cache('setting', build_adjacency)
+
+def get_adjacency(setting_id):
+        """ Returns the Adjacency of a setting, given by its primary key """
+        return cache.get(setting_id)
+
+def invalidate_adjacency(setting_id=None):
+        """ Changes the version of the graph of a setting, or of the graphs
+        of all the settings if setting_id is None """
+        cache.invalidate(setting_id)
+
+def signal_handler_invalidate_adjacency(sender, instance, **kwargs):
+        """ Changes the version of the graph of the setting of a border or an
+        area """
+        try:
+                area = getattr(instance, 'from_area', instance)
+                invalidate_adjacency(area.setting_id)
+        except ObjectDoesNotExist:
+                invalidate_adjacency()
@@ -1,6 +1,7 @@
 from django.contrib import admin
 
 import condottieri_scenarios.models as scenarios
+import condottieri_scenarios.render_queue as render_queue
 from condottieri_scenarios.graphics import make_scenario_map
 
 class ContenderInline(admin.TabularInline):
@@ -48,8 +49,15 @@ class ScenarioAdmin(admin.ModelAdmin):
 	actions = ['make_map',]
 	
 	def make_map(self, request, queryset):
+		if not render_queue.queue_enabled():
+			for obj in queryset:
+				make_scenario_map(obj)
+			return
+		queued = 0
 		for obj in queryset:
-			make_scenario_map(obj)
+			if render_queue.enqueue(obj):
+				queued += 1
+		self.message_user(request, "%s maps queued, %s already waiting in the queue" % (queued, len(queryset) - queued))
 	make_map.short_description = "Make initial map"
 
 class ContenderAdmin(admin.ModelAdmin):
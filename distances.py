@@ -0,0 +1,215 @@
+## Copyright (c) 2010 by Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by the
+## Free Software Foundation, either version 3 of the License, or (at your option
+## any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program. If not, see <http://www.gnu.org/licenses/agpl.txt>.
+##
+## This license is also included in the file COPYING
+##
+## AUTHOR: Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+
+""" This module computes the number of moves between every pair of areas of
+a setting, for armies and for fleets.
+
+The distances are found with a breadth first search from all the areas at
+once, over the borders of the setting, and kept in NumPy matrices of int8,
+or int16 for settings of more than 127 areas, with -1 for the areas that
+cannot be reached. The matrices of each setting are saved in
+``DISTANCES_DIR``, out of the media files because they are not served, in
+a directory of the database, so that the projects and the test runs of the
+same host do not share them. They are removed when a border or an area of
+the setting changes, so they are only computed again when they are needed.
+
+NumPy is only needed to compute and read the distances.
+"""
+
+import hashlib
+import os
+import os.path
+import tempfile
+import threading
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured, ObjectDoesNotExist
+from django.db import connection, transaction
+
+try:
+        import numpy
+except ImportError:
+        numpy = None
+
+import condottieri_scenarios.adjacency as adjacency
+
+DISTANCES_DIR = getattr(settings, 'SCENARIOS_DISTANCES_ROOT',
+        os.path.join(tempfile.gettempdir(), 'condottieri_scenarios', 'distances'))
+
+UNREACHABLE = -1
+
+class Distances(object):
+        """ The matrices of distances of a setting. The rows and columns are
+        the areas, in the order of ``areas``. """
+        __slots__ = ('areas', 'index', 'army', 'fleet')
+
+        def __init__(self, areas, army, fleet):
+                self.areas = areas
+                self.index = dict((pk, i) for i, pk in enumerate(areas.tolist()))
+                self.army = army
+                self.fleet = fleet
+
+        def matrix(self, fleet=False):
+                return self.fleet if fleet else self.army
+
+        def distance(self, from_area, to_area, fleet=False):
+                """ Returns the number of moves from one area to the other,
+                given by their primary keys, or None if the unit cannot get
+                there """
+                i = self.index.get(from_area)
+                j = self.index.get(to_area)
+                if i is None or j is None:
+                        return None
+                d = int(self.matrix(fleet)[i, j])
+                return None if d == UNREACHABLE else d
+
+        def reachable(self, area, moves, fleet=False):
+                """ Returns the primary keys of the areas that a unit in the
+                given area can reach in at most ``moves`` moves """
+                i = self.index.get(area)
+                if i is None:
+                        return []
+                row = self.matrix(fleet)[i]
+                return self.areas[(row != UNREACHABLE) & (row <= moves)].tolist()
+
+def distance_matrix(nodes, edges):
+        """ Returns the distances between the nodes of a graph, given by a
+        boolean vector of the nodes that can be used and a boolean matrix of
+        the edges. Every step of the search expands the frontier of all the
+        nodes at once. """
+        n = len(nodes)
+        dtype = numpy.int8 if n <= numpy.iinfo(numpy.int8).max else numpy.int16
+        edges = (edges & nodes[:, None] & nodes[None, :]).astype(numpy.int32)
+        result = numpy.full((n, n), UNREACHABLE, dtype=dtype)
+        frontier = numpy.diag(nodes)
+        visited = frontier.copy()
+        result[frontier] = 0
+        steps = 0
+        while frontier.any():
+                steps += 1
+                frontier = (frontier.astype(numpy.int32) @ edges > 0) & ~visited
+                result[frontier] = steps
+                visited |= frontier
+        return result
+
+def build_distances(setting_id):
+        """ Computes the distances of a setting from the database """
+        from condottieri_scenarios.models import Area
+
+        if numpy is None:
+                raise ImproperlyConfigured("NumPy is needed to compute the distances between areas")
+        graph = adjacency.build_adjacency(setting_id)
+        n = len(graph.areas)
+        flags = dict((pk, (is_sea, is_coast, mixed)) for pk, is_sea, is_coast, mixed in
+                Area.objects.filter(setting=setting_id).values_list('pk', 'is_sea', 'is_coast', 'mixed'))
+        ## the areas where each type of unit can be, as in Area.accepts_type
+        army = numpy.array([not flags[pk][0] and not flags[pk][2] for pk in graph.areas], dtype=bool)
+        fleet = numpy.array([flags[pk][0] or flags[pk][1] for pk in graph.areas], dtype=bool)
+        land_edges = numpy.zeros((n, n), dtype=bool)
+        fleet_edges = numpy.zeros((n, n), dtype=bool)
+        for i in range(n):
+                for j in graph.targets[graph.offsets[i]:graph.offsets[i + 1]]:
+                        land_edges[i, j] = True
+                        fleet_edges[i, j] = bool(graph.fleet[i] >> j & 1)
+        return Distances(numpy.array(graph.areas, dtype=numpy.int64),
+                distance_matrix(army, land_edges),
+                distance_matrix(fleet, fleet_edges))
+
+def distances_dir():
+        """ Returns the directory of the distances of the settings in the
+        database in use """
+        database = "%s:%s" % (connection.alias, connection.settings_dict['NAME'])
+        return os.path.join(DISTANCES_DIR, hashlib.sha1(database.encode('utf-8')).hexdigest()[:12])
+
+def distances_path(setting_id):
+        return os.path.join(distances_dir(), "%s.npz" % setting_id)
+
+def save_distances(setting_id, distances):
+        path = distances_path(setting_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = "%s.tmp" % path
+        with open(tmp, 'wb') as f:
+                numpy.savez(f, areas=distances.areas, army=distances.army, fleet=distances.fleet)
+        os.replace(tmp, path)
+
+def read_distances(path):
+        with numpy.load(path) as data:
+                return Distances(data['areas'], data['army'], data['fleet'])
+
+## distances read in this process, with the modification time of their file
+_distances = {}
+_lock = threading.Lock()
+
+def get_distances(setting_id):
+        """ Returns the Distances of a setting, given by its primary key. They
+        are read from their file, or computed and saved if there is none. """
+        path = distances_path(setting_id)
+        try:
+                mtime = os.path.getmtime(path)
+        except OSError:
+                mtime = None
+        with _lock:
+                cached = _distances.get(setting_id)
+        if cached is not None and mtime is not None and cached[0] == mtime:
+                return cached[1]
+        if mtime is None:
+                distances = build_distances(setting_id)
+                save_distances(setting_id, distances)
+                mtime = os.path.getmtime(path)
+        else:
+                distances = read_distances(path)
+        with _lock:
+                _distances[setting_id] = (mtime, distances)
+        return distances
+
+def invalidate_distances(setting_id=None):
+        """ Removes the distances of a setting, or of all the settings if
+        setting_id is None, so that they are computed again. They are
+        removed again when the transaction is committed, in case that
+        another process computed them from the old rows in the meantime. """
+        _invalidate(setting_id)
+        if transaction.get_connection().in_atomic_block:
+                transaction.on_commit(lambda: _invalidate(setting_id))
+
+def _invalidate(setting_id):
+        if setting_id is None:
+                paths = []
+                directory = distances_dir()
+                if os.path.isdir(directory):
+                        paths = [os.path.join(directory, f) for f in os.listdir(directory)
+                                if f.endswith('.npz')]
+        else:
+                paths = [distances_path(setting_id), ]
+        for path in paths:
+                try:
+                        os.remove(path)
+                except OSError:
+                        pass
+        with _lock:
+                if setting_id is None:
+                        _distances.clear()
+                else:
+                        _distances.pop(setting_id, None)
+
+def signal_handler_invalidate_distances(sender, instance, **kwargs):
+        """ Removes the distances of the setting of a border or an area """
+        try:
+                area = getattr(instance, 'from_area', instance)
+                invalidate_distances(area.setting_id)
+        except ObjectDoesNotExist:
+                invalidate_distances()
@@ -149,6 +149,52 @@ CountryRandomIncomeFormSet = inlineformset_factory(scenarios.Country,
     extra=1,
     fields="__all__")
 
+def check_area(data):
+    """ Raises a ValidationError if the attributes of an area break the rules
+    of the game. ``data`` is a dictionary with the fields of AreaForm. """
+    is_sea = data.get("is_sea", False)
+    is_coast = data.get("is_coast", False)
+    has_city = data.get("has_city", False)
+    is_fortified = data.get("is_fortified", False)
+    has_port = data.get("has_port", False)
+    control_income = data.get("control_income", 0)
+    garrison_income = data.get("garrison_income", 0)
+    mixed = data.get("mixed", False)
+
+    if not has_city:
+        if is_fortified:
+            raise forms.ValidationError(str(_("An area without a city cannot be fortified")))
+        if has_port:
+            raise forms.ValidationError(str(_("An area without a city cannot have a port")))
+        if control_income > 1:
+            raise forms.ValidationError(str(_("The control income for an area without city must be 1")))
+        if garrison_income > 0:
+            raise forms.ValidationError(str(_("The garrison income for an area without city must be 0")))
+    else:
+        if control_income < 2:
+            raise forms.ValidationError(str(_("The control income for an area with a city must be 2 or higher")))
+
+    if is_sea:
+        if is_coast:
+            raise forms.ValidationError(str(_("An area cannot be sea and coast at the same time")))
+        if has_city:
+            raise forms.ValidationError(str(_("There cannot be a city in a sea area")))
+        if control_income > 0:
+            raise forms.ValidationError(str(_("The control income for a sea area must be 0")))
+        if mixed:
+            raise forms.ValidationError(str(_("An area cannot be sea and mixed at the same time")))
+    else:
+        if control_income < 1:
+            raise forms.ValidationError(str(_("The minimum control income for land areas is 1")))
+
+    if not is_coast:
+        if has_port:
+            raise forms.ValidationError(str(_("An area must be a coast to have a port")))
+
+    if is_fortified:
+        if control_income - garrison_income != 1:
+            raise forms.ValidationError(str(_("For an area with a fortified city, the control income must be the garrison income + 1")))
+
 class AreaForm(forms.ModelForm):
     class Meta:
         model = scenarios.Area
@@ -171,49 +217,7 @@ class AreaForm(forms.ModelForm):
     
     def clean(self):
         cleaned_data = self.cleaned_data
-        is_sea = cleaned_data.get("is_sea", False)
-        is_coast = cleaned_data.get("is_coast", False)
-        has_city = cleaned_data.get("has_city", False)
-        is_fortified = cleaned_data.get("is_fortified", False)
-        has_port = cleaned_data.get("has_port", False)
-        control_income = cleaned_data.get("control_income", 0)
-        garrison_income = cleaned_data.get("garrison_income", 0)
-        mixed = cleaned_data.get("mixed", False)
-
-        if not has_city:
-            if is_fortified:
-                raise forms.ValidationError(str(_("An area without a city cannot be fortified")))
-            if has_port:
-                raise forms.ValidationError(str(_("An area without a city cannot have a port")))
-            if control_income > 1:
-                raise forms.ValidationError(str(_("The control income for an area without city must be 1")))
-            if garrison_income > 0:
-                raise forms.ValidationError(str(_("The garrison income for an area without city must be 0")))
-        else:
-            if control_income < 2:
-                raise forms.ValidationError(str(_("The control income for an area with a city must be 2 or higher")))
-
-        if is_sea:
-            if is_coast:
-                raise forms.ValidationError(str(_("An area cannot be sea and coast at the same time")))
-            if has_city:
-                raise forms.ValidationError(str(_("There cannot be a city in a sea area")))
-            if control_income > 0:
-                raise forms.ValidationError(str(_("The control income for a sea area must be 0")))
-            if mixed:
-                raise forms.ValidationError(str(_("An area cannot be sea and mixed at the same time")))
-        else:
-            if control_income < 1:
-                raise forms.ValidationError(str(_("The minimum control income for land areas is 1")))
-
-        if not is_coast:
-            if has_port:
-                raise forms.ValidationError(str(_("An area must be a coast to have a port")))
-
-        if is_fortified:
-            if control_income - garrison_income != 1:
-                raise forms.ValidationError(str(_("For an area with a fortified city, the control income must be the garrison income + 1")))
-            
+        check_area(cleaned_data)
         return cleaned_data
     
     def save(self, commit=True):
@@ -18,81 +18,717 @@
 
 """ This module defines functions to generate the map. """
 
-from PIL import Image, ImageDraw
+from PIL import Image, ImageDraw, PngImagePlugin, features
+from collections import OrderedDict
+import concurrent.futures
+import hashlib
+import json
+import multiprocessing
 import os
 import os.path
+import shutil
+import threading
 
 from django.conf import settings
+from django.core.exceptions import ObjectDoesNotExist
+from django.db import connections
 
 TOKENS_DIR=os.path.join(settings.MEDIA_ROOT, 'scenarios', 'tokens')
 TEMPLATES_DIR=os.path.join(settings.MEDIA_ROOT, 'scenarios', 'token_templates')
 BADGES_DIR=os.path.join(settings.MEDIA_ROOT, 'scenarios', 'badges')
+ATLAS_DIR=os.path.join(settings.MEDIA_ROOT, 'scenarios', 'atlas')
+
+MARKERS_LAYER = "markers"
+
+## Change this number when the way of rendering the maps changes, so that
+## the maps made by the previous code are not taken as up to date
+RENDER_VERSION = 1
+
+TILE_SIZE = 256
+
+## directories and boxes of the reduced sizes of the maps: the thumbnails for
+## the lists of scenarios and the previews for the scenario pages
+DEFAULT_MAP_SIZES = OrderedDict([
+        ("thumbnails", (187, 267)),
+        ("previews", (800, 800)),
+])
+
+## encoders and their options for each type of output: the full maps, their
+## reduced sizes, the map tiles and the tokens. Each output is saved in the
+## format of its file name, and also in the other formats of its encoders,
+## with the same name and the extension of the format.
+DEFAULT_ENCODERS = {
+        'map': OrderedDict([
+                ('jpeg', {'quality': 85, 'optimize': True, 'progressive': True}),
+                ('webp', {'quality': 80, 'method': 6}),
+        ]),
+        'size': OrderedDict([
+                ('jpeg', {'quality': 80, 'optimize': True, 'progressive': True}),
+                ('webp', {'quality': 75, 'method': 6}),
+        ]),
+        'tile': OrderedDict([
+                ('jpeg', {'quality': 80, 'optimize': True}),
+        ]),
+        ## 'colors' quantizes the tokens to a palette of that many colors
+        'token': OrderedDict([
+                ('png', {'optimize': True}),
+        ]),
+}
+
+FORMAT_EXTENSIONS = {'jpeg': 'jpg', 'webp': 'webp', 'png': 'png'}
+FORMAT_CONTENT_TYPES = {'jpeg': 'image/jpeg', 'webp': 'image/webp', 'png': 'image/png'}
+
+## prefixes of the tokens made for each country
+COUNTRY_TOKENS = ("badge", "icon", "A", "G", "F", "control", "flag")
+## tokens shared by all the countries, that are also packed in the atlases
+ATLAS_EXTRA_TOKENS = ("G-autonomous.png", "disabled.png", "chest.png")
+ATLAS_WIDTH = 1024
 
 def ensure_dir(f):
         d = os.path.dirname(f)
         if not os.path.exists(d):
                 os.makedirs(d)
 
-def make_scenario_map(s):
-        """ Makes the initial map for an scenario.
+class ImageCache(object):
+        """ A process wide cache of decoded RGBA images, keyed by path and
+        modification time of the file. When the decoded images take more than
+        max_bytes, the least recently used ones are evicted.
+
+        The cached images are shared, so they must not be modified.
+        """
+        def __init__(self, max_bytes):
+                self.max_bytes = max_bytes
+                self.size = 0
+                self._images = OrderedDict()
+                self._lock = threading.Lock()
+
+        def get(self, path):
+                mtime = os.path.getmtime(path)
+                with self._lock:
+                        entry = self._images.get(path)
+                        if entry is not None and entry[0] == mtime:
+                                self._images.move_to_end(path)
+                                return entry[1]
+                image = Image.open(path).convert("RGBA")
+                with self._lock:
+                        self._discard(path)
+                        self._images[path] = (mtime, image)
+                        self.size += image_bytes(image)
+                        while self.size > self.max_bytes and len(self._images) > 1:
+                                self._discard(next(iter(self._images)))
+                return image
+
+        def invalidate(self, paths=None):
+                """ Removes the given paths from the cache, or all of them if
+                paths is None. """
+                with self._lock:
+                        if paths is None:
+                                paths = list(self._images.keys())
+                        for path in paths:
+                                self._discard(path)
+
+        def _discard(self, path):
+                entry = self._images.pop(path, None)
+                if entry is not None:
+                        self.size -= image_bytes(entry[1])
+
+def image_bytes(image):
+        return image.size[0] * image.size[1] * len(image.getbands())
+
+token_cache = ImageCache(getattr(settings, 'SCENARIOS_TOKEN_CACHE_BYTES', 16 * 1024 * 1024))
+board_cache = ImageCache(getattr(settings, 'SCENARIOS_BOARD_CACHE_BYTES', 128 * 1024 * 1024))
+
+def get_token(name):
+        """ Returns the decoded token image with the given file name """
+        return token_cache.get(os.path.join(TOKENS_DIR, name))
+
+def get_board_layer(setting):
+        """ Returns the board of a setting as an RGBA image. The board is
+        decoded only once per process, and again only if the file changes.
+        """
+        return board_cache.get(setting.board.path)
+
+def encoders(output):
+        """ Returns the formats, with their options, in which an output is
+        saved. Formats that this Pillow cannot write are left out.
+        """
+        configured = getattr(settings, 'SCENARIOS_ENCODERS', {})
+        result = OrderedDict()
+        for fmt, options in configured.get(output, DEFAULT_ENCODERS[output]).items():
+                if fmt == 'webp' and not features.check('webp'):
+                        continue
+                result[fmt] = options
+        return result
+
+def encoder_options(output, fmt):
+        return dict(encoders(output).get(fmt, {}))
+
+def format_path(filename, fmt):
+        """ Returns the path where an output is saved in the given format """
+        return "%s.%s" % (os.path.splitext(filename)[0], FORMAT_EXTENSIONS[fmt])
+
+def path_format(filename):
+        ext = os.path.splitext(filename)[1][1:].lower()
+        for fmt, fmt_ext in FORMAT_EXTENSIONS.items():
+                if ext == fmt_ext:
+                        return fmt
+        return None
+
+def encode_image(image, fp, fmt, options):
+        """ Writes an image to a file name or file object in the given format,
+        with the options of its encoder. """
+        options = dict(options)
+        colors = options.pop('colors', None)
+        if fmt == 'jpeg' and image.mode not in ("RGB", "L"):
+                image = image.convert("RGB")
+        elif fmt == 'png' and colors:
+                image = image.quantize(colors, method=Image.Quantize.FASTOCTREE
+                        if image.mode == "RGBA" else Image.Quantize.MEDIANCUT)
+        image.save(fp, fmt.upper(), **options)
+
+def save_output(image, filename, output):
+        """ Saves an image in the format of filename, and in every other
+        format of the encoders of the output. The files of the formats that
+        are no longer in the encoders are removed. Returns the paths written.
         """
-        base_map = Image.open(s.setting.board)
-        ## if there are disabled areas, mark them
-        marker = Image.open("%s/disabled.png" % TOKENS_DIR)
-        for d in  s.disabledarea_set.all():
-                base_map.paste(marker, (d.area.aftoken.x, d.area.aftoken.y), marker)
-        ## mark special city incomes
-        marker = Image.open("%s/chest.png" % TOKENS_DIR)
-        for i in s.cityincome_set.all():
-                base_map.paste(marker, (i.city.gtoken.x + 48, i.city.gtoken.y), marker)
-        ##
-        for c in s.contender_set.filter(country__isnull=False):
-                ## paste control markers and flags
-                marker = Image.open("%s/control-%s.png" % (TOKENS_DIR, c.country.static_name))
-                flag = Image.open("%s/flag-%s.png" % (TOKENS_DIR, c.country.static_name))
-                for h in c.home_set.all():
-                        base_map.paste(marker, (h.area.controltoken.x, h.area.controltoken.y), marker)
-                        if h.is_home:
-                                base_map.paste(flag, (h.area.controltoken.x, h.area.controltoken.y - 15), flag)
-                ## paste units
-                army = Image.open("%s/A-%s.png" % (TOKENS_DIR, c.country.static_name))
-                fleet = Image.open("%s/F-%s.png" % (TOKENS_DIR, c.country.static_name))
-                garrison = Image.open("%s/G-%s.png" % (TOKENS_DIR, c.country.static_name))
-                for setup in c.setup_set.all():
-                        if setup.unit_type == 'G':
-                                coords = (setup.area.gtoken.x, setup.area.gtoken.y)
-                                base_map.paste(garrison, coords, garrison)
-                        elif setup.unit_type == 'A':
-                                coords = (setup.area.aftoken.x, setup.area.aftoken.y)
-                                base_map.paste(army, coords, army)
-                        elif setup.unit_type == 'F':
-                                coords = (setup.area.aftoken.x, setup.area.aftoken.y)
-                                base_map.paste(fleet, coords, fleet)
-                        else:
+        main = path_format(filename)
+        formats = encoders(output)
+        ## the main file is written first, so that a variant older than it
+        ## is known to be stale
+        encode_image(image, filename, main, formats.get(main, {}))
+        paths = [filename, ]
+        for fmt, options in formats.items():
+                if fmt != main:
+                        path = format_path(filename, fmt)
+                        encode_image(image, path, fmt, options)
+                        paths.append(path)
+        for fmt in FORMAT_EXTENSIONS:
+                if fmt != main and not fmt in formats:
+                        try:
+                                os.remove(format_path(filename, fmt))
+                        except OSError:
                                 pass
-        for c in s.contender_set.filter(country__isnull=True):
-                ## paste autonomous garrisons
-                garrison = Image.open("%s/G-autonomous.png" % TOKENS_DIR)
-                for g in c.setup_set.filter(unit_type='G'):
-                        coords = (g.area.gtoken.x, g.area.gtoken.y)
-                        base_map.paste(garrison, coords, garrison)
+        return paths
+
+def parse_accept(accept):
+        """ Returns a dictionary with the quality of each media type in an
+        Accept header. """
+        result = {}
+        for item in accept.split(","):
+                params = item.strip().split(";")
+                media_type = params[0].strip().lower()
+                if not media_type:
+                        continue
+                q = 1.0
+                for param in params[1:]:
+                        key, sep, value = param.partition("=")
+                        if key.strip().lower() == "q":
+                                try:
+                                        q = float(value)
+                                except ValueError:
+                                        q = 0.0
+                result[media_type] = q
+        return result
+
+def accept_quality(accepted, content_type):
+        """ Returns the quality of a content type in a parsed Accept header,
+        taken from the most specific media type that matches it. """
+        for media_type in (content_type, "%s/*" % content_type.split("/")[0], "*/*"):
+                if media_type in accepted:
+                        return accepted[media_type]
+        return 0.0
+
+def negotiate_format(filename, accept):
+        """ Returns the path and content type of the smallest format of a
+        saved output that the client accepts, given its Accept header.
+        The format of filename is always accepted, and the other formats
+        are served only if they are named in the header, with a quality not
+        lower than that of the format of filename, and if they are not older
+        than filename.
+        """
+        main = path_format(filename)
+        accepted = parse_accept(accept)
+        quality = accept_quality(accepted, FORMAT_CONTENT_TYPES[main])
+        for fmt in ('webp', ):
+                q = accepted.get(FORMAT_CONTENT_TYPES[fmt], 0.0)
+                if fmt != main and q > 0 and q >= quality:
+                        path = format_path(filename, fmt)
+                        try:
+                                fresh = os.path.getmtime(path) >= os.path.getmtime(filename)
+                        except OSError:
+                                continue
+                        if fresh:
+                                return path, FORMAT_CONTENT_TYPES[fmt]
+        return filename, FORMAT_CONTENT_TYPES[main]
+
+def atlas_enabled():
+        return getattr(settings, 'SCENARIOS_TOKEN_ATLAS', False)
+
+def atlas_path(setting):
+        return os.path.join(ATLAS_DIR, "%s.png" % setting.slug)
+
+def atlas_index_path(setting):
+        return os.path.join(ATLAS_DIR, "%s.json" % setting.slug)
+
+def pack_atlas(tokens):
+        """ Packs the tokens in a single RGBA image, in shelves sorted by
+        height. Returns the image and a dictionary with the rectangle
+        (x, y, width, height) of each token.
+        """
+        tokens = [(name, token if token.mode == "RGBA" else token.convert("RGBA"))
+                for name, token in tokens.items()]
+        tokens.sort(key=lambda t: (-t[1].size[1], t[0]))
+        width = max([ATLAS_WIDTH] + [token.size[0] for name, token in tokens])
+        rects = OrderedDict()
+        x = y = shelf = used = 0
+        for name, token in tokens:
+                w, h = token.size
+                if x + w > width:
+                        x, y, shelf = 0, y + shelf, 0
+                rects[name] = (x, y, w, h)
+                x += w
+                shelf = max(shelf, h)
+                used = max(used, x)
+        atlas = Image.new("RGBA", (max(used, 1), max(y + shelf, 1)), (0, 0, 0, 0))
+        for name, token in tokens:
+                atlas.paste(token, rects[name][:2])
+        return atlas, rects
+
+def make_atlas(setting):
+        """ Makes the atlas of a setting, with the tokens of all the countries
+        that play in any of its scenarios. The tokens of protected countries
+        are taken from their files. Returns the atlas and its index.
+        """
+        from condottieri_scenarios.models import Country
+
+        tokens = OrderedDict()
+        for name in ATLAS_EXTRA_TOKENS:
+                if os.path.exists(token_path(name)):
+                        tokens[name] = Image.open(token_path(name))
+        countries = Country.objects.filter(contender__scenario__setting=setting).distinct()
+        for country in countries:
+                if country.protected:
+                        for prefix in COUNTRY_TOKENS:
+                                name = "%s-%s.png" % (prefix, country.static_name)
+                                if os.path.exists(token_path(name)):
+                                        tokens[name] = Image.open(token_path(name))
+                else:
+                        tokens.update(render_country_tokens(country))
+        atlas, rects = pack_atlas(tokens)
+        ## several workers may be making the same atlas
+        filename = atlas_path(setting)
+        ensure_dir(filename)
+        tmp = "%s.%s.tmp" % (filename, os.getpid())
+        encode_image(atlas, tmp, "png", encoder_options("token", "png"))
+        os.replace(tmp, filename)
+        index = {'width': atlas.size[0], 'height': atlas.size[1], 'tokens': rects}
+        tmp = "%s.%s.tmp" % (atlas_index_path(setting), os.getpid())
+        with open(tmp, 'w') as f:
+                json.dump(index, f, sort_keys=True)
+        os.replace(tmp, atlas_index_path(setting))
+        return atlas, dict(rects)
+
+_atlas_indexes = {}
+
+def get_atlas_index(setting):
+        """ Returns the rectangles of the tokens in the atlas of a setting,
+        or None if the atlas has not been made. """
+        path = atlas_index_path(setting)
+        try:
+                mtime = os.path.getmtime(path)
+        except OSError:
+                return None
+        cached = _atlas_indexes.get(path)
+        if cached is None or cached[0] != mtime:
+                with open(path, 'r') as f:
+                        tokens = json.load(f)['tokens']
+                cached = (mtime, dict((name, tuple(rect)) for name, rect in tokens.items()))
+                _atlas_indexes[path] = cached
+        return cached[1]
+
+def get_atlas(setting):
+        """ Returns the decoded atlas of a setting and its index, making the
+        atlas if needed. """
+        rects = get_atlas_index(setting)
+        if rects is None or not os.path.exists(atlas_path(setting)):
+                return make_atlas(setting)
+        return token_cache.get(atlas_path(setting)), rects
+
+def invalidate_atlas(setting):
+        """ Removes the atlas of a setting, so that it is made again the next
+        time that it is needed. """
+        for path in (atlas_path(setting), atlas_index_path(setting)):
+                try:
+                        os.remove(path)
+                except OSError:
+                        pass
+        token_cache.invalidate([atlas_path(setting), ])
+        with _sprites_lock:
+                for key in [k for k in _sprites if k[0] == atlas_path(setting)]:
+                        del _sprites[key]
+
+_sprites = {}
+_sprites_lock = threading.Lock()
+
+def get_sprite(setting, name):
+        """ Returns the decoded token with the given file name. In atlas mode,
+        the token is cropped from the atlas of the setting if it is there,
+        only once while the atlas does not change.
+
+        The sprites are shared, so they must not be modified.
+        """
+        if atlas_enabled():
+                atlas, rects = get_atlas(setting)
+                rect = rects.get(name)
+                if rect is not None:
+                        key = (atlas_path(setting), name)
+                        with _sprites_lock:
+                                cached = _sprites.get(key)
+                        if cached is None or cached[0] is not atlas or cached[1] != rect:
+                                x, y, w, h = rect
+                                cached = (atlas, rect, atlas.crop((x, y, x + w, y + h)))
+                                with _sprites_lock:
+                                        _sprites[key] = cached
+                        return cached[2]
+        return get_token(name)
+
+def sprite_hash(setting, name):
+        """ Returns a hash of the image of a token, as used by get_sprite """
+        if atlas_enabled():
+                rect = get_atlas(setting)[1].get(name)
+                if rect is not None:
+                        return "%s:%s" % (file_hash(atlas_path(setting)), ",".join(map(str, rect)))
+        return file_hash(token_path(name))
+
+def country_token_index(countries):
+        """ Returns the url and the rectangle in the atlas of the tokens of the
+        given countries, by file name, in a single query. Only the atlases
+        already made are read; the missing ones are made by the render queue,
+        if it is enabled, or by render_scenario_maps. The tokens that are in
+        none of them are left out.
+        """
+        from condottieri_scenarios.models import Setting
+        from condottieri_scenarios import render_queue
+
+        index = {}
+        missing = []
+        for setting in Setting.objects.filter(scenario__contender__country__in=countries).distinct():
+                rects = get_atlas_index(setting)
+                if rects is None or not os.path.exists(atlas_path(setting)):
+                        missing.append(setting)
+                        continue
+                url = atlas_url(setting)
+                for name, rect in rects.items():
+                        index.setdefault(name, (url, rect))
+        if missing and render_queue.queue_enabled():
+                for setting in missing:
+                        scenario = setting.scenario_set.first()
+                        if scenario is not None:
+                                render_queue.enqueue(scenario)
+        return index
+
+def atlas_url(setting):
+        url = "%sscenarios/atlas/%s.png" % (settings.MEDIA_URL, setting.slug)
+        return "%s?v=%s" % (url, file_hash(atlas_path(setting))[:12])
+
+def contender_layer(contender_id):
+        """ Returns the key of the layer holding the tokens of a contender """
+        return "contender-%s" % contender_id
+
+def layer_path(s, key):
+        return os.path.join(s.layers_path, "%s.png" % key)
+
+def invalidate_layers(s, keys=None):
+        """ Removes the cached layers of a scenario, so that they are rendered
+        again in the next call to make_scenario_map. If keys is None, all the
+        layers are removed.
+        """
+        if keys is None:
+                if os.path.isdir(s.layers_path):
+                        keys = [f[:-4] for f in os.listdir(s.layers_path) if f.endswith(".png")]
+                else:
+                        keys = []
+        for key in keys:
+                try:
+                        os.remove(layer_path(s, key))
+                except OSError:
+                        pass
+
+def render_plan(s):
+        """ Returns the draw operations needed to make the map of a scenario.
+
+        The result is an ordered dictionary mapping the key of each layer, in
+        the order that the layers are composited, to a flat list of
+        (sprite, x, y) operations, where sprite is the file name of a token.
+        All the placements and token coordinates are fetched in a fixed number
+        of queries, no matter how many units and homes the scenario has.
+        """
+        from condottieri_scenarios.models import Home, Setup
+
+        plan = OrderedDict()
+        ## disabled areas and special city incomes
+        ops = []
+        for x, y in s.disabledarea_set.values_list('area__aftoken__x', 'area__aftoken__y'):
+                ops.append(("disabled.png", x, y))
+        for x, y in s.cityincome_set.values_list('city__gtoken__x', 'city__gtoken__y'):
+                if x is not None:
+                        x += 48
+                ops.append(("chest.png", x, y))
+        plan[MARKERS_LAYER] = ops
+        ## one layer for each country, and the autonomous garrisons at the end
+        countries = OrderedDict()
+        autonomous = []
+        for pk, static_name in s.contender_set.values_list('pk', 'country__static_name'):
+                if static_name is None:
+                        autonomous.append(pk)
+                else:
+                        countries[pk] = static_name
+        for pk in list(countries.keys()) + autonomous:
+                plan[contender_layer(pk)] = []
+        ## control markers and flags
+        homes = Home.objects.filter(contender__scenario=s).order_by('pk').values_list(
+                'contender', 'is_home', 'area__controltoken__x', 'area__controltoken__y')
+        for contender, is_home, x, y in homes:
+                if not contender in countries:
+                        continue
+                ops = plan[contender_layer(contender)]
+                ops.append(("control-%s.png" % countries[contender], x, y))
+                if is_home and y is not None:
+                        ops.append(("flag-%s.png" % countries[contender], x, y - 15))
+        ## units
+        setups = Setup.objects.filter(contender__scenario=s).order_by('pk').values_list(
+                'contender', 'unit_type', 'area__gtoken__x', 'area__gtoken__y',
+                'area__aftoken__x', 'area__aftoken__y')
+        for contender, unit_type, gx, gy, afx, afy in setups:
+                ops = plan[contender_layer(contender)]
+                if not contender in countries:
+                        if unit_type == 'G':
+                                ops.append(("G-autonomous.png", gx, gy))
+                elif unit_type == 'G':
+                        ops.append(("G-%s.png" % countries[contender], gx, gy))
+                elif unit_type in ('A', 'F'):
+                        ops.append(("%s-%s.png" % (unit_type, countries[contender]), afx, afy))
+        ## areas without token coordinates cannot be drawn
+        for key, ops in plan.items():
+                plan[key] = [op for op in ops if op[1] is not None and op[2] is not None]
+        return plan
+
+def render_layer(ops):
+        """ Pastes the tokens in ops on a transparent image. The image covers
+        only the bounding box of the tokens. Returns the image and its offset
+        in the board.
+        """
+        if not ops:
+                return Image.new("RGBA", (1, 1), (0, 0, 0, 0)), (0, 0)
+        ops = [(token if token.mode == "RGBA" else token.convert("RGBA"), x, y)
+                for token, x, y in ops]
+        left = min(x for token, x, y in ops)
+        top = min(y for token, x, y in ops)
+        right = max(x + token.size[0] for token, x, y in ops)
+        bottom = max(y + token.size[1] for token, x, y in ops)
+        layer = Image.new("RGBA", (right - left, bottom - top), (0, 0, 0, 0))
+        for token, x, y in ops:
+                layer.alpha_composite(token, (x - left, y - top))
+        return layer, (left, top)
+
+def layer_hash(s, ops):
+        """ Returns a hash of the operations of a layer and of the images of
+        the tokens that they draw. """
+        h = hashlib.sha1()
+        h.update(json.dumps([RENDER_VERSION, ops]).encode('utf-8'))
+        for sprite in sorted(set(sprite for sprite, x, y in ops)):
+                h.update(sprite.encode('utf-8'))
+                h.update(sprite_hash(s.setting, sprite).encode('utf-8'))
+        return h.hexdigest()
+
+def save_layer(layer, offset, filename, digest=""):
+        info = PngImagePlugin.PngInfo()
+        info.add_text("offset", "%s,%s" % offset)
+        info.add_text("hash", digest)
+        ensure_dir(filename)
+        tmp = "%s.tmp" % filename
+        layer.save(tmp, "PNG", pnginfo=info)
+        os.replace(tmp, filename)
+
+def load_layer(filename, digest=None):
+        """ Returns a cached layer and its offset, or None if the layer is
+        not cached, or if it was drawn from operations or tokens with a hash
+        other than digest.
+        """
+        try:
+                layer = Image.open(filename)
+                if digest is not None and layer.text.get("hash") != digest:
+                        return None
+                layer.load()
+        except (IOError, OSError):
+                return None
+        offset = tuple(int(i) for i in layer.text["offset"].split(","))
+        return layer, offset
+
+def get_layer(s, key, ops):
+        """ Returns a layer of the scenario and its offset, rendering the
+        operations in ops only if the layer is not cached, or if it was
+        cached from other operations or tokens.
+        """
+        filename = layer_path(s, key)
+        digest = layer_hash(s, ops)
+        cached = load_layer(filename, digest)
+        if cached is not None:
+                return cached
+        layer, offset = render_layer([(get_sprite(s.setting, sprite), x, y) for sprite, x, y in ops])
+        save_layer(layer, offset, filename, digest)
+        return layer, offset
+
+def flatten(board, layers):
+        """ Composites the layers over a copy of the board. """
+        base_map = board.copy()
+        for layer, (x, y) in layers:
+                base_map.alpha_composite(layer, (max(x, 0), max(y, 0)), (max(-x, 0), max(-y, 0)))
+        return base_map
+
+_file_hashes = {}
+
+def file_hash(path):
+        """ Returns the SHA-1 of a file. The file is read only once per process
+        while its modification time and size do not change.
+        """
+        stat = os.stat(path)
+        key = (stat.st_mtime, stat.st_size)
+        cached = _file_hashes.get(path)
+        if cached is None or cached[0] != key:
+                h = hashlib.sha1()
+                with open(path, 'rb') as f:
+                        for chunk in iter(lambda: f.read(65536), b''):
+                                h.update(chunk)
+                cached = (key, h.hexdigest())
+                _file_hashes[path] = cached
+        return cached[1]
+
+def output_options():
+        """ Returns the settings that change the files written for a map """
+        return {'tiles': tiles_enabled(), 'sizes': map_sizes(),
+                'encoders': dict((output, encoders(output)) for output in ('map', 'size', 'tile'))}
+
+def map_fingerprint(s, plan):
+        """ Returns a fingerprint of everything that the map of a scenario is
+        made of: the render plan, the board and the token images, and the
+        output options.
+        """
+        h = hashlib.sha1()
+        h.update(json.dumps([RENDER_VERSION, output_options(), list(plan.items())],
+                sort_keys=True).encode('utf-8'))
+        h.update(file_hash(s.setting.board.path).encode('utf-8'))
+        sprites = set(sprite for ops in plan.values() for sprite, x, y in ops)
+        for sprite in sorted(sprites):
+                h.update(sprite.encode('utf-8'))
+                h.update(sprite_hash(s.setting, sprite).encode('utf-8'))
+        return h.hexdigest()
+
+def make_scenario_map(s, force=False):
+        """ Makes the initial map for an scenario.
+
+        The map is composited from a board layer, a layer with the disabled areas
+        and city incomes, and one layer for each contender. Only the layers
+        that have been invalidated since the last call are rendered again.
+
+        If the fingerprint of the map has not changed since it was last made,
+        nothing is done and False is returned, unless force is True.
+        """
+        plan = render_plan(s)
+        fingerprint = map_fingerprint(s, plan)
+        if not force and fingerprint == s.read_map_fingerprint() and \
+                os.path.exists(s.map_path) and \
+                all(os.path.exists(s.get_map_size_path(d)) for d in map_sizes()) and \
+                (not tiles_enabled() or os.path.isdir(s.tiles_path)):
+                return False
+        board = get_board_layer(s.setting)
+        layers = [get_layer(s, key, ops) for key, ops in plan.items()]
+        base_map = flatten(board, layers)
         ## save the map
         result = base_map.convert("RGB")
         filename = s.map_path
         ensure_dir(filename)
-        result.save(filename)
-        make_scenario_thumb(s, 187, 267, "thumbnails")
+        save_output(result, filename, "map")
+        save_map_sizes(s, result)
+        if tiles_enabled():
+                make_map_tiles(s, result, fingerprint)
+        tmp = "%s.tmp" % s.fingerprint_path
+        with open(tmp, 'w') as f:
+                f.write(fingerprint)
+        os.replace(tmp, s.fingerprint_path)
+        s.map_fingerprint = fingerprint
         return True
 
-def make_scenario_thumb(scenario, w, h, dirname):
-        """ Make thumbnails of the scenario map image """
-        size = w, h
-        fd = scenario.map_path
-        outfile= scenario.thumbnail_path
-        im = Image.open(fd)
-        im.thumbnail(size, Image.Resampling.LANCZOS)
-        ensure_dir(outfile)
-        im.save(outfile, "JPEG")
+def tiles_enabled():
+        return getattr(settings, 'SCENARIOS_MAP_TILES', False)
+
+def make_map_tiles(s, image, fingerprint=None):
+        """ Writes a pyramid of tiles of the map, and a manifest describing it,
+        in the tiles directory of the scenario.
+
+        Level 0 fits in a single tile, and each level doubles the size of the
+        previous one, up to the full map in the last level. The levels are
+        made by halving the map in memory, one after the other.
+        """
+        levels = [image, ]
+        while max(levels[-1].size) > TILE_SIZE:
+                w, h = levels[-1].size
+                levels.append(levels[-1].resize((max(1, (w + 1) // 2), max(1, (h + 1) // 2)),
+                        Image.Resampling.LANCZOS))
+        levels.reverse()
+        tmp = "%s.tmp" % s.tiles_path
+        shutil.rmtree(tmp, ignore_errors=True)
+        for level, im in enumerate(levels):
+                level_dir = os.path.join(tmp, str(level))
+                os.makedirs(level_dir)
+                w, h = im.size
+                for row in range(0, (h + TILE_SIZE - 1) // TILE_SIZE):
+                        for col in range(0, (w + TILE_SIZE - 1) // TILE_SIZE):
+                                box = (col * TILE_SIZE, row * TILE_SIZE,
+                                        min(w, (col + 1) * TILE_SIZE), min(h, (row + 1) * TILE_SIZE))
+                                save_output(im.crop(box), os.path.join(level_dir, "%s_%s.jpg" % (col, row)), "tile")
+        manifest = {
+                'width': image.size[0],
+                'height': image.size[1],
+                'tile_size': TILE_SIZE,
+                'levels': [{'width': im.size[0], 'height': im.size[1]} for im in levels],
+                'format': 'jpg',
+                'fingerprint': fingerprint,
+        }
+        with open(os.path.join(tmp, "manifest.json"), 'w') as f:
+                json.dump(manifest, f)
+        ## swap the new pyramid for the old one
+        old = "%s.old" % s.tiles_path
+        shutil.rmtree(old, ignore_errors=True)
+        if os.path.exists(s.tiles_path):
+                os.rename(s.tiles_path, old)
+        os.rename(tmp, s.tiles_path)
+        shutil.rmtree(old, ignore_errors=True)
+        return manifest
+
+def map_sizes():
+        """ Returns the reduced sizes in which the maps are saved, besides the
+        full map, as a dictionary mapping the directory of each size to the
+        box where the map must fit.
+        """
+        return getattr(settings, 'SCENARIOS_MAP_SIZES', DEFAULT_MAP_SIZES)
+
+def save_map_sizes(s, image):
+        """ Saves the reduced sizes of a map from the composited image. The
+        sizes are made from the biggest to the smallest, and each one is
+        reduced from the previous one instead of from the full map.
+        """
+        w, h = image.size
+        boxes = sorted(map_sizes().items(),
+                key=lambda i: min(float(i[1][0]) / w, float(i[1][1]) / h), reverse=True)
+        source = image
+        for dirname, box in boxes:
+                im = source.copy()
+                im.thumbnail(tuple(box), Image.Resampling.LANCZOS)
+                outfile = s.get_map_size_path(dirname)
+                ensure_dir(outfile)
+                save_output(im, outfile, "size")
+                source = im
 
 def round_corner(radius, fill):
         """ Draw a round corner
@@ -127,64 +763,179 @@ def make_flag(fill):
         del draw
         return flag
 
+def signal_handler_invalidate_markers_layer(sender, instance, **kwargs):
+        """ Invalidates the layer of disabled areas and city incomes """
+        if kwargs.get('raw', False):
+                return
+        try:
+                invalidate_layers(instance.scenario, [MARKERS_LAYER, ])
+        except ObjectDoesNotExist:
+                pass
+
+def signal_handler_invalidate_contender_layer(sender, instance, **kwargs):
+        """ Invalidates the layer of the contender of a home or a setup, or of
+        the contender itself """
+        if kwargs.get('raw', False):
+                return
+        try:
+                contender = getattr(instance, 'contender', instance)
+                invalidate_layers(contender.scenario, [contender_layer(contender.pk), ])
+        except ObjectDoesNotExist:
+                pass
+
+def signal_handler_invalidate_area_layers(sender, instance, **kwargs):
+        """ Invalidates all the layers of the scenarios using the area of a
+        token, because its coordinates may have changed """
+        if kwargs.get('raw', False):
+                return
+        try:
+                for s in instance.area.setting.scenario_set.all():
+                        invalidate_layers(s)
+        except ObjectDoesNotExist:
+                pass
+
+def signal_handler_update_atlas(sender, instance, raw, **kwargs):
+        """ Removes the atlas of the setting if the country of a new contender
+        is not in it. """
+        if raw or instance.country_id is None:
+                return
+        try:
+                setting = instance.scenario.setting
+                static_name = instance.country.static_name
+        except ObjectDoesNotExist:
+                return
+        rects = get_atlas_index(setting)
+        if rects is not None and not "A-%s.png" % static_name in rects:
+                invalidate_atlas(setting)
+
 def signal_handler_make_country_tokens(sender, instance, created, raw, **kwargs):
     make_country_tokens(sender, instance, created, raw, **kwargs)
 
-def make_country_tokens(sender, instance, created, raw, **kwargs):
-        """ Generate all the tokens for a country """
-        if raw:
-            return
-        if instance.protected:
-            return
-        #try:
-        coat = Image.open(instance.coat_of_arms)
-        #except:
-        #       coat = None
+def render_country_tokens(country):
+        """ Returns an ordered dictionary with all the tokens of a country,
+        keyed by the name of the file where each token is kept.
+        """
+        coat = Image.open(country.coat_of_arms)
+        color = "#%s" % country.color if country.color else "#CCCCCC"
+        tokens = OrderedDict()
         ## generate 48x48 Badge
         badge_base = Image.open(os.path.join(TEMPLATES_DIR, "badge-base.png"))
         if coat:
                 badge_base.paste(coat, (4,4), coat)
-        badge_base.save(os.path.join(BADGES_DIR, "badge-%s.png" % instance.static_name))
+        tokens["badge-%s.png" % country.static_name] = badge_base
         ## generate 24x24 icon
         if coat:
                 icon = coat.copy()
                 icon.thumbnail((24,24), Image.Resampling.LANCZOS)
-                icon.save(os.path.join(BADGES_DIR, "icon-%s.png" % instance.static_name))
+                tokens["icon-%s.png" % country.static_name] = icon
         ## generate Army token
         army_base = Image.open(os.path.join(TEMPLATES_DIR, "army-base.png"))
         draw = ImageDraw.Draw(army_base)
-        draw.ellipse((5, 5, 45, 45), fill="#%s" % instance.color if instance.color else "#CCCCCC")
+        draw.ellipse((5, 5, 45, 45), fill=color)
         del draw
         if coat:
                 a_coat = coat.copy()
                 a_coat.thumbnail((26,26), Image.Resampling.LANCZOS)
                 army_base.paste(a_coat, (12,12), a_coat)
-        army_base.save(os.path.join(TOKENS_DIR, "A-%s.png" % instance.static_name))
+        tokens["A-%s.png" % country.static_name] = army_base
         ## generate Garrison token
         garrison_base = Image.open(os.path.join(TEMPLATES_DIR, "garrison-base.png"))
         draw = ImageDraw.Draw(garrison_base)
-        draw.ellipse((3, 3, 30, 30), fill="#%s" % instance.color if instance.color else "#CCCCCC")
+        draw.ellipse((3, 3, 30, 30), fill=color)
         del draw
         if coat:
                 g_coat = coat.copy()
                 g_coat.thumbnail((19, 19), Image.Resampling.LANCZOS)
                 garrison_base.paste(g_coat, (8,8), g_coat)
-        garrison_base.save(os.path.join(TOKENS_DIR, "G-%s.png" % instance.static_name))
+        tokens["G-%s.png" % country.static_name] = garrison_base
         ## generate Fleet token
         fleet_base = Image.open(os.path.join(TEMPLATES_DIR, "fleet-base.png"))
-        rectangle = round_rectangle((49,24), 7, "#%s" % instance.color if instance.color else "#CCCCCC")
+        rectangle = round_rectangle((49,24), 7, color)
         fleet_base.paste(rectangle, (2, 2), rectangle)
         ship = Image.open(os.path.join(TEMPLATES_DIR, "ship-icon.png"))
         fleet_base.paste(ship, (0,0), ship)
         if coat:
                 fleet_base.paste(g_coat, (6, 5), g_coat)
-        fleet_base.save(os.path.join(TOKENS_DIR, "F-%s.png" % instance.static_name))
+        tokens["F-%s.png" % country.static_name] = fleet_base
         ## generate Control token
         control = Image.new("RGBA", (24, 24))
         draw = ImageDraw.Draw(control)
-        draw.ellipse((0, 0, 24, 24), fill="#%s" % instance.color if instance.color else "#CCCCCC", outline="#000000")
+        draw.ellipse((0, 0, 24, 24), fill=color, outline="#000000")
         del draw
-        control.save(os.path.join(TOKENS_DIR, "control-%s.png" % instance.static_name))
+        tokens["control-%s.png" % country.static_name] = control
         ## generate Home flag
-        flag = make_flag("#%s" % instance.color if instance.color else "#CCCCCC")
-        flag.save(os.path.join(TOKENS_DIR, "flag-%s.png" % instance.static_name))
+        tokens["flag-%s.png" % country.static_name] = make_flag(color)
+        return tokens
+
+def token_path(name):
+        """ Returns the path of the loose file of a token """
+        if name.startswith("badge-") or name.startswith("icon-"):
+                return os.path.join(BADGES_DIR, name)
+        return os.path.join(TOKENS_DIR, name)
+
+def make_country_tokens(sender, instance, created, raw, **kwargs):
+        """ Generate all the tokens for a country.
+
+        In atlas mode, the atlases of the settings where the country plays are
+        made again instead, and the tokens are only written as loose files if
+        the country does not play in any setting yet.
+        """
+        if raw:
+            return
+        if instance.protected:
+            return
+        from condottieri_scenarios.models import Setting
+
+        names = ["%s-%s.png" % (prefix, instance.static_name) for prefix in COUNTRY_TOKENS]
+        setting_list = []
+        if atlas_enabled():
+                setting_list = list(Setting.objects.filter(
+                        scenario__contender__country=instance).distinct())
+        if setting_list:
+                for setting in setting_list:
+                        invalidate_atlas(setting)
+        else:
+                write_country_tokens(instance)
+        ## drop the old tokens from the cache, and the layers where they were pasted
+        token_cache.invalidate([token_path(name) for name in names])
+        for c in instance.contender_set.select_related('scenario'):
+                invalidate_layers(c.scenario, [contender_layer(c.pk), ])
+
+def write_country_tokens(country):
+        """ Renders the tokens of a country and writes them as loose files """
+        for name, token in render_country_tokens(country).items():
+                encode_image(token, token_path(name), "png", encoder_options("token", "png"))
+
+def make_tokens(countries, jobs=1):
+        """ Makes the tokens of several countries at once, with the same
+        result as make_country_tokens for each of them. The tokens are
+        rendered in a pool of ``jobs`` forked processes, and the atlases and
+        the layers are invalidated with a few queries for all the countries.
+        """
+        from condottieri_scenarios.models import Setting, Contender
+
+        countries = [c for c in countries if not c.protected]
+        if not countries:
+                return
+        contenders = list(Contender.objects.filter(country__in=countries).select_related('scenario'))
+        loose = countries
+        if atlas_enabled():
+                for setting in Setting.objects.filter(scenario__contender__country__in=countries).distinct():
+                        invalidate_atlas(setting)
+                playing = set(c.country_id for c in contenders)
+                loose = [c for c in countries if not c.pk in playing]
+        if jobs > 1 and len(loose) > 1:
+                ## the workers must not share the database connection of this process
+                connections.close_all()
+                context = multiprocessing.get_context('fork')
+                with concurrent.futures.ProcessPoolExecutor(max_workers=min(jobs, len(loose)),
+                        mp_context=context) as pool:
+                        for future in [pool.submit(write_country_tokens, c) for c in loose]:
+                                future.result()
+        else:
+                for c in loose:
+                        write_country_tokens(c)
+        token_cache.invalidate([token_path("%s-%s.png" % (prefix, c.static_name))
+                for c in countries for prefix in COUNTRY_TOKENS])
+        for c in contenders:
+                invalidate_layers(c.scenario, [contender_layer(c.pk), ])
@@ -0,0 +1,50 @@
+from django.core.management.base import CommandError
+from django.db import connections
+import os
+import time
+
+from condottieri_scenarios.scenario_data import dependency_order
+from condottieri_scenarios.scenario_pack import PACK_PATH, PackCompiler, \
+    PackError, write_pack
+from condottieri_scenarios.management.commands.load_scenario_data import \
+    Command as LoadCommand
+
+class Command(LoadCommand):
+    help = 'Compiles the scenario data files into a pack that load_scenario_data --pack restores'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--output', default=PACK_PATH, metavar='PATH',
+            help='Path of the pack')
+        parser.add_argument('--data', metavar='DIR',
+            help='Directory of the data files, instead of the data directory of the application')
+        parser.add_argument('--images', metavar='DIR',
+            help='Directory of the board and coat of arms images, instead of the static images')
+        parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1,
+            help='Number of processes that read the data files. With 1, they are read in this process')
+
+    def handle(self, *args, **options):
+        self.data_dir = options['data']
+        self.images_dir = options['images']
+        # The files are read in forked processes, which must not share the
+        # database connection of this process
+        connections.close_all()
+        paths = self._data_paths()
+        data = self._read_data(paths, options['jobs'])
+        start = time.time()
+        compiler = PackCompiler(self._static_dir(), log=self._log)
+        buckets = self._group(data)
+        for name in dependency_order(buckets.keys()):
+            compiler.load(name, buckets[name])
+        compiler.finish()
+        if compiler.problems:
+            # The pack has the same rows as a load of the files, without these
+            self._report_problems(compiler, data)
+        tables = compiler.tables()
+        try:
+            size = write_pack(options['output'], tables, compiler.files, self._manifest(paths, data))
+        except PackError as e:
+            raise CommandError(str(e))
+        rows = sum(len(objs) for model, objs in tables)
+        self.stdout.write(f'Compiled {rows} rows of {len(tables)} models and {len(compiler.files)} images '
+            f'in {time.time() - start:.3f}s')
+        self.stdout.write(self.style.SUCCESS(f'Wrote {size} bytes to {options["output"]}'))
@@ -0,0 +1,35 @@
+from django.core.management.base import BaseCommand, CommandError
+import fnmatch
+import os
+import time
+
+from condottieri_scenarios.scenario_export import DataExporter
+from condottieri_scenarios.management.commands.load_scenario_data import DATA_FILES
+
+class Command(BaseCommand):
+    help = 'Exports the settings, countries and scenarios to data files that load_scenario_data can load'
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', metavar='DIR',
+            help='Directory where the data files are written')
+        parser.add_argument('--clean', action='store_true',
+            help='Remove the data files already in the directory')
+
+    def handle(self, *args, **options):
+        output = options['output']
+        # Any other data file in the directory would be loaded with the export
+        old = []
+        if os.path.isdir(output):
+            old = [filename for filename in sorted(os.listdir(output))
+                if any(fnmatch.fnmatch(filename, pattern) for pattern in DATA_FILES)]
+        if old and not options['clean']:
+            raise CommandError(f'{output} already has {len(old)} data files, use --clean to remove them')
+        for filename in old:
+            os.remove(os.path.join(output, filename))
+        start = time.time()
+        exporter = DataExporter(output)
+        files = exporter.export()
+        for name, rows in exporter.rows.items():
+            self.stdout.write(f'{name}: {rows} rows')
+        self.stdout.write(self.style.SUCCESS(
+            f'Exported {sum(exporter.rows.values())} rows to {len(files)} files in {time.time() - start:.3f}s'))
@@ -0,0 +1,84 @@
+from django.core.management.base import BaseCommand
+from django.db import connections
+import concurrent.futures
+from concurrent.futures.process import BrokenProcessPool
+import multiprocessing
+import os
+import time
+
+import condottieri_scenarios.render_queue as render_queue
+
+class Command(BaseCommand):
+    help = 'Makes the scenario maps waiting in the render queue, using a pool of worker processes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=os.cpu_count() or 1,
+            help='Number of worker processes')
+        parser.add_argument('--interval', type=float, default=1.0,
+            help='Seconds to wait between checks of the queue')
+        parser.add_argument('--once', action='store_true',
+            help='Exit when the queue is empty instead of waiting for new jobs')
+
+    def handle(self, *args, **options):
+        workers = max(1, options['workers'])
+        # The workers are forked from this process, so they must not share
+        # its database connection. The queue itself does not use the database.
+        connections.close_all()
+        requeued = render_queue.requeue_stale()
+        if requeued:
+            self.stdout.write(self.style.WARNING(f'Put back {requeued} jobs left running by a stopped worker'))
+        context = multiprocessing.get_context('fork')
+        pool = concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=context)
+        running = {}
+        try:
+            while True:
+                while len(running) < workers:
+                    job = render_queue.claim()
+                    if job is None:
+                        break
+                    try:
+                        future = pool.submit(render_queue.render_job, job['scenario'], queued=True)
+                    except BrokenProcessPool:
+                        render_queue.requeue(job['scenario'])
+                        pool = self._restart(pool, running, workers, context)
+                        continue
+                    running[future] = job
+                if not running:
+                    if options['once']:
+                        break
+                    time.sleep(options['interval'])
+                    continue
+                done, not_done = concurrent.futures.wait(running.keys(),
+                    timeout=options['interval'],
+                    return_when=concurrent.futures.FIRST_COMPLETED)
+                broken = False
+                for future in done:
+                    job = running.pop(future)
+                    name = job.get('name', job['scenario'])
+                    try:
+                        elapsed, rendered = future.result()
+                    except Exception as e:
+                        broken = broken or isinstance(e, BrokenProcessPool)
+                        render_queue.finish(job, error=e)
+                        self.stdout.write(self.style.ERROR(f'Failed to make map for scenario {name}: {e}'))
+                    else:
+                        render_queue.finish(job)
+                        if rendered:
+                            self.stdout.write(self.style.SUCCESS(f'Made map for scenario {name} in {elapsed:.2f}s'))
+                        else:
+                            self.stdout.write(f'Map for scenario {name} is up to date')
+                if broken:
+                    pool = self._restart(pool, running, workers, context)
+        finally:
+            pool.shutdown()
+
+    def _restart(self, pool, running, workers, context):
+        """ Replaces a pool whose worker has died. The jobs that were in it
+        are marked as failed, since the one that killed the worker is not
+        known. """
+        self.stdout.write(self.style.ERROR('A worker process has died, starting a new pool'))
+        pool.shutdown(wait=False, cancel_futures=True)
+        for future, job in running.items():
+            render_queue.finish(job, error=BrokenProcessPool('the worker process died'))
+        running.clear()
+        return concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=context)
@@ -0,0 +1,93 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+import concurrent.futures
+import multiprocessing
+import os
+import time
+
+from condottieri_scenarios.models import Scenario
+from condottieri_scenarios.graphics import get_board_layer, invalidate_layers, \
+    atlas_enabled, get_atlas, invalidate_atlas
+from condottieri_scenarios.render_queue import render_job
+
+class Command(BaseCommand):
+    help = 'Makes the maps and thumbnails of all the scenarios, using a pool of worker processes'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--setting', action='append', default=[],
+            help='Slug of a setting whose scenarios will be rendered (can be repeated)')
+        parser.add_argument('--scenario', action='append', default=[],
+            help='Name of a scenario to render (can be repeated)')
+        parser.add_argument('--jobs', type=int, default=os.cpu_count() or 1,
+            help='Number of worker processes. With 1, the maps are made in this process')
+        parser.add_argument('--force', action='store_true',
+            help='Render every layer and map again, even if nothing has changed')
+
+    def handle(self, *args, **options):
+        scenarios = Scenario.objects.select_related('setting').order_by('setting', 'pk')
+        if options['setting']:
+            scenarios = scenarios.filter(setting__slug__in=options['setting'])
+        if options['scenario']:
+            scenarios = scenarios.filter(name__in=options['scenario'])
+        scenarios = list(scenarios)
+        if not scenarios:
+            raise CommandError('No scenarios match the given filters')
+
+        # Each board and atlas is decoded only once, here. The workers are
+        # forked afterwards, so they share the decoded images with this process.
+        settings_seen = set()
+        for s in scenarios:
+            if options['force']:
+                invalidate_layers(s)
+            if s.setting_id not in settings_seen:
+                get_board_layer(s.setting)
+                if atlas_enabled():
+                    if options['force']:
+                        invalidate_atlas(s.setting)
+                    get_atlas(s.setting)
+                settings_seen.add(s.setting_id)
+        names = dict((s.pk, s.name) for s in scenarios)
+
+        start = time.time()
+        failed = 0
+        skipped = 0
+        if options['jobs'] <= 1:
+            results = self._render_serial(names, options['force'])
+        else:
+            results = self._render_parallel(names, options['force'], options['jobs'])
+        for pk, result, error in results:
+            if error is not None:
+                failed += 1
+                self.stdout.write(self.style.ERROR(f'{names[pk]}: failed: {error}'))
+                continue
+            elapsed, rendered = result
+            if rendered:
+                self.stdout.write(f'{names[pk]}: {elapsed:.2f}s')
+            else:
+                skipped += 1
+                self.stdout.write(f'{names[pk]}: up to date')
+        total = time.time() - start
+        done = len(names) - failed - skipped
+        self.stdout.write(self.style.SUCCESS(
+            f'Made {done} maps in {total:.2f}s ({done / total if total else 0:.2f} maps/s), {skipped} up to date'))
+        if failed:
+            raise CommandError(f'{failed} maps could not be made')
+
+    def _render_serial(self, names, force):
+        for pk in names:
+            try:
+                yield pk, render_job(pk, force), None
+            except Exception as e:
+                yield pk, None, e
+
+    def _render_parallel(self, names, force, jobs):
+        # The workers must not share the database connection of this process
+        connections.close_all()
+        context = multiprocessing.get_context('fork')
+        with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, mp_context=context) as pool:
+            futures = dict((pool.submit(render_job, pk, force), pk) for pk in names)
+            for future in concurrent.futures.as_completed(futures):
+                try:
+                    yield futures[future], future.result(), None
+                except Exception as e:
+                    yield futures[future], None, e
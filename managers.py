@@ -1,5 +1,6 @@
 from django.db import models
-from django.db.models import Avg
+from django.db.models import Avg, Count, OuterRef, Q, Subquery
+from django.db.models.functions import Coalesce
 
 class CountryManager(models.Manager):
 	def scenario_stats(self, scenario):
@@ -7,6 +8,34 @@ class CountryManager(models.Manager):
 			avg_points=Avg('score__points'),
 			avg_position=Avg('score__position')).order_by('avg_position')
 
+class ScenarioQuerySet(models.QuerySet):
+	def with_stats(self):
+		""" Annotates the number of players, of games, of games being played
+		and of finished games of each scenario, read by the properties
+		number_of_players, in_use, in_play and times_played, so that a list
+		of scenarios takes one query. The players are counted in a subquery,
+		so that the contenders are not joined with the games. """
+		contenders = self.model._meta.get_field('contender').related_model
+		players = contenders.objects.filter(scenario=OuterRef('pk'),
+			country__isnull=False).order_by().values('scenario').annotate(
+			n=Count('pk')).values('n')
+		scenarios = self.select_related('setting').annotate(
+			players_count=Coalesce(Subquery(players), 0),
+			games_count=Count('game'),
+			playing_count=Count('game', filter=Q(game__finished__isnull=True)),
+			played_count=Count('game', filter=Q(game__finished__isnull=False)))
+		## the default ordering is not used in queries with GROUP BY
+		if not self.query.order_by:
+			scenarios = scenarios.order_by(*self.model._meta.ordering)
+		return scenarios
+
+class ScenarioManager(models.Manager):
+	def get_queryset(self):
+		return ScenarioQuerySet(self.model, using=self._db)
+
+	def with_stats(self):
+		return self.get_queryset().with_stats()
+
 class AreaManager(models.Manager):
 	def major(self):
 		return self.filter(garrison_income__gt=1)
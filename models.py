@@ -27,6 +27,7 @@ from django.core.validators import RegexValidator
 from django.forms import ValidationError
 from django.conf import settings
 from django.urls import reverse
+from django.utils.functional import cached_property
 
 from transmeta import TransMeta
 
@@ -35,6 +36,9 @@ logger = logging.getLogger(__name__)
 
 import condottieri_scenarios.managers as managers
 import condottieri_scenarios.graphics as graphics
+import condottieri_scenarios.adjacency as adjacency
+import condottieri_scenarios.distances as distances
+import condottieri_scenarios.snapshots as snapshots
 import machiavelli.slugify as slugify
 
 class Error(Exception):
@@ -94,8 +98,13 @@ class Setting(models.Model, metaclass=TransMeta):
 
     map_name = property(_get_map_name)
 
+    def get_distances(self):
+        """ Returns the number of moves between every pair of areas, for
+        armies and fleets. See condottieri_scenarios.distances """
+        return distances.get_distances(self.pk)
+
     def _get_in_play(self):
-        for s in self.scenario_set.all():
+        for s in self.scenario_set.with_stats():
             if s.in_play:
                 return True
         return False
@@ -136,6 +145,8 @@ class Scenario(models.Model, metaclass=TransMeta):
     countries = models.ManyToManyField('Country', through='Contender')
     published = models.DateField("publication date", null=True, blank=True)
 
+    objects = managers.ScenarioManager()
+
     class Meta:
         verbose_name = _("scenario")
         verbose_name_plural = _("scenarios")
@@ -148,6 +159,8 @@ class Scenario(models.Model, metaclass=TransMeta):
         super(Scenario, self).save(*args, **kwargs)
 
     def _get_number_of_players(self):
+        if hasattr(self, 'players_count'):
+            return self.players_count
         return self.countries.count()
 
     number_of_players = property(_get_number_of_players)
@@ -172,30 +185,101 @@ class Scenario(models.Model, metaclass=TransMeta):
 
     map_path = property(_get_map_path)
 
+    def _get_fingerprint_path(self):
+        return "%s.fingerprint" % self.map_path
+
+    fingerprint_path = property(_get_fingerprint_path)
+
+    def read_map_fingerprint(self):
+        """ Returns the fingerprint of the last rendered map, or None """
+        try:
+            with open(self.fingerprint_path, 'r') as f:
+                return f.read().strip() or None
+        except (IOError, OSError):
+            return None
+
+    @cached_property
+    def map_fingerprint(self):
+        """ The fingerprint of the map, read once for each instance, so that
+        the URLs of the map and its sizes do not read the file again """
+        return self.read_map_fingerprint()
+
+    def _versioned_url(self, url):
+        fingerprint = self.map_fingerprint
+        if fingerprint:
+            return "%s?v=%s" % (url, fingerprint[:12])
+        return url
+
     def _get_map_url(self):
-        return os.path.join(settings.MEDIA_URL, settings.SCENARIOS_ROOT,
-            self.map_name)
+        return self._versioned_url(os.path.join(settings.MEDIA_URL,
+            settings.SCENARIOS_ROOT, self.map_name))
 
     map_url = property(_get_map_url)
 
-    def _get_thumbnail_path(self):
+    def get_map_size_path(self, dirname):
+        """ Returns the path of the map reduced to one of the map sizes """
         return os.path.join(settings.MEDIA_ROOT, settings.SCENARIOS_ROOT,
-            "thumbnails", self.map_name)
+            dirname, self.map_name)
+
+    def get_map_size_url(self, dirname):
+        return self._versioned_url(os.path.join(settings.MEDIA_URL,
+            settings.SCENARIOS_ROOT, dirname, self.map_name))
+
+    def _get_thumbnail_path(self):
+        return self.get_map_size_path("thumbnails")
 
     thumbnail_path = property(_get_thumbnail_path)
 
     def _get_thumbnail_url(self):
-        return os.path.join(settings.MEDIA_URL, settings.SCENARIOS_ROOT,
-            "thumbnails", self.map_name)
+        return self.get_map_size_url("thumbnails")
     
     thumbnail_url = property(_get_thumbnail_url)
+
+    def _get_preview_url(self):
+        return self.get_map_size_url("previews")
+
+    preview_url = property(_get_preview_url)
+
+    def get_map_image_url(self, dirname=None):
+        """ Returns the URL of the view that serves the map, or one of its
+        reduced sizes, in the best format for the client """
+        kwargs = {'slug': self.name}
+        if dirname:
+            kwargs['size'] = dirname
+        return self._versioned_url(reverse('scenarios:scenario_map_image', kwargs=kwargs))
+
+    def _get_map_image_url(self):
+        return self.get_map_image_url()
+
+    map_image_url = property(_get_map_image_url)
+
+    def _get_preview_image_url(self):
+        return self.get_map_image_url("previews")
+
+    preview_image_url = property(_get_preview_image_url)
+
+    def _get_tiles_path(self):
+        return os.path.join(settings.MEDIA_ROOT, settings.SCENARIOS_ROOT,
+            "tiles", self.name)
+
+    tiles_path = property(_get_tiles_path)
+
+    def _get_layers_path(self):
+        return os.path.join(settings.MEDIA_ROOT, settings.SCENARIOS_ROOT,
+            "layers", self.name)
+
+    layers_path = property(_get_layers_path)
     
     def _get_in_use(self):
+        if hasattr(self, 'games_count'):
+            return self.games_count > 0
         return self.game_set.count() > 0
 
     in_use = property(_get_in_use)
 
     def _get_in_play(self):
+        if hasattr(self, 'playing_count'):
+            return self.playing_count > 0
         return self.game_set.filter(finished__isnull=True).count() > 0
 
     in_play = property(_get_in_play)
@@ -205,19 +289,16 @@ class Scenario(models.Model, metaclass=TransMeta):
     #
     #countries = property(_get_countries)
 
+    def _get_snapshot(self):
+        """ Returns the ScenarioSnapshot with the initial setup of the
+        scenario, that is kept in memory until the scenario changes """
+        return snapshots.get_snapshot(self.pk)
+
+    snapshot = property(_get_snapshot)
+
     def _get_setup_dict(self):
         """ Returns a dictionary with all the setup data for the scenario."""
-        _setup_dict = {}
-        for c in self.countries:
-            treasury = c.treasury_set.get(scenario=self)
-            c_dict = {
-                'name': c.name,
-                'homes': c.home_set.select_related().filter(scenario=self),
-                'setups': c.setup_set.select_related().filter(scenario=self),
-                'ducats': treasury.ducats,      
-                'double': treasury.double,}
-            _setup_dict.update({c.static_name: c_dict})
-        return _setup_dict
+        return self.snapshot.setup_dict()
 
     setup_dict = property(_get_setup_dict)
 
@@ -237,6 +318,8 @@ class Scenario(models.Model, metaclass=TransMeta):
     disabled_list = property(_get_disabled_list)
 
     def _get_times_played(self):
+        if hasattr(self, 'played_count'):
+            return self.played_count
         return self.game_set.filter(finished__isnull=False).count()
 
     times_played = property(_get_times_played)
@@ -252,6 +335,8 @@ def create_autonomous(sender, instance, created, raw, **kwargs):
         autonomous.save()
 
 models.signals.post_save.connect(create_autonomous, sender=Scenario)
+models.signals.post_save.connect(snapshots.signal_handler_invalidate_snapshot, sender=Scenario)
+models.signals.post_delete.connect(snapshots.signal_handler_invalidate_snapshot, sender=Scenario)
 
 class SpecialUnit(models.Model, metaclass=TransMeta):
     """ A SpecialUnit describes the attributes of a unit that costs more ducats
@@ -346,6 +431,7 @@ class Country(models.Model, metaclass=TransMeta):
     in_play = property(_get_in_play)
 
 models.signals.post_save.connect(graphics.signal_handler_make_country_tokens, sender=Country)
+models.signals.post_save.connect(snapshots.signal_handler_invalidate_snapshots, sender=Country)
 
 class Contender(models.Model):
     """ A Contender object defines a relationship between an Scenario and a
@@ -372,6 +458,11 @@ class Contender(models.Model):
 
     editor = property(_get_editor)
 
+models.signals.post_delete.connect(graphics.signal_handler_invalidate_contender_layer, sender=Contender)
+models.signals.post_save.connect(graphics.signal_handler_update_atlas, sender=Contender)
+models.signals.post_save.connect(snapshots.signal_handler_invalidate_snapshot, sender=Contender)
+models.signals.post_delete.connect(snapshots.signal_handler_invalidate_snapshot, sender=Contender)
+
 class Treasury(models.Model):
     """
     This class represents the initial amount of ducats that a Country starts
@@ -396,6 +487,9 @@ class Treasury(models.Model):
 
     editor = property(_get_editor)
 
+models.signals.post_save.connect(snapshots.signal_handler_invalidate_snapshot, sender=Treasury)
+models.signals.post_delete.connect(snapshots.signal_handler_invalidate_snapshot, sender=Treasury)
+
 class Area(models.Model, metaclass=TransMeta):
     """ This class describes **only** the area features in the board. The game is
     actually played in GameArea objects.
@@ -434,15 +528,20 @@ class Area(models.Model, metaclass=TransMeta):
     objects = managers.AreaManager()
 
     def is_adjacent(self, area, fleet=False):
-        """ Two areas can be adjacent through land, but not through a coast."""
-        
-        if fleet:
-            borders = Border.objects.filter(Q(from_area=self, to_area=area)|
-                                        Q(from_area=area, to_area=self))
-            for b in borders:
-                if b.only_land:
-                    return False
-        return area in self.borders.all()
+        """ Two areas can be adjacent through land, but not through a coast.
+        The borders of the setting are kept in memory, see adjacency."""
+        return adjacency.get_adjacency(self.setting_id).is_adjacent(self.pk, area.pk, fleet)
+
+    def distance(self, area, fleet=False):
+        """ Returns the number of moves that an army, or a fleet, needs to go
+        from this area to the given one, or None if it cannot get there. """
+        return distances.get_distances(self.setting_id).distance(self.pk, area.pk, fleet)
+
+    def reachable(self, moves, fleet=False):
+        """ Returns the areas that an army, or a fleet, in this area can reach
+        in at most the given number of moves. """
+        pks = distances.get_distances(self.setting_id).reachable(self.pk, moves, fleet)
+        return Area.objects.filter(pk__in=pks)
 
     def build_possible(self, type):
         """ Returns True if the given type of Unit can be built in the Area. """
@@ -492,6 +591,12 @@ class Area(models.Model, metaclass=TransMeta):
         ordering = ('setting', 'code',)
         translate = ('name', )
 
+models.signals.post_save.connect(distances.signal_handler_invalidate_distances, sender=Area)
+models.signals.post_delete.connect(distances.signal_handler_invalidate_distances, sender=Area)
+models.signals.post_save.connect(adjacency.signal_handler_invalidate_adjacency, sender=Area)
+models.signals.post_delete.connect(adjacency.signal_handler_invalidate_adjacency, sender=Area)
+models.signals.post_save.connect(snapshots.signal_handler_invalidate_snapshots, sender=Area)
+
 class Border(models.Model):
     from_area = models.ForeignKey(Area, related_name="from_borders", on_delete=models.CASCADE)
     to_area = models.ForeignKey(Area, related_name="to_borders", on_delete=models.CASCADE)
@@ -512,6 +617,10 @@ def symmetric_border(sender, instance, created, raw, **kwargs):
             only_land=instance.only_land)
 
 models.signals.post_save.connect(symmetric_border, sender=Border)
+models.signals.post_save.connect(adjacency.signal_handler_invalidate_adjacency, sender=Border)
+models.signals.post_delete.connect(adjacency.signal_handler_invalidate_adjacency, sender=Border)
+models.signals.post_save.connect(distances.signal_handler_invalidate_distances, sender=Border)
+models.signals.post_delete.connect(distances.signal_handler_invalidate_distances, sender=Border)
 
 class DisabledArea(models.Model):
     """ A DisabledArea is an Area that is not used in a given Scenario. """
@@ -558,6 +667,11 @@ class DisabledArea(models.Model):
 
     editor = property(_get_editor)
 
+models.signals.post_save.connect(graphics.signal_handler_invalidate_markers_layer, sender=DisabledArea)
+models.signals.post_delete.connect(graphics.signal_handler_invalidate_markers_layer, sender=DisabledArea)
+models.signals.post_save.connect(snapshots.signal_handler_invalidate_snapshot, sender=DisabledArea)
+models.signals.post_delete.connect(snapshots.signal_handler_invalidate_snapshot, sender=DisabledArea)
+
 class CityIncome(models.Model):
     """
     This class represents a City that generates an income in a given Scenario
@@ -587,6 +701,11 @@ class CityIncome(models.Model):
 
     editor = property(_get_editor)
 
+models.signals.post_save.connect(graphics.signal_handler_invalidate_markers_layer, sender=CityIncome)
+models.signals.post_delete.connect(graphics.signal_handler_invalidate_markers_layer, sender=CityIncome)
+models.signals.post_save.connect(snapshots.signal_handler_invalidate_snapshot, sender=CityIncome)
+models.signals.post_delete.connect(snapshots.signal_handler_invalidate_snapshot, sender=CityIncome)
+
 income_list_validator = RegexValidator(regex="^([0-9]+,\s*){5}[0-9]+$",
         message = _("List must have 6 comma separated numbers"))
 
@@ -692,7 +811,10 @@ class Home(models.Model):
 
     editor = property(_get_editor)
 
-
+models.signals.post_save.connect(graphics.signal_handler_invalidate_contender_layer, sender=Home)
+models.signals.post_delete.connect(graphics.signal_handler_invalidate_contender_layer, sender=Home)
+models.signals.post_save.connect(snapshots.signal_handler_invalidate_snapshot, sender=Home)
+models.signals.post_delete.connect(snapshots.signal_handler_invalidate_snapshot, sender=Home)
 
 UNIT_TYPES = (('A', _('Army')),
               ('F', _('Fleet')),
@@ -753,6 +875,11 @@ class Setup(models.Model):
 
     editor = property(_get_editor)
 
+models.signals.post_save.connect(graphics.signal_handler_invalidate_contender_layer, sender=Setup)
+models.signals.post_delete.connect(graphics.signal_handler_invalidate_contender_layer, sender=Setup)
+models.signals.post_save.connect(snapshots.signal_handler_invalidate_snapshot, sender=Setup)
+models.signals.post_delete.connect(snapshots.signal_handler_invalidate_snapshot, sender=Setup)
+
 class ControlToken(models.Model):
     """ Defines the coordinates of the control token for a board area. """
 
@@ -785,6 +912,13 @@ class AFToken(models.Model):
     def __str__(self):
         return "%s, %s" % (self.x, self.y)
 
+models.signals.post_save.connect(graphics.signal_handler_invalidate_area_layers, sender=ControlToken)
+models.signals.post_delete.connect(graphics.signal_handler_invalidate_area_layers, sender=ControlToken)
+models.signals.post_save.connect(graphics.signal_handler_invalidate_area_layers, sender=GToken)
+models.signals.post_delete.connect(graphics.signal_handler_invalidate_area_layers, sender=GToken)
+models.signals.post_save.connect(graphics.signal_handler_invalidate_area_layers, sender=AFToken)
+models.signals.post_delete.connect(graphics.signal_handler_invalidate_area_layers, sender=AFToken)
+
 ##
 ## Natural disasters
 ##
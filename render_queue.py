@@ -0,0 +1,243 @@
+## Copyright (c) 2010 by Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by the
+## Free Software Foundation, either version 3 of the License, or (at your option
+## any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program. If not, see <http://www.gnu.org/licenses/agpl.txt>.
+##
+## This license is also included in the file COPYING
+##
+## AUTHOR: Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+
+""" This module defines a local queue of map render jobs.
+
+The queue is kept in the filesystem, with one directory for each state of a
+job and one file for each scenario, so it needs no broker. A scenario can
+only have one pending job: asking again for a map that is still waiting in
+the queue does nothing. Jobs are run by the ``process_render_queue``
+management command.
+
+The queue is only used if ``SCENARIOS_RENDER_QUEUE`` is True, since the maps
+are not made until a worker is started. A running job whose worker has died,
+or that has been running for more than ``SCENARIOS_RENDER_TIMEOUT`` seconds,
+is put back in the queue.
+"""
+
+import json
+import os
+import os.path
+import socket
+import time
+
+from django.conf import settings
+
+QUEUE_DIR = getattr(settings, 'SCENARIOS_QUEUE_ROOT',
+        os.path.join(settings.MEDIA_ROOT, 'scenarios', 'queue'))
+
+PENDING = 'pending'
+RUNNING = 'running'
+DONE = 'done'
+FAILED = 'failed'
+
+STATES = (PENDING, RUNNING, DONE, FAILED)
+
+RENDER_TIMEOUT = getattr(settings, 'SCENARIOS_RENDER_TIMEOUT', 1800)
+
+def queue_enabled():
+        return getattr(settings, 'SCENARIOS_RENDER_QUEUE', False)
+
+def job_path(state, scenario_id):
+        return os.path.join(QUEUE_DIR, state, str(scenario_id))
+
+def read_job(path):
+        try:
+                with open(path, 'r') as f:
+                        return json.load(f)
+        except (IOError, OSError, ValueError):
+                return None
+
+def write_job(path, job):
+        tmp = "%s.tmp" % path
+        with open(tmp, 'w') as f:
+                json.dump(job, f)
+        os.replace(tmp, path)
+
+def enqueue(scenario):
+        """ Adds a render job for the scenario to the queue. Returns False if
+        there was already a pending job for it.
+        """
+        path = job_path(PENDING, scenario.pk)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+                fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_EXCL)
+        except FileExistsError:
+                return False
+        with os.fdopen(fd, 'w') as f:
+                json.dump({'scenario': scenario.pk,
+                        'name': scenario.name,
+                        'queued': time.time()}, f)
+        return True
+
+def get_status(scenario_id):
+        """ Returns the state and data of the last job of a scenario, or None
+        if the scenario has never been queued. A pending job takes precedence,
+        because it will make the map again.
+        """
+        for state in STATES:
+                job = read_job(job_path(state, scenario_id))
+                if job is not None:
+                        job['state'] = state
+                        return job
+        return None
+
+def process_alive(pid):
+        try:
+                os.kill(pid, 0)
+        except ProcessLookupError:
+                return False
+        except PermissionError:
+                pass
+        return True
+
+def is_stale(job, started):
+        """ Returns True if the worker of a running job has died, or if the
+        job has been running for too long """
+        if time.time() - started > RENDER_TIMEOUT:
+                return True
+        pid = job.get('pid')
+        ## the process can only be checked in the host where it runs
+        if pid is None or job.get('host') != socket.gethostname():
+                return False
+        return not process_alive(pid)
+
+def requeue_stale():
+        """ Puts the running jobs whose worker has died, or that have been
+        running for too long, back in the queue. Returns the number of jobs
+        put back. """
+        running_dir = os.path.join(QUEUE_DIR, RUNNING)
+        if not os.path.isdir(running_dir):
+                return 0
+        requeued = 0
+        for name in os.listdir(running_dir):
+                if not name.isdigit():
+                        continue
+                running = job_path(RUNNING, name)
+                job = read_job(running) or {}
+                try:
+                        started = job.get('started') or os.path.getmtime(running)
+                except OSError:
+                        continue
+                if not is_stale(job, started):
+                        continue
+                if requeue(name):
+                        requeued += 1
+        return requeued
+
+def requeue(scenario_id):
+        """ Puts a running job back in the queue. Returns False if another
+        worker has taken care of it. """
+        running = job_path(RUNNING, scenario_id)
+        pending = job_path(PENDING, scenario_id)
+        os.makedirs(os.path.dirname(pending), exist_ok=True)
+        try:
+                if os.path.exists(pending):
+                        ## the scenario is already waiting in the queue
+                        os.remove(running)
+                else:
+                        os.rename(running, pending)
+        except OSError:
+                return False
+        return True
+
+def claim():
+        """ Moves the oldest pending job to the running state and returns it,
+        or returns None if there is nothing to do. Jobs for a scenario whose
+        map is being made are left in the queue, unless the job that is
+        running is stale.
+        """
+        requeue_stale()
+        pending_dir = os.path.join(QUEUE_DIR, PENDING)
+        if not os.path.isdir(pending_dir):
+                return None
+        os.makedirs(os.path.join(QUEUE_DIR, RUNNING), exist_ok=True)
+        jobs = []
+        for name in os.listdir(pending_dir):
+                if not name.isdigit():
+                        continue
+                try:
+                        jobs.append((os.path.getmtime(os.path.join(pending_dir, name)), name))
+                except OSError:
+                        pass
+        for mtime, name in sorted(jobs):
+                running = job_path(RUNNING, name)
+                if os.path.exists(running):
+                        continue
+                try:
+                        os.rename(job_path(PENDING, name), running)
+                except OSError:
+                        ## another worker has taken it
+                        continue
+                job = read_job(running) or {'scenario': int(name)}
+                job['started'] = time.time()
+                ## until the worker records itself, the job is bound to this process
+                job['pid'] = os.getpid()
+                job['host'] = socket.gethostname()
+                write_job(running, job)
+                return job
+        return None
+
+def finish(job, error=None):
+        """ Moves a running job to the done or failed state """
+        scenario_id = job['scenario']
+        job['finished'] = time.time()
+        if error is None:
+                state = DONE
+                job.pop('error', None)
+        else:
+                state = FAILED
+                job['error'] = str(error)
+        for old in (DONE, FAILED):
+                try:
+                        os.remove(job_path(old, scenario_id))
+                except OSError:
+                        pass
+        path = job_path(state, scenario_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        write_job(path, job)
+        try:
+                os.remove(job_path(RUNNING, scenario_id))
+        except OSError:
+                pass
+
+def set_worker(scenario_id):
+        """ Records in the running job of a scenario the process that makes
+        it, so that the job is put back in the queue if the process dies """
+        path = job_path(RUNNING, scenario_id)
+        job = read_job(path)
+        if job is not None:
+                job['pid'] = os.getpid()
+                job['host'] = socket.gethostname()
+                write_job(path, job)
+
+def render_job(scenario_id, force=False, queued=False):
+        """ Makes the map of a scenario. This is run in a worker process.
+        If the job was taken from the queue, the worker is recorded in it.
+        Returns the number of seconds that it took and whether the map had
+        to be made again.
+        """
+        from condottieri_scenarios.models import Scenario
+        from condottieri_scenarios.graphics import make_scenario_map
+
+        if queued:
+                set_worker(scenario_id)
+        start = time.time()
+        scenario = Scenario.objects.select_related('setting').get(pk=scenario_id)
+        rendered = make_scenario_map(scenario, force=force)
+        return time.time() - start, rendered
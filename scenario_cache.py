@@ -0,0 +1,172 @@
+## Copyright (c) 2010 by Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by the
+## Free Software Foundation, either version 3 of the License, or (at your option
+## any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program. If not, see <http://www.gnu.org/licenses/agpl.txt>.
+##
+## This license is also included in the file COPYING
+##
+## AUTHOR: Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+
+""" This module keeps the snapshots of the scenarios and the settings in the
+cache of Django, ``SCENARIOS_CACHE``, so that they are shared by all the
+processes, with a small cache in the memory of each process in front of it.
+
+Every object has a version, kept in the shared cache, that is changed when
+the object is saved or deleted in any process, and the snapshots are stored
+under their version, so the old ones are never read again. Besides the
+version of each object, there is a version of all the objects of each kind,
+that is changed when the data files are loaded.
+
+The copies in memory are used without asking the shared cache for the
+version during ``SCENARIOS_CACHE_CHECK_INTERVAL`` seconds; the changes made
+in the same process are seen at once.
+"""
+
+from collections import OrderedDict
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+CACHE_ALIAS = getattr(settings, 'SCENARIOS_CACHE', 'default')
+CACHE_TIMEOUT = getattr(settings, 'SCENARIOS_CACHE_TIMEOUT', 24 * 3600)
+CACHE_SIZE = getattr(settings, 'SCENARIOS_CACHE_SIZE', 64)
+CACHE_CHECK_INTERVAL = getattr(settings, 'SCENARIOS_CACHE_CHECK_INTERVAL', 5)
+
+KEY_PREFIX = 'condottieri_scenarios'
+
+def new_version():
+        ## a lost version must not be taken again, or an old snapshot could be read
+        return time.time_ns()
+
+class VersionedCache(object):
+        """ The snapshots of one kind of object, by primary key.
+        ``build(pk, version)`` makes the snapshot of an object when it is in
+        none of the caches. """
+        def __init__(self, kind, build, size=CACHE_SIZE, alias=CACHE_ALIAS,
+                timeout=CACHE_TIMEOUT, check_interval=CACHE_CHECK_INTERVAL):
+                self.kind = kind
+                self.build = build
+                self.size = size
+                self.alias = alias
+                self.timeout = timeout
+                self.check_interval = check_interval
+                ## the copies in memory, as tuples of (version, checked, snapshot)
+                self.local = OrderedDict()
+                self.lock = threading.Lock()
+                self.local_hits = 0
+                self.hits = 0
+                self.misses = 0
+
+        def _get_backend(self):
+                return caches[self.alias]
+
+        backend = property(_get_backend)
+
+        def version_key(self, pk=None):
+                if pk is None:
+                        return "%s:%s:version" % (KEY_PREFIX, self.kind)
+                return "%s:%s:%s:version" % (KEY_PREFIX, self.kind, pk)
+
+        def snapshot_key(self, pk, version):
+                return "%s:%s:%s:%s" % (KEY_PREFIX, self.kind, pk, version)
+
+        def version(self, pk):
+                """ Returns the current version of an object, from the shared
+                cache, as a string """
+                keys = [self.version_key(), self.version_key(pk)]
+                versions = self.backend.get_many(keys)
+                for key in keys:
+                        if not key in versions:
+                                self.backend.add(key, new_version(), None)
+                                versions[key] = self.backend.get(key, new_version())
+                return "%s.%s" % tuple(versions[key] for key in keys)
+
+        def get(self, pk):
+                """ Returns the snapshot of an object, given by its primary key """
+                now = time.time()
+                with self.lock:
+                        cached = self.local.get(pk)
+                        if cached is not None and now - cached[1] < self.check_interval:
+                                self.local.move_to_end(pk)
+                                self.local_hits += 1
+                                return cached[2]
+                version = self.version(pk)
+                if cached is not None and cached[0] == version:
+                        with self.lock:
+                                self.local_hits += 1
+                        snapshot = cached[2]
+                else:
+                        key = self.snapshot_key(pk, version)
+                        snapshot = self.backend.get(key)
+                        if snapshot is None:
+                                snapshot = self.build(pk, version)
+                                self.backend.set(key, snapshot, self.timeout)
+                                with self.lock:
+                                        self.misses += 1
+                        else:
+                                with self.lock:
+                                        self.hits += 1
+                with self.lock:
+                        self.local[pk] = (version, now, snapshot)
+                        self.local.move_to_end(pk)
+                        while len(self.local) > self.size:
+                                self.local.popitem(last=False)
+                return snapshot
+
+        def invalidate(self, pk=None):
+                """ Changes the version of an object, or of all the objects if
+                pk is None. The version is changed again when the transaction
+                is committed, in case that another process built the snapshot
+                from the old rows in the meantime. """
+                self._invalidate(pk)
+                if transaction.get_connection().in_atomic_block:
+                        transaction.on_commit(lambda: self._invalidate(pk))
+
+        def _invalidate(self, pk):
+                self.backend.set(self.version_key(pk), new_version(), None)
+                with self.lock:
+                        if pk is None:
+                                self.local.clear()
+                        else:
+                                self.local.pop(pk, None)
+
+        def clear_local(self):
+                """ Empties the cache in memory """
+                with self.lock:
+                        self.local.clear()
+
+        def stats(self):
+                """ Returns the counters of the snapshots found in memory, found
+                in the shared cache and built """
+                with self.lock:
+                        return {'local_hits': self.local_hits,
+                                'hits': self.hits,
+                                'misses': self.misses,
+                                'size': len(self.local)}
+
+        def reset_stats(self):
+                with self.lock:
+                        self.local_hits = self.hits = self.misses = 0
+
+_caches = {}
+
+def register_cache(kind, build, **kwargs):
+        """ Makes the VersionedCache of a kind of object """
+        _caches[kind] = VersionedCache(kind, build, **kwargs)
+        return _caches[kind]
+
+def cache_stats():
+        """ Returns the counters of every VersionedCache, by kind """
+        return dict((kind, cache.stats()) for kind, cache in _caches.items())
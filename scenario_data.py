@@ -0,0 +1,776 @@
+## Copyright (c) 2010 by Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by the
+## Free Software Foundation, either version 3 of the License, or (at your option
+## any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program. If not, see <http://www.gnu.org/licenses/agpl.txt>.
+##
+## This license is also included in the file COPYING
+##
+## AUTHOR: Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+
+""" This module loads the scenario data files into the database.
+
+The records are given in the format of the Django serializers, as
+dictionaries with ``model``, ``pk`` and ``fields`` keys. The records of each
+model are checked against the rows already loaded, kept in memory, and
+inserted with a few bulk INSERTs, instead of one query per foreign key and
+one INSERT per row.
+"""
+
+from collections import defaultdict, OrderedDict
+import concurrent.futures
+import contextlib
+import hashlib
+import json
+import multiprocessing
+import os.path
+import time
+import xml.etree.ElementTree as ET
+
+import yaml
+try:
+        ## the libyaml bindings are several times faster than the pure Python parser
+        from yaml import CSafeLoader as SafeLoader
+except ImportError:
+        from yaml import SafeLoader
+
+from django.apps import apps
+from django.conf import settings
+from django.core.exceptions import FieldDoesNotExist, ValidationError
+from django.core.files import File
+from django.core.management.color import no_style
+from django.contrib.auth.models import User
+from django.db import connection, models
+from django.db.models import Q
+
+from condottieri_common.translation_compat import ugettext_lazy as _
+
+import condottieri_scenarios.models as scenarios
+import condottieri_scenarios.graphics as graphics
+import condottieri_scenarios.adjacency as adjacency
+import condottieri_scenarios.distances as distances
+import condottieri_scenarios.snapshots as snapshots
+from condottieri_scenarios.forms import check_area
+
+BATCH_SIZE = 500
+
+MANIFEST_PATH = getattr(settings, 'SCENARIOS_DATA_MANIFEST',
+        os.path.join(settings.MEDIA_ROOT, 'scenarios', 'data_manifest.json'))
+
+APP_LABEL = 'condottieri_scenarios'
+
+## the scenario files of the first setting do not name it
+DEFAULT_SETTING = 1
+
+## models whose rows are shared by all the settings
+SHARED_MODELS = ('country', 'religion', 'specialunit')
+
+## handlers that are muted while the data is loaded. The loader does their
+## work for all the rows at once, when it finishes.
+MUTED_SIGNALS = (
+        (models.signals.post_save, scenarios.create_configuration, scenarios.Setting),
+        (models.signals.post_save, scenarios.create_autonomous, scenarios.Scenario),
+        (models.signals.post_save, graphics.signal_handler_make_country_tokens, scenarios.Country),
+        (models.signals.post_save, scenarios.symmetric_border, scenarios.Border),
+        (models.signals.post_save, adjacency.signal_handler_invalidate_adjacency, scenarios.Border),
+        (models.signals.post_delete, adjacency.signal_handler_invalidate_adjacency, scenarios.Border),
+        (models.signals.post_save, distances.signal_handler_invalidate_distances, scenarios.Border),
+        (models.signals.post_delete, distances.signal_handler_invalidate_distances, scenarios.Border),
+        (models.signals.post_save, distances.signal_handler_invalidate_distances, scenarios.Area),
+        (models.signals.post_delete, distances.signal_handler_invalidate_distances, scenarios.Area),
+        (models.signals.post_save, adjacency.signal_handler_invalidate_adjacency, scenarios.Area),
+        (models.signals.post_delete, adjacency.signal_handler_invalidate_adjacency, scenarios.Area),
+        (models.signals.post_delete, graphics.signal_handler_invalidate_contender_layer, scenarios.Contender),
+        (models.signals.post_delete, graphics.signal_handler_invalidate_contender_layer, scenarios.Home),
+        (models.signals.post_delete, graphics.signal_handler_invalidate_markers_layer, scenarios.DisabledArea),
+        (models.signals.post_delete, graphics.signal_handler_invalidate_markers_layer, scenarios.CityIncome),
+        (models.signals.post_save, snapshots.signal_handler_invalidate_snapshot, scenarios.Scenario),
+        (models.signals.post_delete, snapshots.signal_handler_invalidate_snapshot, scenarios.Scenario),
+        (models.signals.post_save, snapshots.signal_handler_invalidate_snapshots, scenarios.Country),
+        (models.signals.post_save, snapshots.signal_handler_invalidate_snapshot, scenarios.Contender),
+        (models.signals.post_delete, snapshots.signal_handler_invalidate_snapshot, scenarios.Contender),
+        (models.signals.post_save, snapshots.signal_handler_invalidate_snapshot, scenarios.Treasury),
+        (models.signals.post_delete, snapshots.signal_handler_invalidate_snapshot, scenarios.Treasury),
+        (models.signals.post_save, snapshots.signal_handler_invalidate_snapshots, scenarios.Area),
+        (models.signals.post_save, snapshots.signal_handler_invalidate_snapshot, scenarios.DisabledArea),
+        (models.signals.post_delete, snapshots.signal_handler_invalidate_snapshot, scenarios.DisabledArea),
+        (models.signals.post_save, snapshots.signal_handler_invalidate_snapshot, scenarios.CityIncome),
+        (models.signals.post_delete, snapshots.signal_handler_invalidate_snapshot, scenarios.CityIncome),
+        (models.signals.post_save, snapshots.signal_handler_invalidate_snapshot, scenarios.Home),
+        (models.signals.post_delete, snapshots.signal_handler_invalidate_snapshot, scenarios.Home),
+        (models.signals.post_save, snapshots.signal_handler_invalidate_snapshot, scenarios.Setup),
+        (models.signals.post_delete, snapshots.signal_handler_invalidate_snapshot, scenarios.Setup),
+)
+
+@contextlib.contextmanager
+def muted_signals():
+        """ Disconnects the handlers in ``MUTED_SIGNALS`` while the block runs.
+        Without receivers, the deletions also take the fast path that does
+        not fetch the rows. """
+        for signal, handler, sender in MUTED_SIGNALS:
+                signal.disconnect(handler, sender=sender)
+        try:
+                yield
+        finally:
+                for signal, handler, sender in MUTED_SIGNALS:
+                        signal.connect(handler, sender=sender)
+
+class MissingReference(Exception):
+        pass
+
+def get_model(name):
+        """ Returns the model class for a model name as used in the data
+        files, with or without the application label """
+        return apps.get_model(APP_LABEL, name.split('.')[-1])
+
+def model_name(record):
+        return record['model'].split('.')[-1]
+
+def read_yaml(path):
+        with open(path, 'r') as f:
+                return yaml.load(f, Loader=SafeLoader) or []
+
+def xml_record(item):
+        """ Returns the record of an ``object`` element of the XML format of the
+        Django serializers """
+        fields = {}
+        for field in item.iterfind('field'):
+                if field.find('None') is not None:
+                        fields[field.get('name')] = None
+                elif field.get('rel') == 'ManyToManyRel':
+                        fields[field.get('name')] = [o.get('pk') for o in field.iterfind('object')]
+                else:
+                        fields[field.get('name')] = field.text or ''
+        return {'model': item.get('model'), 'pk': item.get('pk'), 'fields': fields}
+
+def iter_xml(path):
+        """ Yields the records of a file in the XML format of the Django
+        serializers. The file is parsed as a stream and every object is
+        dropped from the tree once it is read, so the memory used does not
+        grow with the size of the file. """
+        depth = 0
+        root = None
+        for event, elem in ET.iterparse(path, events=('start', 'end')):
+                if event == 'start':
+                        if root is None:
+                                root = elem
+                        depth += 1
+                        continue
+                depth -= 1
+                ## the objects in many to many fields are two levels deeper
+                if depth == 1 and elem.tag == 'object':
+                        yield xml_record(elem)
+                        root.clear()
+
+def read_xml(path):
+        return list(iter_xml(path))
+
+def read_records(path):
+        """ Returns the records in a data file, in the format of the Django
+        serializers """
+        if path.endswith('.xml'):
+                return read_xml(path)
+        return read_yaml(path)
+
+def read_files(paths, jobs=1):
+        """ Reads the data files, in a pool of ``jobs`` processes if there are
+        more than one, and yields each path with the result of reading it:
+        either its records or the exception raised. The files are given
+        back in the same order. """
+        if jobs <= 1 or len(paths) <= 1:
+                for path in paths:
+                        try:
+                                yield path, read_records(path)
+                        except Exception as e:
+                                yield path, e
+                return
+        context = multiprocessing.get_context('fork')
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(jobs, len(paths)),
+                mp_context=context) as pool:
+                ## the largest files are sent first, so that they do not
+                ## end up alone in one process at the end
+                futures = dict((path, pool.submit(read_records, path))
+                        for path in sorted(paths, key=os.path.getsize, reverse=True))
+                for path in paths:
+                        future = futures[path]
+                        try:
+                                yield path, future.result()
+                        except Exception as e:
+                                yield path, e
+
+def record_key(record):
+        return "%s.%s" % (model_name(record), record['pk'])
+
+def record_hash(record):
+        return hashlib.sha1(json.dumps(record, sort_keys=True, default=str).encode('utf-8')).hexdigest()
+
+def file_manifest(file_hash, records):
+        """ Returns the manifest entry of a data file: the hash of its
+        contents and the hash of each of its records """
+        return {'sha1': file_hash,
+                'records': dict((record_key(r), record_hash(r)) for r in records)}
+
+def read_manifest(path=MANIFEST_PATH):
+        """ Returns the manifest of the last load, mapping the name of each
+        data file to its entry, or an empty dictionary """
+        try:
+                with open(path, 'r') as f:
+                        return json.load(f)
+        except (IOError, OSError, ValueError):
+                return {}
+
+def write_manifest(manifest, path=MANIFEST_PATH):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = "%s.tmp" % path
+        with open(tmp, 'w') as f:
+                json.dump(manifest, f, sort_keys=True)
+        os.replace(tmp, path)
+
+def diff_manifest(manifest, entries, records):
+        """ Compares the entries of the changed data files with the manifest of
+        the last load. ``records`` maps the name of each changed file to its
+        records, and files of the manifest missing from ``entries`` have been
+        removed. Returns the records that are new or have changed, grouped by
+        model, and the keys of the records that are gone, also grouped by
+        model. """
+        upserts = OrderedDict()
+        gone = set()
+        for filename, entry in manifest.items():
+                if not filename in entries:
+                        gone.update(entry['records'])
+        for filename, file_records in records.items():
+                old = manifest.get(filename, {}).get('records', {})
+                new = entries[filename]['records']
+                gone.update(key for key in old if not key in new)
+                for record in file_records:
+                        key = record_key(record)
+                        if old.get(key) != new[key]:
+                                upserts.setdefault(model_name(record), []).append(record)
+        ## a record that has moved to another file is not deleted
+        for file_records in upserts.values():
+                gone.difference_update(record_key(r) for r in file_records)
+        deletes = defaultdict(list)
+        for key in gone:
+                name, pk = key.split('.', 1)
+                deletes[name].append(pk)
+        return upserts, deletes
+
+def unique_sets(model):
+        """ Returns the tuples of attribute names that must be unique in a model """
+        sets = [(f.attname, ) for f in model._meta.concrete_fields
+                if f.unique and not f.primary_key]
+        for together in model._meta.unique_together:
+                sets.append(tuple(model._meta.get_field(name).attname for name in together))
+        return sets
+
+def dependency_order(names):
+        """ Sorts model names so that every model comes after the models that
+        its foreign keys point to. Models that do not depend on each other
+        keep the given order. """
+        pending = list(names)
+        order = []
+        while pending:
+                for name in pending:
+                        model = get_model(name)
+                        related = set(f.related_model._meta.model_name
+                                for f in model._meta.concrete_fields if f.is_relation)
+                        related.discard(model._meta.model_name)
+                        if not related.intersection(pending):
+                                break
+                else:
+                        raise ValueError("Circular references between %s" % ", ".join(pending))
+                pending.remove(name)
+                order.append(name)
+        return order
+
+def select_records(buckets, settings=(), scenarios=()):
+        """ Returns the records, grouped by model, that belong to the settings
+        with the given slugs or to the scenarios with the given names: the
+        settings and scenarios themselves and every record that refers to
+        them, directly or through other selected records. The rows of
+        ``SHARED_MODELS`` are never selected. """
+        selected = defaultdict(set)
+        result = OrderedDict()
+        for name in dependency_order(buckets.keys()):
+                model = get_model(name)
+                relations = [(f.name, f.related_model._meta.model_name)
+                        for f in model._meta.concrete_fields if f.is_relation]
+                records = []
+                for record in buckets[name]:
+                        fields = record['fields']
+                        if name == 'setting':
+                                chosen = fields.get('slug') in settings
+                        elif name == 'scenario':
+                                chosen = fields.get('name') in scenarios or \
+                                        str(fields.get('setting', DEFAULT_SETTING)) in selected['setting']
+                        else:
+                                chosen = any(str(fields.get(field)) in selected[target]
+                                        for field, target in relations)
+                        if chosen and not name in SHARED_MODELS:
+                                selected[name].add(str(record['pk']))
+                                records.append(record)
+                if records:
+                        result[name] = records
+        ## the trade routes are only referred to by their steps
+        routes = set(str(r['fields'].get('route')) for r in result.get('routestep', []))
+        records = [r for r in buckets.get('traderoute', []) if str(r['pk']) in routes]
+        if records:
+                result['traderoute'] = records
+        return result
+
+class ScenarioRules(object):
+        """ In-memory version of the checks made by ``Home.save``,
+        ``Setup.save``, ``DisabledArea.save`` and ``CityIncome.save``.
+
+        The rows must be added with ``add`` after they are accepted, so that
+        the next checks take them into account.
+        """
+        def __init__(self):
+                self.areas = {}
+                self.contenders = {}
+                self.disabled = set()
+                self.homes = set()
+                self.units = set()
+                self.occupied = set()
+                self.cities = set()
+
+        def preload(self, replaced):
+                """ Adds the rows already in the database, except those whose
+                primary keys are in ``replaced``, a dictionary keyed by model
+                name """
+                def rows(name):
+                        return get_model(name).objects.exclude(pk__in=replaced.get(name, ()))
+                for area in rows('area'):
+                        self.areas[area.pk] = area
+                for pk, scenario, country in rows('contender').values_list('pk', 'scenario', 'country'):
+                        self.contenders[pk] = (scenario, country)
+                self.disabled.update(rows('disabledarea').values_list('scenario', 'area'))
+                self.cities.update(rows('cityincome').values_list('scenario', 'city'))
+                self.homes.update(rows('home').values_list('contender__scenario', 'area'))
+                for scenario, area, unit_type in rows('setup').values_list('contender__scenario', 'area', 'unit_type'):
+                        self.units.add((scenario, area, unit_type))
+                        self.occupied.add((scenario, area))
+
+        def check(self, name, obj):
+                check = getattr(self, "check_%s" % name, None)
+                if check is not None:
+                        check(obj)
+
+        def add(self, name, obj):
+                if name == 'area':
+                        self.areas[obj.pk] = obj
+                elif name == 'contender':
+                        self.contenders[obj.pk] = (obj.scenario_id, obj.country_id)
+                elif name == 'disabledarea':
+                        self.disabled.add((obj.scenario_id, obj.area_id))
+                elif name == 'cityincome':
+                        self.cities.add((obj.scenario_id, obj.city_id))
+                elif name == 'home':
+                        self.homes.add((self.contenders[obj.contender_id][0], obj.area_id))
+                elif name == 'setup':
+                        scenario = self.contenders[obj.contender_id][0]
+                        self.units.add((scenario, obj.area_id, obj.unit_type))
+                        self.occupied.add((scenario, obj.area_id))
+
+        def check_home(self, home):
+                scenario, country = self.contenders[home.contender_id]
+                if country is None:
+                        raise scenarios.HomeIsAutonomous(_("You cannot define an autonomous home"))
+                if self.areas[home.area_id].is_sea:
+                        raise scenarios.AreaNotAllowed(_("A sea area cannot be controlled"))
+                if (scenario, home.area_id) in self.disabled:
+                        raise scenarios.AreaNotAllowed(_("This area is disabled"))
+                if (scenario, home.area_id) in self.homes:
+                        raise scenarios.HomeIsTaken(_("This area is already controlled by another country"))
+
+        def check_setup(self, setup):
+                scenario = self.contenders[setup.contender_id][0]
+                if not setup.unit_type in ('A', 'F', 'G') or \
+                        not self.areas[setup.area_id].accepts_type(setup.unit_type):
+                        raise scenarios.WrongUnitType(_("This unit type is not allowed in this area"))
+                if (scenario, setup.area_id) in self.disabled:
+                        raise scenarios.AreaNotAllowed(_("This area is disabled"))
+                if (scenario, setup.area_id, setup.unit_type) in self.units:
+                        raise scenarios.AreaIsOccupied(_("You cannot place two units of the same type on the same area"))
+
+        def check_disabledarea(self, disabled):
+                key = (disabled.scenario_id, disabled.area_id)
+                if key in self.homes:
+                        raise scenarios.AreaNotAllowed(_("Selected area is controlled by a country"))
+                if key in self.occupied:
+                        raise scenarios.AreaNotAllowed(_("Selected area is occupied by one or more units"))
+                if key in self.cities:
+                        raise scenarios.AreaNotAllowed(_("Selected area has special income"))
+
+        def check_cityincome(self, income):
+                if (income.scenario_id, income.city_id) in self.disabled:
+                        raise scenarios.AreaNotAllowed(_("This area is disabled"))
+
+class BulkLoader(object):
+        """ Loads records into the database, model by model.
+
+        The primary keys of the loaded rows are kept in memory, mapped from
+        the keys used in the data files, and the foreign keys of the records
+        are resolved against these maps. ``log`` is called with a level
+        ('success', 'warning' or 'error') and a message for every problem.
+        """
+        def __init__(self, editor, static_dir, log=None, batch_size=BATCH_SIZE):
+                self.editor = editor
+                self.static_dir = static_dir
+                self.log = log or (lambda level, message: None)
+                self.batch_size = batch_size
+                self.pks = defaultdict(dict)
+                self.unique = defaultdict(set)
+                self.rules = ScenarioRules()
+                self.timings = OrderedDict()
+                self.loaded_models = set()
+                self.autonomous = {}
+                self.configurations = {}
+                ## countries whose tokens must be made again
+                self.countries = []
+                ## rows that are updated instead of inserted
+                self.existing = defaultdict(set)
+                self.deleted = OrderedDict()
+                ## rows whose changes need some work when the load finishes
+                self.touched = defaultdict(set)
+
+        def resolve(self, name, pk):
+                """ Returns the primary key in the database of a row given by
+                its key in the data files, or None if it was not loaded """
+                return self.pks[name].get(pk)
+
+        def preload(self, replaced):
+                """ Takes into account the rows already in the database, for a
+                load that only changes some of them. ``replaced`` maps model
+                names to the primary keys of the rows that are going to be
+                loaded again or deleted: they are left out, and those that are
+                loaded again are updated instead of inserted. """
+                replaced = dict((name, set(get_model(name)._meta.pk.to_python(pk) for pk in pks))
+                        for name, pks in replaced.items())
+                for model in apps.get_app_config(APP_LABEL).get_models():
+                        name = model._meta.model_name
+                        if name == 'configuration':
+                                ## mapped by setting, see prepare_configuration
+                                continue
+                        pks = replaced.get(name, set())
+                        sets = unique_sets(model)
+                        attnames = [model._meta.pk.attname] + sorted(set(a for u in sets for a in u))
+                        for row in model.objects.exclude(pk__in=pks).values_list(*attnames):
+                                self.pks[name][row[0]] = row[0]
+                                values = dict(zip(attnames, row))
+                                for fields in sets:
+                                        key = tuple(values[f] for f in fields)
+                                        if not None in key:
+                                                self.unique[name].add((fields, key))
+                        if pks:
+                                self.existing[name] = set(model.objects.filter(pk__in=pks).values_list('pk', flat=True))
+                self.rules.preload(replaced)
+                self.configurations.update(scenarios.Configuration.objects.values_list('setting', 'pk'))
+                for pk, scenario in scenarios.Contender.objects.filter(country__isnull=True).exclude(
+                        pk__in=replaced.get('contender', ())).values_list('pk', 'scenario'):
+                        self.autonomous[scenario] = pk
+
+        def delete(self, name, pks):
+                """ Deletes the rows of a model with the given keys. Returns the
+                number of rows deleted. """
+                model = get_model(name)
+                queryset = model.objects.filter(pk__in=[model._meta.pk.to_python(pk) for pk in pks])
+                count = 0
+                for obj in queryset:
+                        self.touch(name, obj)
+                        count += 1
+                self.count_deleted(queryset.delete()[1])
+                return count
+
+        def count_deleted(self, rows):
+                """ Adds to ``deleted`` the rows of each model, as given by
+                QuerySet.delete, with those deleted in cascade """
+                for label, count in rows.items():
+                        if count:
+                                name = label.split('.')[-1].lower()
+                                self.deleted[name] = self.deleted.get(name, 0) + count
+
+        def touch(self, name, obj):
+                """ Remembers the scenarios, contenders, settings and areas that
+                a loaded or deleted row belongs to, when it is drawn on the maps """
+                if name in ('scenario', 'setting'):
+                        self.touched[name].add(obj.pk)
+                elif name == 'area':
+                        self.touched['setting'].add(obj.setting_id)
+                elif name in ('contender', 'disabledarea', 'cityincome'):
+                        self.touched['scenario'].add(obj.scenario_id)
+                elif name in ('home', 'setup'):
+                        self.touched['contender'].add(obj.contender_id)
+                elif name in ('aftoken', 'controltoken', 'gtoken'):
+                        self.touched['area'].add(obj.area_id)
+                elif name == 'border':
+                        self.touched['border'].update((obj.from_area_id, obj.to_area_id))
+
+        def touched_scenarios(self):
+                """ Returns the scenarios whose maps may have changed """
+                touched = self.touched
+                setting_ids = touched['setting'].union(scenarios.Area.objects.filter(
+                        pk__in=touched['area']).values_list('setting', flat=True))
+                return scenarios.Scenario.objects.filter(Q(pk__in=touched['scenario']) |
+                        Q(contender__in=touched['contender']) |
+                        Q(setting__in=setting_ids)).distinct()
+
+        def load(self, name, records):
+                """ Loads the records of a model. Returns the number of rows
+                inserted. """
+                if not records:
+                        return 0
+                start = time.time()
+                model = get_model(name)
+                objs = []
+                updates = []
+                m2m = []
+                for record in records:
+                        pk = model._meta.pk.to_python(record['pk'])
+                        try:
+                                obj, related = self.make_instance(name, model, pk, record['fields'])
+                                self.check_unique(name, model, obj)
+                                self.rules.check(name, obj)
+                                prepare = getattr(self, "prepare_%s" % name, None)
+                                if prepare is not None and prepare(obj, record['fields']) is False:
+                                        continue
+                        except MissingReference as e:
+                                self.reject('warning', name, pk, e)
+                                continue
+                        except (scenarios.Error, ValidationError) as e:
+                                self.reject('error', name, pk, e)
+                                continue
+                        self.add_unique(name, model, obj)
+                        if obj.pk in self.existing[name]:
+                                updates.append(obj)
+                        else:
+                                objs.append(obj)
+                        self.touch(name, obj)
+                        if name == 'country':
+                                self.countries.append(obj)
+                        self.pks[name][pk] = obj.pk
+                        self.rules.add(name, obj)
+                        m2m.append((obj, related))
+                self.save_rows(model, objs, updates, m2m)
+                count = len(m2m)
+                self.loaded_models.add(model)
+                elapsed, total = self.timings.get(name, (0.0, 0))
+                self.timings[name] = (elapsed + time.time() - start, total + count)
+                return count
+
+        def reject(self, level, name, pk, error):
+                """ Called for every record that cannot be loaded """
+                if isinstance(error, ValidationError):
+                        error = "; ".join(error.messages)
+                self.log(level, "%s %s: %s" % (name, pk, error))
+
+        def save_rows(self, model, objs, updates, m2m):
+                """ Writes the accepted rows of a model: inserts ``objs``,
+                updates ``updates`` and sets the many to many relations in
+                ``m2m``, a list of (object, {field: keys}) """
+                model.objects.bulk_create(objs, batch_size=self.batch_size)
+                ## the files are only updated if the data gives them
+                fields = [f.name for f in model._meta.concrete_fields if not f.primary_key and
+                        (not isinstance(f, models.FileField) or all(getattr(o, f.attname) for o in updates))]
+                if updates and fields:
+                        model.objects.bulk_update(updates, fields, batch_size=self.batch_size)
+                for obj, related in m2m:
+                        for field, values in related.items():
+                                getattr(obj, field).set(values)
+
+        def make_instance(self, name, model, pk, fields):
+                """ Returns an unsaved instance of the model for the fields of a
+                record, and a dictionary with the keys of its many to many
+                relations """
+                kwargs = {'pk': pk}
+                related = {}
+                for field in model._meta.concrete_fields:
+                        if field.is_relation and field.related_model is User:
+                                kwargs[field.attname] = getattr(self.editor, 'pk', None)
+                for key, value in fields.items():
+                        try:
+                                field = model._meta.get_field(key)
+                        except FieldDoesNotExist:
+                                continue
+                        if field.is_relation and field.related_model is User:
+                                continue
+                        if field.many_to_many:
+                                target = field.related_model._meta.model_name
+                                related[key] = [self.resolve(target, pk) for pk in value or []
+                                        if self.resolve(target, pk) is not None]
+                        elif field.is_relation:
+                                if value is None:
+                                        kwargs[field.attname] = None
+                                        continue
+                                target = field.related_model._meta.model_name
+                                pk = self.resolve(target, field.target_field.to_python(value))
+                                if pk is None:
+                                        raise MissingReference("%s %s not found" % (target, value))
+                                kwargs[field.attname] = pk
+                        elif isinstance(field, models.FileField):
+                                continue
+                        elif value is None and not field.null and field.empty_strings_allowed:
+                                ## untranslated texts are exported as null
+                                kwargs[field.attname] = ''
+                        else:
+                                kwargs[field.attname] = field.to_python(value)
+                return model(**kwargs), related
+
+        def check_unique(self, name, model, obj):
+                if obj.pk in self.pks[name]:
+                        raise scenarios.Error("%s %s already exists" % (name, obj.pk))
+                for fields in unique_sets(model):
+                        values = tuple(getattr(obj, f) for f in fields)
+                        if None in values:
+                                continue
+                        if (fields, values) in self.unique[name]:
+                                raise scenarios.Error("%s with %s %s already exists" %
+                                        (name, ", ".join(fields), ", ".join(map(str, values))))
+
+        def add_unique(self, name, model, obj):
+                for fields in unique_sets(model):
+                        values = tuple(getattr(obj, f) for f in fields)
+                        if not None in values:
+                                self.unique[name].add((fields, values))
+
+        def symmetric_borders(self):
+                """ Adds the opposite of every border of the loaded areas that
+                does not have one, as ``symmetric_border`` does when a border
+                is saved. Returns the number of borders added. """
+                areas = self.touched['border']
+                if not areas:
+                        return 0
+                borders = list(scenarios.Border.objects.filter(Q(from_area__in=areas) |
+                        Q(to_area__in=areas)).values_list('from_area', 'to_area', 'only_land'))
+                pairs = set((from_area, to_area) for from_area, to_area, only_land in borders)
+                reverse = [scenarios.Border(from_area_id=to_area, to_area_id=from_area, only_land=only_land)
+                        for from_area, to_area, only_land in borders if not (to_area, from_area) in pairs]
+                scenarios.Border.objects.bulk_create(reverse, batch_size=self.batch_size)
+                return len(reverse)
+
+        def attach(self, obj, field, path, name):
+                """ Saves the file at ``path`` in a file field of an unsaved row """
+                with open(path, 'rb') as f:
+                        getattr(obj, field).save(name, File(f), save=False)
+
+        def prepare_setting(self, setting, fields):
+                if not 'enabled' in fields:
+                        setting.enabled = True
+                if 'board' in fields:
+                        board_path = os.path.join(self.static_dir, fields['board'])
+                        if os.path.exists(board_path):
+                                self.attach(setting, 'board', board_path, "board-%s.png" % setting.slug)
+                        else:
+                                self.log('warning', "Board image not found at %s for setting %s" %
+                                        (board_path, setting.slug))
+
+        def prepare_country(self, country, fields):
+                if not 'enabled' in fields:
+                        country.enabled = True
+                coat_path = os.path.join(self.static_dir, "badge-%s.png" % country.static_name)
+                if not os.path.exists(coat_path):
+                        self.log('warning', "Coat of arms not found for %s, using default" % country.static_name)
+                        coat_path = os.path.join(self.static_dir, "badge-austria.png")
+                if os.path.exists(coat_path):
+                        self.attach(country, 'coat_of_arms', coat_path, "badge-%s.png" % country.static_name)
+                else:
+                        self.log('error', "Default coat of arms not found at %s" % coat_path)
+                        return False
+
+        def prepare_scenario(self, scenario, fields):
+                if scenario.setting_id is None:
+                        scenario.setting_id = self.resolve('setting', DEFAULT_SETTING)
+                if not 'enabled' in fields:
+                        scenario.enabled = True
+
+        def prepare_contender(self, contender, fields):
+                if contender.country_id is None:
+                        if contender.scenario_id in self.autonomous:
+                                self.reject('warning', 'contender', contender.pk,
+                                        "Skipping duplicate autonomous contender")
+                                return False
+                        self.autonomous[contender.scenario_id] = contender.pk
+
+        def prepare_configuration(self, config, fields):
+                ## a setting has only one configuration, whatever its key
+                pk = self.configurations.get(config.setting_id)
+                if pk is not None:
+                        config.pk = pk
+                        self.existing['configuration'].add(pk)
+                self.configurations[config.setting_id] = config.pk
+
+        def prepare_countryrandomincome(self, income, fields):
+                income.income_list = "".join(income.income_list.split())
+
+        prepare_cityrandomincome = prepare_countryrandomincome
+
+        def finish(self):
+                """ Does the work of the signal handlers muted while the data was
+                loaded, for all the rows at once, except the tokens of the
+                countries, that are made with ``graphics.make_tokens`` after the
+                transaction. Before that, resets the sequences of the primary
+                keys, that are not updated when rows are inserted with explicit
+                keys. """
+                sql = connection.ops.sequence_reset_sql(no_style(), list(self.loaded_models))
+                if sql:
+                        with connection.cursor() as cursor:
+                                for statement in sql:
+                                        cursor.execute(statement)
+                self.symmetric_borders()
+                if self.touched['border'] or self.touched['setting']:
+                        adjacency.invalidate_adjacency()
+                        distances.invalidate_distances()
+                scenarios.Configuration.objects.bulk_create([scenarios.Configuration(setting_id=pk)
+                        for pk in self.pks['setting'].values() if not pk in self.configurations],
+                        batch_size=self.batch_size)
+                scenarios.Contender.objects.bulk_create([scenarios.Contender(scenario_id=pk)
+                        for pk in self.pks['scenario'].values() if not pk in self.autonomous],
+                        batch_size=self.batch_size)
+                for scenario in self.touched_scenarios():
+                        graphics.invalidate_layers(scenario)
+                snapshots.invalidate_snapshot()
+
+class DataChecker(BulkLoader):
+        """ Checks the records as BulkLoader would load them, without
+        touching the database or the files. Besides the checks made by the
+        loader, the areas that do not follow the rules of ``AreaForm`` are
+        reported as warnings, since the shipped data has some of them. Every
+        rejected record is kept in ``problems`` as a tuple of (level, model
+        name, key, message). """
+        def __init__(self, static_dir=None, batch_size=BATCH_SIZE):
+                super(DataChecker, self).__init__(None, static_dir, batch_size=batch_size)
+                self.problems = []
+
+        def reject(self, level, name, pk, error):
+                if isinstance(error, ValidationError):
+                        error = "; ".join(error.messages)
+                self.problems.append((level, name, pk, str(error)))
+
+        def save_rows(self, model, objs, updates, m2m):
+                pass
+
+        def prepare_setting(self, setting, fields):
+                pass
+
+        def prepare_country(self, country, fields):
+                pass
+
+        def prepare_area(self, area, fields):
+                ## the loader takes these areas, so they are reported but kept
+                try:
+                        check_area(dict((f, getattr(area, f)) for f in ('is_sea', 'is_coast',
+                                'has_city', 'is_fortified', 'has_port', 'control_income',
+                                'garrison_income', 'mixed')))
+                except ValidationError as e:
+                        self.reject('warning', 'area', area.pk, e)
+
+        def finish(self):
+                pass
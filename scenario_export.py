@@ -0,0 +1,210 @@
+## Copyright (c) 2010 by Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by the
+## Free Software Foundation, either version 3 of the License, or (at your option
+## any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program. If not, see <http://www.gnu.org/licenses/agpl.txt>.
+##
+## This license is also included in the file COPYING
+##
+## AUTHOR: Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+
+""" This module exports the scenario data from the database to YAML files,
+in the layout and format read by ``scenario_data``.
+
+The rows shared by all the settings go to one file, and each setting and
+each scenario get their own file, with every row that belongs to them. The
+rows are read in chunks of ``values_list`` queries, ordered by primary key,
+and each chunk is written before the next one is read, so the memory used
+does not grow with the size of the settings. Since the loader keeps the
+primary keys, exporting the data loaded from an export gives the same files.
+
+The board and coat of arms images are copied to an ``img`` directory,
+under the names that the loader looks for.
+"""
+
+from collections import OrderedDict
+import itertools
+import os
+import os.path
+
+import yaml
+try:
+        from yaml import CSafeDumper as SafeDumper
+except ImportError:
+        from yaml import SafeDumper
+
+from django.contrib.auth.models import User
+
+import condottieri_scenarios.models as scenarios
+from condottieri_scenarios.scenario_data import APP_LABEL, BATCH_SIZE, get_model
+
+SHARED_FILE = '00_shared.yaml'
+SETTING_FILE = '10_setting_%s.yaml'
+SCENARIO_FILE = '20_scenario_%s.yaml'
+
+IMAGES_DIR = 'img'
+
+## the rows shared by all the settings, and the trade routes without steps
+SHARED_MODELS = (
+        ('religion', {}),
+        ('specialunit', {}),
+        ('country', {}),
+        ('traderoute', {'routestep__isnull': True}),
+)
+
+## the models in the file of a setting, with the lookup of the setting
+SETTING_MODELS = (
+        ('setting', 'pk'),
+        ('configuration', 'setting'),
+        ('area', 'setting'),
+        ('border', 'from_area__setting'),
+        ('controltoken', 'area__setting'),
+        ('gtoken', 'area__setting'),
+        ('aftoken', 'area__setting'),
+        ('faminecell', 'area__setting'),
+        ('plaguecell', 'area__setting'),
+        ('stormcell', 'area__setting'),
+        ('countryrandomincome', 'setting'),
+        ('cityrandomincome', 'city__setting'),
+        ('traderoute', 'routestep__area__setting'),
+        ('routestep', 'area__setting'),
+)
+
+## the models in the file of a scenario, with the lookup of the scenario
+SCENARIO_MODELS = (
+        ('scenario', 'pk'),
+        ('contender', 'scenario'),
+        ('treasury', 'contender__scenario'),
+        ('home', 'contender__scenario'),
+        ('setup', 'contender__scenario'),
+        ('disabledarea', 'scenario'),
+        ('cityincome', 'scenario'),
+)
+
+def export_fields(model):
+        """ Returns the concrete fields of a model that are written in the
+        files: all but the primary key and the references to users, which
+        the loader gives to the editor that loads them """
+        return [f for f in model._meta.concrete_fields if not f.primary_key and
+                not (f.is_relation and f.related_model is User)]
+
+def related_fields(model):
+        """ Returns the many to many fields of a model that are written in the
+        files """
+        return [f for f in model._meta.many_to_many if f.remote_field.through._meta.auto_created and
+                not f.related_model is User]
+
+class DataExporter(object):
+        """ Writes the rows of the database to data files in ``output_dir``.
+        The images are copied to ``output_dir/img``. ``rows`` counts the rows
+        written of each model. """
+        def __init__(self, output_dir, batch_size=BATCH_SIZE):
+                self.output_dir = output_dir
+                self.images_dir = os.path.join(output_dir, IMAGES_DIR)
+                self.batch_size = batch_size
+                self.rows = OrderedDict()
+                self.files = []
+
+        def records(self, queryset):
+                """ Yields the records of the rows of a queryset, in lists of at
+                most ``batch_size`` records """
+                model = queryset.model
+                name = model._meta.model_name
+                fields = export_fields(model)
+                related = related_fields(model)
+                rows = queryset.order_by('pk').values_list('pk',
+                        *[f.attname for f in fields]).iterator(chunk_size=self.batch_size)
+                while True:
+                        chunk = list(itertools.islice(rows, self.batch_size))
+                        if not chunk:
+                                break
+                        m2m = self.related(related, [row[0] for row in chunk])
+                        records = []
+                        for row in chunk:
+                                values = dict((f.name, value) for f, value in zip(fields, row[1:]))
+                                for field in related:
+                                        values[field.name] = m2m[field.name].get(row[0], [])
+                                prepare = getattr(self, "prepare_%s" % name, None)
+                                if prepare is not None:
+                                        prepare(values)
+                                records.append({'model': "%s.%s" % (APP_LABEL, name),
+                                        'pk': row[0],
+                                        'fields': values})
+                        yield records
+
+        def related(self, fields, pks):
+                """ Returns the keys of the rows related to the given rows, by
+                field name and by row """
+                result = {}
+                for field in fields:
+                        through = field.remote_field.through
+                        source = through._meta.get_field(field.m2m_field_name()).attname
+                        target = through._meta.get_field(field.m2m_reverse_field_name()).attname
+                        result[field.name] = {}
+                        for pk, value in through.objects.filter(**{"%s__in" % source: pks}).order_by(
+                                source, target).values_list(source, target):
+                                result[field.name].setdefault(pk, []).append(value)
+                return result
+
+        def write(self, filename, querysets):
+                """ Writes the rows of the querysets to a data file """
+                path = os.path.join(self.output_dir, filename)
+                tmp = "%s.tmp" % path
+                with open(tmp, 'w', encoding='utf-8') as f:
+                        for queryset in querysets:
+                                name = queryset.model._meta.model_name
+                                for records in self.records(queryset):
+                                        yaml.dump(records, f, Dumper=SafeDumper, allow_unicode=True,
+                                                default_flow_style=False, sort_keys=True)
+                                        self.rows[name] = self.rows.get(name, 0) + len(records)
+                os.replace(tmp, path)
+                self.files.append(filename)
+
+        def copy_image(self, field, name, target):
+                """ Copies an image of a file field to the images directory.
+                Returns False if the image is missing. """
+                if not field.storage.exists(name):
+                        return False
+                path = os.path.join(self.images_dir, target)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                with field.storage.open(name, 'rb') as source:
+                        with open(path, 'wb') as f:
+                                for chunk in source.chunks():
+                                        f.write(chunk)
+                return True
+
+        def prepare_setting(self, fields):
+                ## the loader reads the board from a path relative to the images
+                board = fields.pop('board')
+                target = "scenarios/boards/board-%s.png" % fields['slug']
+                if board and self.copy_image(scenarios.Setting._meta.get_field('board'), board, target):
+                        fields['board'] = target
+
+        def prepare_country(self, fields):
+                ## the loader takes the coat of arms from the static name
+                coat = fields.pop('coat_of_arms')
+                if coat:
+                        self.copy_image(scenarios.Country._meta.get_field('coat_of_arms'), coat,
+                                "badge-%s.png" % fields['static_name'])
+
+        def export(self):
+                """ Writes the files of the shared rows, of every setting and of
+                every scenario """
+                os.makedirs(self.output_dir, exist_ok=True)
+                self.write(SHARED_FILE, [get_model(name).objects.filter(**lookup)
+                        for name, lookup in SHARED_MODELS])
+                for pk, slug in scenarios.Setting.objects.order_by('pk').values_list('pk', 'slug'):
+                        self.write(SETTING_FILE % slug, [get_model(name).objects.filter(**{lookup: pk}).distinct()
+                                for name, lookup in SETTING_MODELS])
+                for pk, name in scenarios.Scenario.objects.order_by('pk').values_list('pk', 'name'):
+                        self.write(SCENARIO_FILE % name, [get_model(model).objects.filter(**{lookup: pk})
+                                for model, lookup in SCENARIO_MODELS])
+                return self.files
@@ -0,0 +1,336 @@
+## Copyright (c) 2010 by Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by the
+## Free Software Foundation, either version 3 of the License, or (at your option
+## any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program. If not, see <http://www.gnu.org/licenses/agpl.txt>.
+##
+## This license is also included in the file COPYING
+##
+## AUTHOR: Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+
+""" This module compiles the scenario data into a binary pack, and restores
+the pack into the database.
+
+The pack holds the rows exactly as ``BulkLoader`` would write them, after
+all the checks, with one column of values for each field of each model,
+and the board and coat of arms images. Restoring it does not parse nor
+check anything: the columns are decoded and the rows inserted with a few
+bulk INSERTs.
+
+The file starts with ``PACK_MAGIC``, the version of the format and the
+size of a JSON header, that describes where the columns and images are in
+the rest of the file.
+"""
+
+from collections import OrderedDict
+import array
+import datetime
+import json
+import os
+import os.path
+import struct
+import sys
+import time
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+from django.core.management.color import no_style
+from django.db import connection, models
+
+import condottieri_scenarios.models as scenarios
+import condottieri_scenarios.graphics as graphics
+import condottieri_scenarios.adjacency as adjacency
+import condottieri_scenarios.distances as distances
+import condottieri_scenarios.snapshots as snapshots
+from condottieri_scenarios.scenario_data import BATCH_SIZE, BulkLoader, \
+        DataChecker, get_model, dependency_order
+
+PACK_MAGIC = b'CSPACK'
+PACK_VERSION = 1
+
+PACK_PATH = getattr(settings, 'SCENARIOS_DATA_PACK',
+        os.path.join(settings.MEDIA_ROOT, 'scenarios', 'data.pack'))
+
+## the version and the size of the header
+PACK_PREAMBLE = struct.Struct('<HI')
+
+INTEGER_TYPES = ('AutoField', 'BigAutoField', 'SmallAutoField', 'IntegerField',
+        'BigIntegerField', 'SmallIntegerField', 'PositiveIntegerField',
+        'PositiveSmallIntegerField', 'PositiveBigIntegerField')
+
+TEXT_TYPES = ('CharField', 'SlugField', 'TextField', 'FileField')
+
+class PackError(Exception):
+        pass
+
+def column_kind(field):
+        """ Returns the kind of column that holds the values of a field: 'i'
+        for integers, 'b' for booleans, 'd' for dates and 's' for texts """
+        if field.is_relation:
+                field = field.target_field
+        internal = field.get_internal_type()
+        if internal in INTEGER_TYPES:
+                return 'i'
+        if internal in ('BooleanField', 'NullBooleanField'):
+                return 'b'
+        if internal == 'DateField':
+                return 'd'
+        if internal in TEXT_TYPES:
+                return 's'
+        raise PackError("Fields of type %s cannot be packed" % internal)
+
+def int_bytes(values):
+        a = array.array('q', values)
+        if sys.byteorder == 'big':
+                a.byteswap()
+        return a.tobytes()
+
+def int_values(blob):
+        a = array.array('q')
+        a.frombytes(blob)
+        if sys.byteorder == 'big':
+                a.byteswap()
+        return a.tolist()
+
+def encode_column(kind, values):
+        """ Returns the blobs of a column and the blob of its mask of nulls,
+        which is None if there are no nulls """
+        nulls = None
+        if any(v is None for v in values):
+                nulls = bytes(v is None for v in values)
+        if kind == 'i':
+                return [int_bytes(0 if v is None else v for v in values)], nulls
+        if kind == 'b':
+                return [bytes(bool(v) for v in values)], nulls
+        if kind == 'd':
+                return [int_bytes(0 if v is None else v.toordinal() for v in values)], nulls
+        texts = ['' if v is None else v for v in values]
+        ## the offsets are counted in characters, so the text is decoded once
+        offsets = [0]
+        for text in texts:
+                offsets.append(offsets[-1] + len(text))
+        return [int_bytes(offsets), "".join(texts).encode('utf-8')], nulls
+
+def decode_column(kind, blobs, nulls):
+        if kind == 'i':
+                values = int_values(blobs[0])
+        elif kind == 'b':
+                values = [b == 1 for b in bytes(blobs[0])]
+        elif kind == 'd':
+                values = [datetime.date.fromordinal(v) if v else None for v in int_values(blobs[0])]
+        else:
+                offsets = int_values(blobs[0])
+                text = bytes(blobs[1]).decode('utf-8')
+                values = [text[offsets[i]:offsets[i + 1]] for i in range(len(offsets) - 1)]
+        if nulls is not None:
+                values = [None if null else v for v, null in zip(values, bytes(nulls))]
+        return values
+
+def field_value(field, obj):
+        if isinstance(field, models.FileField):
+                return getattr(obj, field.attname).name or ''
+        ## the values of the XML files are still strings
+        return field.get_prep_value(getattr(obj, field.attname))
+
+def write_pack(path, tables, files, manifest):
+        """ Writes a pack. ``tables`` is a list of (model, objects), in the
+        order in which they must be inserted, ``files`` maps the names of
+        the images in the file fields to their paths, and ``manifest`` is the
+        manifest of the data files. Returns the size of the pack. """
+        blobs = []
+        offset = [0]
+        def add(blob):
+                blobs.append(blob)
+                part = [offset[0], len(blob)]
+                offset[0] += len(blob)
+                return part
+        header = {'version': PACK_VERSION,
+                'created': time.time(),
+                'manifest': manifest,
+                'tables': [],
+                'files': {}}
+        for model, objs in tables:
+                columns = []
+                for field in model._meta.concrete_fields:
+                        kind = column_kind(field)
+                        parts, nulls = encode_column(kind, [field_value(field, obj) for obj in objs])
+                        columns.append({'name': field.attname,
+                                'kind': kind,
+                                'parts': [add(part) for part in parts],
+                                'nulls': None if nulls is None else add(nulls)})
+                header['tables'].append({'model': model._meta.model_name,
+                        'rows': len(objs),
+                        'columns': columns})
+        for name in sorted(files):
+                with open(files[name], 'rb') as f:
+                        header['files'][name] = add(f.read())
+        header = json.dumps(header, sort_keys=True).encode('utf-8')
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp = "%s.tmp" % path
+        with open(tmp, 'wb') as f:
+                f.write(PACK_MAGIC)
+                f.write(PACK_PREAMBLE.pack(PACK_VERSION, len(header)))
+                f.write(header)
+                for blob in blobs:
+                        f.write(blob)
+        os.replace(tmp, path)
+        return os.path.getsize(path)
+
+class ScenarioPack(object):
+        """ A pack read from a file. The whole file is kept in memory and the
+        columns are decoded when they are asked for. """
+        def __init__(self, path=PACK_PATH):
+                with open(path, 'rb') as f:
+                        data = f.read()
+                start = len(PACK_MAGIC) + PACK_PREAMBLE.size
+                if not data.startswith(PACK_MAGIC) or len(data) < start:
+                        raise PackError("%s is not a scenario pack" % path)
+                version, size = PACK_PREAMBLE.unpack_from(data, len(PACK_MAGIC))
+                if version != PACK_VERSION:
+                        raise PackError("%s has version %s of the format, not %s" %
+                                (path, version, PACK_VERSION))
+                header = json.loads(data[start:start + size].decode('utf-8'))
+                self.created = header['created']
+                self.manifest = header['manifest']
+                self.tables = header['tables']
+                self.files = header['files']
+                self.body = memoryview(data)[start + size:]
+
+        def blob(self, part):
+                offset, size = part
+                return self.body[offset:offset + size]
+
+        def column(self, column):
+                nulls = column['nulls']
+                return decode_column(column['kind'], [self.blob(part) for part in column['parts']],
+                        None if nulls is None else self.blob(nulls))
+
+        def rows(self, table):
+                """ Returns the values of the rows of a table, as tuples in the
+                order of the columns """
+                return list(zip(*[self.column(column) for column in table['columns']]))
+
+        def file(self, name):
+                return bytes(self.blob(self.files[name]))
+
+class PackCompiler(DataChecker):
+        """ Takes the rows that BulkLoader would write, with the same checks,
+        and keeps them in memory to write them in a pack. Like DataChecker,
+        it does not touch the database. """
+        def __init__(self, static_dir, log=None, batch_size=BATCH_SIZE):
+                super(PackCompiler, self).__init__(static_dir, batch_size=batch_size)
+                self.log = log or (lambda level, message: None)
+                self.rows = OrderedDict()
+                ## paths of the images, by the names they have in the rows
+                self.files = {}
+
+        prepare_setting = BulkLoader.prepare_setting
+        prepare_country = BulkLoader.prepare_country
+
+        def prepare_area(self, area, fields):
+                ## BulkLoader does not check the rules of AreaForm
+                pass
+
+        def attach(self, obj, field, path, name):
+                getattr(obj, field).name = name
+                self.files[name] = path
+
+        def save_rows(self, model, objs, updates, m2m):
+                self.rows.setdefault(model._meta.model_name, []).extend(objs + updates)
+                for obj, related in m2m:
+                        for name, values in related.items():
+                                field = model._meta.get_field(name)
+                                through = field.remote_field.through
+                                source = through._meta.get_field(field.m2m_field_name()).attname
+                                target = through._meta.get_field(field.m2m_reverse_field_name()).attname
+                                rows = self.rows.setdefault(through._meta.model_name, [])
+                                for value in values:
+                                        rows.append(through(pk=len(rows) + 1,
+                                                **{source: obj.pk, target: value}))
+
+        def next_pk(self, name):
+                return max([obj.pk for obj in self.rows.get(name, [])] or [0]) + 1
+
+        def finish(self):
+                """ Adds the rows that BulkLoader.finish would insert, with
+                keys after the last ones in the data """
+                borders = self.rows.get('border', [])
+                pairs = set((b.from_area_id, b.to_area_id) for b in borders)
+                pk = self.next_pk('border')
+                for border in sorted(borders, key=lambda b: b.pk):
+                        if not (border.to_area_id, border.from_area_id) in pairs:
+                                borders.append(scenarios.Border(pk=pk, from_area_id=border.to_area_id,
+                                        to_area_id=border.from_area_id, only_land=border.only_land))
+                                pairs.add((border.to_area_id, border.from_area_id))
+                                pk += 1
+                pk = self.next_pk('configuration')
+                for setting in self.pks['setting'].values():
+                        if not setting in self.configurations:
+                                self.rows.setdefault('configuration', []).append(
+                                        scenarios.Configuration(pk=pk, setting_id=setting))
+                                pk += 1
+                pk = self.next_pk('contender')
+                for scenario in self.pks['scenario'].values():
+                        if not scenario in self.autonomous:
+                                self.rows.setdefault('contender', []).append(
+                                        scenarios.Contender(pk=pk, scenario_id=scenario))
+                                pk += 1
+
+        def tables(self):
+                """ Returns the rows of every model, in the order in which they
+                must be inserted """
+                return [(get_model(name), self.rows[name])
+                        for name in dependency_order(self.rows.keys())]
+
+def restore_pack(pack, editor, batch_size=BATCH_SIZE):
+        """ Inserts the rows of a pack, which must not be in the database
+        yet. The rows that refer to users are given to ``editor``. Returns
+        the time spent in each model with the number of rows inserted, and
+        the countries, whose tokens must be made. """
+        timings = OrderedDict()
+        loaded = []
+        countries = []
+        for table in pack.tables:
+                start = time.time()
+                model = get_model(table['model'])
+                fields = model._meta.concrete_fields
+                if [f.attname for f in fields] != [c['name'] for c in table['columns']]:
+                        raise PackError("The columns of %s in the pack do not match the model" %
+                                table['model'])
+                objs = [model(*row) for row in pack.rows(table)]
+                for field in fields:
+                        if field.is_relation and field.related_model is User:
+                                for obj in objs:
+                                        setattr(obj, field.attname, editor.pk)
+                        elif isinstance(field, models.FileField):
+                                for obj in objs:
+                                        name = getattr(obj, field.attname).name
+                                        if name:
+                                                getattr(obj, field.attname).save(name,
+                                                        ContentFile(pack.file(name)), save=False)
+                model.objects.bulk_create(objs, batch_size=batch_size)
+                loaded.append(model)
+                if model is scenarios.Country:
+                        countries = objs
+                timings[table['model']] = (time.time() - start, len(objs))
+        ## the rows are inserted with their keys, so the sequences are not updated
+        sql = connection.ops.sequence_reset_sql(no_style(), loaded)
+        if sql:
+                with connection.cursor() as cursor:
+                        for statement in sql:
+                                cursor.execute(statement)
+        for scenario in scenarios.Scenario.objects.all():
+                graphics.invalidate_layers(scenario)
+        adjacency.invalidate_adjacency()
+        distances.invalidate_distances()
+        snapshots.invalidate_snapshot()
+        return timings, countries
@@ -0,0 +1,226 @@
+## Copyright (c) 2010 by Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+## This program is free software: you can redistribute it and/or modify it
+## under the terms of the GNU Affero General Public License as published by the
+## Free Software Foundation, either version 3 of the License, or (at your option
+## any later version.
+##
+## This program is distributed in the hope that it will be useful, but WITHOUT
+## ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or
+## FITNESS FOR A PARTICULAR PURPOSE. See the GNU Affero General Public License
+## for more details.
+##
+## You should have received a copy of the GNU Affero General Public License
+## along with this program. If not, see <http://www.gnu.org/licenses/agpl.txt>.
+##
+## This license is also included in the file COPYING
+##
+## AUTHOR: Jose Antonio Martin <jantonio.martin AT gmail DOT com>
+
+""" This module keeps in memory the initial setup of each scenario, that is
+copied to every new game: the countries with their homes, units and ducats,
+the autonomous garrisons, the disabled areas and the cities with income.
+
+The snapshot of a scenario is built with a fixed number of queries, whatever
+the number of countries, and kept in ``scenario_cache`` until a row of the
+scenario is saved or deleted, which changes the version of the scenario.
+"""
+
+from django.core.exceptions import ObjectDoesNotExist
+from condottieri_common.translation_compat import ugettext_lazy as _
+
+from condottieri_scenarios.scenario_cache import register_cache
+
+class HomeSnapshot(object):
+        """ An area controlled by a country at the beginning """
+        __slots__ = ('area', 'is_home')
+
+        def __init__(self, area, is_home):
+                self.area = area
+                self.is_home = is_home
+
+        def __str__(self):
+                return "%s" % self.area.name
+
+        def _get_area_id(self):
+                return self.area.pk
+
+        area_id = property(_get_area_id)
+
+        def _get_code(self):
+                return self.area.code
+
+        code = property(_get_code)
+
+class SetupSnapshot(object):
+        """ A unit placed in an area at the beginning """
+        __slots__ = ('area', 'unit_type')
+
+        def __init__(self, area, unit_type):
+                self.area = area
+                self.unit_type = unit_type
+
+        def __str__(self):
+                from condottieri_scenarios.models import UNIT_TYPES
+
+                return _("%(unit)s in %(area)s") % {
+                        'unit': dict(UNIT_TYPES)[self.unit_type],
+                        'area': self.area.name }
+
+        def _get_area_id(self):
+                return self.area.pk
+
+        area_id = property(_get_area_id)
+
+        def _get_code(self):
+                return self.area.code
+
+        code = property(_get_code)
+
+class CountrySnapshot(object):
+        """ The setup of a country in a scenario """
+        __slots__ = ('country', 'contender_id', 'priority', 'ducats', 'double', 'homes', 'setups')
+
+        def __init__(self, country, contender_id, priority, ducats=0, double=False):
+                self.country = country
+                self.contender_id = contender_id
+                self.priority = priority
+                self.ducats = ducats
+                self.double = double
+                self.homes = []
+                self.setups = []
+
+        def _get_static_name(self):
+                return self.country.static_name
+
+        static_name = property(_get_static_name)
+
+        def _get_name(self):
+                ## the name is read from the country in the active language
+                return self.country.name
+
+        name = property(_get_name)
+
+class AutonomousSnapshot(object):
+        """ The contender without country, with the setups of the autonomous
+        garrisons """
+        __slots__ = ('contender_id', 'setups')
+        country = None
+
+        def __init__(self, contender_id, setups):
+                self.contender_id = contender_id
+                self.setups = setups
+
+class ScenarioSnapshot(object):
+        """ The initial setup of a scenario. ``contenders`` are all the
+        contenders, in the order of the model, ``countries`` are those with
+        a country, ``autonomous`` are the units of the contender without
+        country, ``autonomous_id``, and ``disabled`` and ``cities`` are lists
+        of areas. """
+        __slots__ = ('scenario_id', 'version', 'contenders', 'countries', 'autonomous_id',
+                'autonomous', 'disabled', 'cities')
+
+        def __init__(self, scenario_id, version):
+                self.scenario_id = scenario_id
+                self.version = version
+                self.contenders = []
+                self.countries = []
+                self.autonomous_id = None
+                self.autonomous = []
+                self.disabled = []
+                self.cities = []
+
+        def get_country(self, static_name):
+                for country in self.countries:
+                        if country.static_name == static_name:
+                                return country
+                return None
+
+        def setup_dict(self):
+                """ Returns the setup of the countries as a dictionary, by the
+                static name of the country. The homes and the setups are
+                given as querysets, that are only run if they are used. """
+                from condottieri_scenarios.models import Home, Setup
+
+                return dict((c.static_name, {
+                        'name': c.name,
+                        'homes': Home.objects.filter(contender=c.contender_id).select_related('area'),
+                        'setups': Setup.objects.filter(contender=c.contender_id).select_related('area'),
+                        'ducats': c.ducats,
+                        'double': c.double,
+                        }) for c in self.countries)
+
+def build_snapshot(scenario_id, version=None):
+        """ Reads the setup of a scenario from the database, in five queries.
+        The contenders are in the default order of the model. """
+        from condottieri_scenarios.models import Contender, Home, Setup, DisabledArea, CityIncome
+
+        snapshot = ScenarioSnapshot(scenario_id, version)
+        by_contender = {}
+        for contender in Contender.objects.filter(scenario=scenario_id).select_related('country',
+                'treasury'):
+                if contender.country is None:
+                        snapshot.autonomous_id = contender.pk
+                        snapshot.contenders.append(AutonomousSnapshot(contender.pk, snapshot.autonomous))
+                        continue
+                try:
+                        treasury = contender.treasury
+                except ObjectDoesNotExist:
+                        country = CountrySnapshot(contender.country, contender.pk, contender.priority)
+                else:
+                        country = CountrySnapshot(contender.country, contender.pk, contender.priority,
+                                treasury.ducats, treasury.double)
+                by_contender[contender.pk] = country
+                snapshot.contenders.append(country)
+                snapshot.countries.append(country)
+        for home in Home.objects.filter(contender__scenario=scenario_id).select_related(
+                'area').order_by('pk'):
+                country = by_contender.get(home.contender_id)
+                if country is not None:
+                        country.homes.append(HomeSnapshot(home.area, home.is_home))
+        for setup in Setup.objects.filter(contender__scenario=scenario_id).select_related(
+                'area').order_by('pk'):
+                unit = SetupSnapshot(setup.area, setup.unit_type)
+                country = by_contender.get(setup.contender_id)
+                if country is None:
+                        snapshot.autonomous.append(unit)
+                else:
+                        country.setups.append(unit)
+        snapshot.disabled = [d.area for d in DisabledArea.objects.filter(
+                scenario=scenario_id).select_related('area').order_by('area__code')]
+        snapshot.cities = [c.city for c in CityIncome.objects.filter(
+                scenario=scenario_id).select_related('city').order_by('city__code')]
+        return snapshot
+
+cache = register_cache('scenario', build_snapshot)
+
+def get_snapshot(scenario_id):
+        """ Returns the ScenarioSnapshot of a scenario, given by its primary
+        key, built again if the scenario has changed """
+        return cache.get(scenario_id)
+
+def invalidate_snapshot(scenario_id=None):
+        """ Changes the version of a scenario, or of all the scenarios if
+        scenario_id is None, so that their snapshots are built again """
+        cache.invalidate(scenario_id)
+
+def snapshot_scenario_id(instance):
+        """ Returns the key of the scenario of a row that is part of its setup """
+        if hasattr(instance, 'contender_id'):
+                return instance.contender.scenario_id
+        if hasattr(instance, 'scenario_id'):
+                return instance.scenario_id
+        return instance.pk
+
+def signal_handler_invalidate_snapshot(sender, instance, **kwargs):
+        """ Changes the version of the scenario of a contender, a treasury, a
+        home, a setup, a disabled area or a city income, or of the scenario
+        itself """
+        try:
+                invalidate_snapshot(snapshot_scenario_id(instance))
+        except ObjectDoesNotExist:
+                invalidate_snapshot()
+
+def signal_handler_invalidate_snapshots(sender, instance, **kwargs):
+        """ Changes the version of every scenario, when a country or an area,
+        that are shared by the snapshots, changes """
+        invalidate_snapshot()
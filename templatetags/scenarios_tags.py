@@ -1,6 +1,10 @@
 from django import template
 from django.utils.safestring import mark_safe
 from django.templatetags.static import static
+from django.conf import settings
+from django.utils.html import format_html
+
+from condottieri_scenarios import graphics
 
 register = template.Library()
 
@@ -11,4 +15,26 @@ def yesnoicons(value):
     """
     if value:
         return mark_safe(f'<img src="{static("img/yes.png")}" alt="Yes" />')
-    return mark_safe(f'<img src="{static("img/no.png")}" alt="No" />') 
\ No newline at end of file
+    return mark_safe(f'<img src="{static("img/no.png")}" alt="No" />') 
+
+@register.simple_tag(takes_context=True)
+def country_token(context, country, prefix="icon"):
+    """
+    Returns an image with a token of a country (badge, icon, A, G, F, control
+    or flag). In atlas mode, the token is cropped from the atlas of a setting
+    with CSS, so that the page loads a single image for all the countries.
+    The atlases are looked up once by the view, in ``token_index``; the
+    tokens that are not there are shown as plain images.
+    """
+    found = context.get('token_index', {}).get("%s-%s.png" % (prefix, country.static_name))
+    if found is not None:
+        url, (x, y, w, h) = found
+        return format_html('<span class="token" title="{}" style="display: inline-block; '
+            'width: {}px; height: {}px; background: url(\'{}\') -{}px -{}px no-repeat"></span>',
+            country.name, w, h, url, x, y)
+    if prefix in ("badge", "icon"):
+        directory = "badges"
+    else:
+        directory = "tokens"
+    return format_html('<img src="{}scenarios/{}/{}-{}.png" alt="{}" />',
+        settings.MEDIA_URL, directory, prefix, country.static_name, country.name)
@@ -1,2 +1,7 @@
 from .graphics import *
 from .models import *
+from .render_queue import *
+from .scenario_data import *
+from .scenario_pack import *
+from .scenario_export import *
+from .scenario_cache import *
@@ -1,7 +1,17 @@
+import os
+import shutil
+import tempfile
+from collections import OrderedDict
+
 from django.test import TestCase
 from unittest import mock
 
+from django.contrib.auth.models import User
+from PIL import Image
+
 from condottieri_scenarios.graphics import *
+from condottieri_scenarios.models import Setting, Scenario, Country, Contender, \
+    Area, Home, Setup, DisabledArea, CityIncome, ControlToken, GToken, AFToken
 
 class GraphicsTestCase(TestCase):
 
@@ -9,3 +19,422 @@ class GraphicsTestCase(TestCase):
     def test_ensure_dir(self, mock_makedirs):
         mock_makedirs.return_value = None
         self.assertIsNone(ensure_dir(''))
+
+class LayerTestCase(TestCase):
+
+    def setUp(self):
+        self.board = Image.new("RGBA", (100, 100), (255, 255, 255, 255))
+        self.token = Image.new("RGBA", (10, 10), (255, 0, 0, 128))
+
+    def test_contender_layer(self):
+        self.assertEqual(contender_layer(3), "contender-3")
+
+    def test_render_empty_layer(self):
+        layer, offset = render_layer([])
+        self.assertEqual(offset, (0, 0))
+        self.assertEqual(layer.getpixel((0, 0)), (0, 0, 0, 0))
+
+    def test_render_layer_bounding_box(self):
+        layer, offset = render_layer([(self.token, 20, 30), (self.token, 50, 35)])
+        self.assertEqual(offset, (20, 30))
+        self.assertEqual(layer.size, (40, 15))
+
+    def test_flatten_equals_direct_paste(self):
+        ops = [(self.token, 20, 30), (self.token, 25, 35), (self.token, -5, 90)]
+        expected = self.board.copy()
+        for token, x, y in ops:
+            expected.paste(token, (x, y), token)
+        result = flatten(self.board, [render_layer(ops)])
+        self.assertEqual(result.convert("RGB").tobytes(), expected.convert("RGB").tobytes())
+
+    def test_flatten_keeps_board(self):
+        flatten(self.board, [render_layer([(self.token, 0, 0)])])
+        self.assertEqual(self.board.getpixel((0, 0)), (255, 255, 255, 255))
+
+    def test_get_layer_checks_hash(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        s = mock.Mock(layers_path=tmpdir)
+        ops = [("control-florence.png", 20, 30)]
+        blue = Image.new("RGBA", (10, 10), (0, 0, 255, 255))
+        with mock.patch('condottieri_scenarios.graphics.sprite_hash', return_value="red"), \
+                mock.patch('condottieri_scenarios.graphics.get_sprite', return_value=self.token):
+            get_layer(s, "contender-1", ops)
+            layer, offset = get_layer(s, "contender-1", ops)
+        self.assertEqual(layer.getpixel((0, 0)), (255, 0, 0, 128))
+        ## a token changed without removing the layer
+        with mock.patch('condottieri_scenarios.graphics.sprite_hash', return_value="blue"), \
+                mock.patch('condottieri_scenarios.graphics.get_sprite', return_value=blue) as mock_get_sprite:
+            layer, offset = get_layer(s, "contender-1", ops)
+            self.assertEqual(layer.getpixel((0, 0)), (0, 0, 255, 255))
+            get_layer(s, "contender-1", ops)
+            self.assertEqual(mock_get_sprite.call_count, 1)
+            layer, offset = get_layer(s, "contender-1", [("control-florence.png", 40, 30)])
+            self.assertEqual(offset, (40, 30))
+
+class ImageCacheTestCase(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.paths = []
+        for i in range(3):
+            path = os.path.join(self.tmpdir, "token-%s.png" % i)
+            Image.new("RGBA", (10, 10), (i, 0, 0, 255)).save(path)
+            self.paths.append(path)
+        ## each token takes 400 bytes, so only two of them fit in the cache
+        self.cache = ImageCache(800)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_get_returns_cached_image(self):
+        self.assertIs(self.cache.get(self.paths[0]), self.cache.get(self.paths[0]))
+        self.assertEqual(self.cache.size, 400)
+
+    def test_evicts_least_recently_used(self):
+        first = self.cache.get(self.paths[0])
+        self.cache.get(self.paths[1])
+        self.cache.get(self.paths[0])
+        self.cache.get(self.paths[2])
+        self.assertEqual(self.cache.size, 800)
+        self.assertIs(self.cache.get(self.paths[0]), first)
+        self.assertNotIn(self.paths[1], self.cache._images)
+
+    def test_reloads_modified_file(self):
+        self.cache.get(self.paths[0])
+        Image.new("RGBA", (10, 10), (0, 255, 0, 255)).save(self.paths[0])
+        os.utime(self.paths[0], (0, 0))
+        self.assertEqual(self.cache.get(self.paths[0]).getpixel((0, 0)), (0, 255, 0, 255))
+        self.assertEqual(self.cache.size, 400)
+
+    def test_invalidate(self):
+        first = self.cache.get(self.paths[0])
+        self.cache.invalidate([self.paths[0], ])
+        self.assertEqual(self.cache.size, 0)
+        self.assertIsNot(self.cache.get(self.paths[0]), first)
+
+class FileHashTestCase(TestCase):
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        os.write(fd, b"token")
+        os.close(fd)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_file_hash(self):
+        self.assertEqual(file_hash(self.path), "ee977806d7286510da8b9a7492ba58e2484c0ecc")
+
+    def test_file_hash_changes_with_file(self):
+        first = file_hash(self.path)
+        with open(self.path, "wb") as f:
+            f.write(b"another token")
+        self.assertNotEqual(file_hash(self.path), first)
+
+class EncoderTestCase(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.image = Image.new("RGBA", (64, 48), (255, 0, 0, 255))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_format_path(self):
+        self.assertEqual(format_path("/maps/scenario-a.jpg", "webp"), "/maps/scenario-a.webp")
+        self.assertEqual(path_format("/maps/scenario-a.jpg"), "jpeg")
+        self.assertEqual(path_format("/tokens/A-a.png"), "png")
+
+    def test_encoders_from_settings(self):
+        with self.settings(SCENARIOS_ENCODERS={'map': {'jpeg': {'quality': 50}}}):
+            self.assertEqual(encoders('map'), {'jpeg': {'quality': 50}})
+            self.assertEqual(encoders('tile'), DEFAULT_ENCODERS['tile'])
+
+    def test_save_output(self):
+        filename = os.path.join(self.tmpdir, "scenario-a.jpg")
+        encs = {'map': {'jpeg': {'progressive': True}, 'webp': {'quality': 50}}}
+        with self.settings(SCENARIOS_ENCODERS=encs):
+            paths = save_output(self.image, filename, "map")
+        self.assertEqual(paths, [filename, os.path.join(self.tmpdir, "scenario-a.webp")])
+        self.assertEqual(Image.open(filename).format, "JPEG")
+        self.assertTrue(Image.open(filename).info.get("progressive"))
+        self.assertEqual(Image.open(paths[1]).format, "WEBP")
+
+    def test_save_output_always_writes_filename(self):
+        filename = os.path.join(self.tmpdir, "scenario-a.jpg")
+        with self.settings(SCENARIOS_ENCODERS={'map': {'webp': {}}}):
+            save_output(self.image, filename, "map")
+        self.assertEqual(Image.open(filename).format, "JPEG")
+
+    def test_save_output_removes_old_formats(self):
+        filename = os.path.join(self.tmpdir, "scenario-a.jpg")
+        with self.settings(SCENARIOS_ENCODERS={'map': {'webp': {}, 'jpeg': {}}}):
+            save_output(self.image, filename, "map")
+        self.assertTrue(os.path.exists(format_path(filename, "webp")))
+        self.assertLessEqual(os.path.getmtime(filename), os.path.getmtime(format_path(filename, "webp")))
+        with self.settings(SCENARIOS_ENCODERS={'map': {'jpeg': {}}}):
+            self.assertEqual(save_output(self.image, filename, "map"), [filename])
+        self.assertFalse(os.path.exists(format_path(filename, "webp")))
+
+    def test_quantized_png(self):
+        filename = os.path.join(self.tmpdir, "A-a.png")
+        encode_image(self.image, filename, "png", {'optimize': True, 'colors': 16})
+        self.assertEqual(Image.open(filename).mode, "P")
+
+    def test_negotiate_format(self):
+        filename = os.path.join(self.tmpdir, "scenario-a.jpg")
+        self.image.convert("RGB").save(filename)
+        self.assertEqual(negotiate_format(filename, "image/webp,*/*"), (filename, "image/jpeg"))
+        self.image.save(format_path(filename, "webp"))
+        self.assertEqual(negotiate_format(filename, "image/webp,*/*"),
+            (format_path(filename, "webp"), "image/webp"))
+        self.assertEqual(negotiate_format(filename, "*/*"), (filename, "image/jpeg"))
+        self.assertEqual(negotiate_format(filename, "image/webp;q=0,*/*"), (filename, "image/jpeg"))
+        self.assertEqual(negotiate_format(filename, "image/jpeg,image/webp;q=0.5"),
+            (filename, "image/jpeg"))
+        self.assertEqual(negotiate_format(filename, "image/webp;q=0.9, image/*;q=0.8"),
+            (format_path(filename, "webp"), "image/webp"))
+        os.utime(format_path(filename, "webp"), (0, 0))
+        self.assertEqual(negotiate_format(filename, "image/webp,*/*"), (filename, "image/jpeg"))
+
+    def test_parse_accept(self):
+        self.assertEqual(parse_accept("image/webp, image/*;q=0.8 ,*/*; q=0.5"),
+            {'image/webp': 1.0, 'image/*': 0.8, '*/*': 0.5})
+        self.assertEqual(parse_accept(""), {})
+
+class AtlasTestCase(TestCase):
+
+    def setUp(self):
+        self.tokens = {
+            "A-florence.png": Image.new("RGBA", (48, 48), (255, 0, 0, 255)),
+            "F-florence.png": Image.new("RGBA", (52, 28), (0, 255, 0, 128)),
+            "control-florence.png": Image.new("RGB", (24, 24), (0, 0, 255)),
+        }
+
+    def test_token_path(self):
+        self.assertEqual(token_path("icon-florence.png"), os.path.join(BADGES_DIR, "icon-florence.png"))
+        self.assertEqual(token_path("A-florence.png"), os.path.join(TOKENS_DIR, "A-florence.png"))
+
+    def test_pack_atlas(self):
+        atlas, rects = pack_atlas(self.tokens)
+        self.assertEqual(atlas.size, (124, 48))
+        self.assertEqual(rects["A-florence.png"], (0, 0, 48, 48))
+        for name, (x, y, w, h) in rects.items():
+            self.assertEqual(atlas.crop((x, y, x + w, y + h)).tobytes(),
+                self.tokens[name].convert("RGBA").tobytes())
+
+    def test_pack_atlas_shelves(self):
+        tokens = dict(("G-%s.png" % i, Image.new("RGBA", (300, 32))) for i in range(5))
+        atlas, rects = pack_atlas(tokens)
+        self.assertEqual(atlas.size, (900, 64))
+        self.assertEqual(rects["G-3.png"], (0, 32, 300, 32))
+
+    @mock.patch('condottieri_scenarios.graphics.get_token')
+    @mock.patch('condottieri_scenarios.graphics.get_atlas')
+    def test_get_sprite_from_atlas(self, mock_get_atlas, mock_get_token):
+        mock_get_atlas.return_value = pack_atlas(self.tokens)
+        setting = mock.Mock(slug="italy")
+        with self.settings(SCENARIOS_TOKEN_ATLAS=True):
+            sprite = get_sprite(setting, "F-florence.png")
+            self.assertEqual(sprite.tobytes(), self.tokens["F-florence.png"].tobytes())
+            self.assertIs(get_sprite(setting, "F-florence.png"), sprite)
+            self.assertFalse(mock_get_token.called)
+            get_sprite(setting, "chest.png")
+            mock_get_token.assert_called_with("chest.png")
+            mock_get_atlas.return_value = pack_atlas(self.tokens)
+            self.assertIsNot(get_sprite(setting, "F-florence.png"), sprite)
+
+    @mock.patch('condottieri_scenarios.graphics.get_atlas')
+    def test_get_sprite_without_atlas(self, mock_get_atlas):
+        with mock.patch('condottieri_scenarios.graphics.get_token') as mock_get_token:
+            get_sprite(None, "A-florence.png")
+            mock_get_token.assert_called_with("A-florence.png")
+        self.assertFalse(mock_get_atlas.called)
+
+    @mock.patch('condottieri_scenarios.graphics.get_atlas')
+    @mock.patch('condottieri_scenarios.graphics.get_atlas_index')
+    def test_country_token_index(self, mock_get_atlas_index, mock_get_atlas):
+        user = User.objects.create(username="editor")
+        setting = Setting.objects.create(title_en="Italy", slug="italy", editor=user)
+        scenario = Scenario.objects.create(setting=setting, title_en="S", start_year=1454,
+            editor=user)
+        with mock.patch('condottieri_scenarios.graphics.make_country_tokens'):
+            country = Country.objects.create(name_en="Florence", static_name="florence",
+                color="000000", editor=user)
+        Contender.objects.create(scenario=scenario, country=country)
+        mock_get_atlas_index.return_value = None
+        with mock.patch('condottieri_scenarios.render_queue.enqueue') as mock_enqueue:
+            with self.settings(SCENARIOS_RENDER_QUEUE=True):
+                self.assertEqual(country_token_index([country]), {})
+            mock_enqueue.assert_called_with(scenario)
+        self.assertFalse(mock_get_atlas.called)
+        mock_get_atlas_index.return_value = {"A-florence.png": (0, 0, 48, 48)}
+        with mock.patch('os.path.exists', return_value=True), \
+                mock.patch('condottieri_scenarios.graphics.atlas_url', return_value="atlas.png"):
+            with self.assertNumQueries(1):
+                self.assertEqual(country_token_index([country]),
+                    {"A-florence.png": ("atlas.png", (0, 0, 48, 48))})
+
+class MapTilesTestCase(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.scenario = mock.Mock(tiles_path=os.path.join(self.tmpdir, "tiles"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_make_map_tiles(self):
+        image = Image.new("RGB", (600, 300), (255, 255, 255))
+        manifest = make_map_tiles(self.scenario, image, "fingerprint")
+        self.assertEqual(manifest['levels'], [
+            {'width': 150, 'height': 75},
+            {'width': 300, 'height': 150},
+            {'width': 600, 'height': 300}])
+        self.assertEqual(sorted(os.listdir(os.path.join(self.scenario.tiles_path, "2"))),
+            ["0_0.jpg", "0_1.jpg", "1_0.jpg", "1_1.jpg", "2_0.jpg", "2_1.jpg"])
+        tile = Image.open(os.path.join(self.scenario.tiles_path, "2", "2_1.jpg"))
+        self.assertEqual(tile.size, (88, 44))
+
+    @mock.patch('condottieri_scenarios.graphics.map_sizes', return_value={})
+    @mock.patch('condottieri_scenarios.graphics.map_fingerprint', return_value="fingerprint")
+    @mock.patch('condottieri_scenarios.graphics.render_plan')
+    def test_make_scenario_map_without_tiles(self, *mocks):
+        self.scenario.map_path = os.path.join(self.tmpdir, "map.jpg")
+        open(self.scenario.map_path, 'w').close()
+        self.scenario.read_map_fingerprint.return_value = "fingerprint"
+        self.assertFalse(make_scenario_map(self.scenario))
+        with self.settings(SCENARIOS_MAP_TILES=True):
+            with mock.patch('condottieri_scenarios.graphics.get_board_layer',
+                    side_effect=IOError("rendered")):
+                self.assertRaisesMessage(IOError, "rendered", make_scenario_map, self.scenario)
+
+    def test_make_map_tiles_replaces_old_pyramid(self):
+        make_map_tiles(self.scenario, Image.new("RGB", (600, 300)))
+        make_map_tiles(self.scenario, Image.new("RGB", (200, 100)))
+        self.assertEqual(sorted(os.listdir(self.scenario.tiles_path)), ["0", "manifest.json"])
+
+class MapSizesTestCase(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.scenario = mock.Mock()
+        self.scenario.get_map_size_path = lambda d: os.path.join(self.tmpdir, d, "map.jpg")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_map_sizes(self):
+        self.assertEqual(list(map_sizes().keys()), ["thumbnails", "previews"])
+
+    def test_save_map_sizes(self):
+        image = Image.new("RGB", (1600, 1000), (255, 255, 255))
+        sizes = OrderedDict([("small", (100, 100)), ("big", (800, 800))])
+        reduced = []
+        thumbnail = Image.Image.thumbnail
+        def record_thumbnail(im, *args, **kwargs):
+            reduced.append(im.size)
+            return thumbnail(im, *args, **kwargs)
+        with self.settings(SCENARIOS_MAP_SIZES=sizes):
+            with mock.patch.object(Image.Image, 'thumbnail', autospec=True,
+                    side_effect=record_thumbnail):
+                save_map_sizes(self.scenario, image)
+        ## the small size is reduced from the big one
+        self.assertEqual(reduced, [(1600, 1000), (800, 500)])
+        self.assertEqual(Image.open(os.path.join(self.tmpdir, "big", "map.jpg")).size, (800, 500))
+        self.assertEqual(Image.open(os.path.join(self.tmpdir, "small", "map.jpg")).size, (100, 63))
+        self.assertEqual(image.size, (1600, 1000))
+
+class RenderPlanTestCase(TestCase):
+
+    fixtures = ['users.yaml',]
+
+    @mock.patch("condottieri_scenarios.graphics.make_country_tokens")
+    def setUp(self, make_country_tokens_mock):
+        make_country_tokens_mock.return_value = None
+        self.user = User.objects.first()
+        self.setting = Setting.objects.create(title_en = 'dummy setting',
+                description_en = 'description',
+                editor = self.user)
+        self.country = Country.objects.create(name_en = "Albacete",
+                color = "000000",
+                coat_of_arms = "",
+                editor = self.user)
+        self.scenario = Scenario.objects.create(setting = self.setting,
+                title_en = "dummy scenario",
+                description_en = "description",
+                start_year = 0,
+                editor = self.user)
+        self.contender = Contender.objects.create(country=self.country,
+                scenario=self.scenario)
+        self.autonomous = self.scenario.contender_set.get(country__isnull=True)
+        self.areas = [self.make_area(i) for i in range(10)]
+
+    def make_area(self, i):
+        area = Area.objects.create(setting=self.setting,
+                name_en="Area %s" % i,
+                code="A%s" % i,
+                is_coast=True,
+                has_city=True,
+                is_fortified=True,
+                has_port=True)
+        ControlToken.objects.create(area=area, x=i, y=100 + i)
+        GToken.objects.create(area=area, x=200 + i, y=300 + i)
+        AFToken.objects.create(area=area, x=400 + i, y=500 + i)
+        return area
+
+    def test_plan(self):
+        Home.objects.create(contender=self.contender, area=self.areas[0])
+        Home.objects.create(contender=self.contender, area=self.areas[1], is_home=False)
+        Setup.objects.create(contender=self.contender, area=self.areas[0], unit_type='A')
+        Setup.objects.create(contender=self.autonomous, area=self.areas[2], unit_type='G')
+        DisabledArea.objects.create(scenario=self.scenario, area=self.areas[3])
+        CityIncome.objects.create(scenario=self.scenario, city=self.areas[4])
+        plan = render_plan(self.scenario)
+        self.assertEqual(list(plan.keys()), [MARKERS_LAYER,
+            contender_layer(self.contender.pk),
+            contender_layer(self.autonomous.pk)])
+        self.assertEqual(plan[MARKERS_LAYER], [("disabled.png", 403, 503),
+            ("chest.png", 252, 304)])
+        self.assertEqual(plan[contender_layer(self.contender.pk)], [
+            ("control-albacete.png", 0, 100),
+            ("flag-albacete.png", 0, 85),
+            ("control-albacete.png", 1, 101),
+            ("A-albacete.png", 400, 500)])
+        self.assertEqual(plan[contender_layer(self.autonomous.pk)], [
+            ("G-autonomous.png", 202, 302)])
+
+    def test_number_of_queries(self):
+        with self.assertNumQueries(5):
+            render_plan(self.scenario)
+        for area in self.areas:
+            Home.objects.create(contender=self.contender, area=area)
+            Setup.objects.create(contender=self.contender, area=area, unit_type='F')
+            Setup.objects.create(contender=self.autonomous, area=area, unit_type='G')
+        with self.assertNumQueries(5):
+            plan = render_plan(self.scenario)
+        self.assertEqual(len(plan[contender_layer(self.contender.pk)]), 30)
+
+class MakeTokensTestCase(TestCase):
+
+    fixtures = ['users.yaml',]
+
+    @mock.patch("condottieri_scenarios.graphics.make_country_tokens")
+    def setUp(self, make_country_tokens_mock):
+        self.user = User.objects.first()
+        self.countries = [Country.objects.create(name_en=name,
+                color="000000",
+                coat_of_arms="",
+                protected=(name == "Cuenca"),
+                editor=self.user) for name in ("Albacete", "Cuenca", "Toledo")]
+
+    @mock.patch("condottieri_scenarios.graphics.token_cache")
+    @mock.patch("condottieri_scenarios.graphics.write_country_tokens")
+    def test_make_tokens(self, write_mock, cache_mock):
+        make_tokens(self.countries)
+        self.assertEqual([c.args[0] for c in write_mock.call_args_list],
+            [self.countries[0], self.countries[2]])
+        paths = cache_mock.invalidate.call_args[0][0]
+        self.assertIn(token_path("A-albacete.png"), paths)
+        self.assertNotIn(token_path("A-cuenca.png"), paths)
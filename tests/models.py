@@ -1,9 +1,15 @@
+import os
+import shutil
+import tempfile
+
 from django.test import TestCase, override_settings
 from unittest import skip, mock 
 
 from django.contrib.auth.models import User
 
 from condottieri_scenarios.models import *
+import condottieri_scenarios.adjacency as adjacency
+import condottieri_scenarios.distances as distances
 
 class SettingTestCase(TestCase):
 
@@ -72,6 +78,29 @@ class ScenarioTestCase(TestCase):
         self.assertEqual(self.scenario.map_url,
                 "media/scenarios/scenario-dummy-scenario.jpg")
 
+    @override_settings(MEDIA_URL="media")
+    @override_settings(SCENARIOS_ROOT="scenarios")
+    @mock.patch.object(Scenario, "map_fingerprint", "0123456789abcdef")
+    def test_map_url_with_fingerprint(self):
+        self.assertEqual(self.scenario.map_url,
+                "media/scenarios/scenario-dummy-scenario.jpg?v=0123456789ab")
+
+    @override_settings(MEDIA_ROOT="media")
+    @override_settings(SCENARIOS_ROOT="scenarios")
+    def test_fingerprint_path(self):
+        self.assertEqual(self.scenario.fingerprint_path,
+                "media/scenarios/scenario-dummy-scenario.jpg.fingerprint")
+
+    def test_map_fingerprint(self):
+        self.assertIsNone(self.scenario.map_fingerprint)
+
+    def test_map_fingerprint_read_once(self):
+        with mock.patch.object(Scenario, "read_map_fingerprint", return_value="0123456789abcdef") as read:
+            self.scenario.map_url
+            self.scenario.thumbnail_url
+            self.scenario.preview_url
+        self.assertEqual(read.call_count, 1)
+
     @override_settings(MEDIA_ROOT="media")
     @override_settings(SCENARIOS_ROOT="scenarios")
     def test_thumbnail_path(self):
@@ -84,6 +113,18 @@ class ScenarioTestCase(TestCase):
         self.assertEqual(self.scenario.thumbnail_url,
                 "media/scenarios/thumbnails/scenario-dummy-scenario.jpg")
 
+    @override_settings(MEDIA_ROOT="media")
+    @override_settings(SCENARIOS_ROOT="scenarios")
+    def test_get_map_size_path(self):
+        self.assertEqual(self.scenario.get_map_size_path("previews"),
+                "media/scenarios/previews/scenario-dummy-scenario.jpg")
+
+    @override_settings(MEDIA_URL="media")
+    @override_settings(SCENARIOS_ROOT="scenarios")
+    def test_preview_url(self):
+        self.assertEqual(self.scenario.preview_url,
+                "media/scenarios/previews/scenario-dummy-scenario.jpg")
+
     def test_in_use(self):
         self.assertFalse(self.scenario.in_use)
     
@@ -99,6 +140,15 @@ class ScenarioTestCase(TestCase):
     def test_times_played(self):
         self.assertEqual(self.scenario.times_played, 0)
 
+    def test_with_stats(self):
+        scenario = Scenario.objects.with_stats().get(pk=self.scenario.pk)
+        with self.assertNumQueries(0):
+            self.assertEqual(scenario.number_of_players, 0)
+            self.assertFalse(scenario.in_use)
+            self.assertFalse(scenario.in_play)
+            self.assertEqual(scenario.times_played, 0)
+            self.assertEqual(scenario.setting, self.setting)
+
 class SpecialUnitTestCase(TestCase):
 
     def setUp(self):
@@ -194,6 +244,39 @@ class ContenderTestCase(TestCase):
     def test_treasury_editor(self):
         self.assertEqual(self.treasury.editor, self.user)
 
+    def test_setup_dict(self):
+        area = Area.objects.create(setting=self.setting, name_en="Alicante", code="ALI")
+        Home.objects.create(contender=self.contender, area=area)
+        Setup.objects.create(contender=self.contender, area=area, unit_type='A')
+        setup = self.scenario.setup_dict['albacete']
+        self.assertEqual(setup['name'], "Albacete")
+        self.assertEqual(setup['ducats'], 0)
+        self.assertEqual([h.area.code for h in setup['homes']], ["ALI"])
+        self.assertEqual(setup['setups'].filter(unit_type='A').count(), 1)
+
+    def test_snapshot(self):
+        area = Area.objects.create(setting=self.setting, name_en="Alicante", code="ALI",
+                has_city=True, is_fortified=True)
+        Setup.objects.create(contender=self.scenario.contender_set.get(country__isnull=True),
+                area=area, unit_type='G')
+        disabled = Area.objects.create(setting=self.setting, name_en="Albacete", code="ALB")
+        DisabledArea.objects.create(scenario=self.scenario, area=disabled)
+        with self.assertNumQueries(5):
+            snapshot = self.scenario.snapshot
+        with self.assertNumQueries(0):
+            self.assertIs(self.scenario.snapshot, snapshot)
+        self.assertEqual([str(u) for u in snapshot.autonomous], ["Garrison in Alicante"])
+        self.assertEqual([c.contender_id for c in snapshot.contenders],
+            list(self.scenario.contender_set.values_list('pk', flat=True)))
+        self.assertEqual([str(u) for u in snapshot.contenders[
+            [c.country for c in snapshot.contenders].index(None)].setups], ["Garrison in Alicante"])
+        self.assertEqual(snapshot.disabled, [disabled])
+        self.assertEqual(snapshot.cities, [])
+        self.treasury.ducats = 12
+        self.treasury.save()
+        snapshot = self.scenario.snapshot
+        self.assertEqual(snapshot.get_country('albacete').ducats, 12)
+
 class AreaTestCase(TestCase):
 
     fixtures = ['users.yaml',]
@@ -238,6 +321,56 @@ class AreaTestCase(TestCase):
         self.assertFalse(self.area_1.is_adjacent(self.area_3, fleet=True))
         self.assertFalse(self.area_3.is_adjacent(self.area_1, fleet=True))
 
+    def test_is_adjacent_cached(self):
+        self.area_1.is_adjacent(self.area_2)
+        with self.assertNumQueries(0):
+            self.assertTrue(self.area_2.is_adjacent(self.area_1))
+            self.assertFalse(self.area_1.is_adjacent(self.area_3, fleet=True))
+        Border.objects.filter(from_area=self.area_2, to_area=self.area_1).delete()
+        self.assertFalse(self.area_2.is_adjacent(self.area_1))
+        Border.objects.create(from_area=self.area_3, to_area=self.area_3)
+        self.assertTrue(self.area_3.is_adjacent(self.area_3, fleet=True))
+
+    def test_neighbours(self):
+        graph = adjacency.get_adjacency(self.setting.pk)
+        self.assertEqual(sorted(graph.neighbours(self.area_1.pk)), sorted([self.area_2.pk, self.area_3.pk]))
+        self.assertEqual(graph.neighbours(self.area_1.pk, fleet=True), [self.area_2.pk])
+        self.assertEqual(graph.neighbours(0), [])
+
+    def test_distance(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        patcher = mock.patch.object(distances, 'DISTANCES_DIR', tmpdir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        sea = Area.objects.create(setting=self.setting, name_en="Mar", code="MAR", is_sea=True)
+        Border.objects.create(from_area=sea, to_area=self.area_1)
+        self.assertEqual(self.area_1.distance(self.area_1), 0)
+        self.assertEqual(self.area_1.distance(self.area_3), 1)
+        self.assertIsNone(self.area_1.distance(sea))
+        self.assertEqual(sea.distance(self.area_2, fleet=True), 2)
+        self.assertIsNone(sea.distance(self.area_3, fleet=True))
+        self.assertEqual(set(sea.reachable(1, fleet=True)), set([sea, self.area_1]))
+        self.assertEqual(self.setting.get_distances().army.dtype.name, 'int8')
+        ## the distances are read again from their file, without queries
+        distances._distances.clear()
+        with self.assertNumQueries(0):
+            self.assertEqual(self.area_2.distance(self.area_3), 1)
+        Border.objects.filter(from_area=self.area_2, to_area=self.area_3).delete()
+        self.assertEqual(self.area_2.distance(self.area_3), 2)
+        ## the distances are removed again when the transaction is committed
+        with self.captureOnCommitCallbacks(execute=True) as callbacks:
+            distances.invalidate_distances(self.setting.pk)
+            self.setting.get_distances()
+            self.assertTrue(os.path.exists(distances.distances_path(self.setting.pk)))
+        self.assertEqual(len(callbacks), 1)
+        self.assertFalse(os.path.exists(distances.distances_path(self.setting.pk)))
+        ## each database has its own directory
+        directory = distances.distances_dir()
+        self.assertEqual(os.path.dirname(directory), tmpdir)
+        with mock.patch.dict(distances.connection.settings_dict, {'NAME': 'other'}):
+            self.assertNotEqual(distances.distances_dir(), directory)
+
     def test_build_possible(self):
         self.assertTrue(self.area_1.build_possible('A'))
         self.assertTrue(self.area_1.build_possible('F'))
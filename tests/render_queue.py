@@ -0,0 +1,85 @@
+import shutil
+import tempfile
+
+from django.test import TestCase
+from unittest import mock
+
+import condottieri_scenarios.render_queue as render_queue
+
+class RenderQueueTestCase(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        patcher = mock.patch.object(render_queue, 'QUEUE_DIR', self.tmpdir)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.scenario = mock.Mock(pk=1)
+        self.scenario.name = "dummy-scenario"
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_status_of_unknown_scenario(self):
+        self.assertIsNone(render_queue.get_status(1))
+
+    def test_enqueue_coalesces_pending_jobs(self):
+        self.assertTrue(render_queue.enqueue(self.scenario))
+        self.assertFalse(render_queue.enqueue(self.scenario))
+        self.assertEqual(render_queue.get_status(1)['state'], render_queue.PENDING)
+
+    def test_claim(self):
+        render_queue.enqueue(self.scenario)
+        job = render_queue.claim()
+        self.assertEqual(job['scenario'], 1)
+        self.assertEqual(job['name'], "dummy-scenario")
+        self.assertEqual(render_queue.get_status(1)['state'], render_queue.RUNNING)
+        self.assertIsNone(render_queue.claim())
+
+    def test_claim_skips_scenario_being_rendered(self):
+        render_queue.enqueue(self.scenario)
+        render_queue.claim()
+        self.assertTrue(render_queue.enqueue(self.scenario))
+        self.assertIsNone(render_queue.claim())
+        self.assertEqual(render_queue.get_status(1)['state'], render_queue.PENDING)
+
+    def test_finish(self):
+        render_queue.enqueue(self.scenario)
+        render_queue.finish(render_queue.claim())
+        self.assertEqual(render_queue.get_status(1)['state'], render_queue.DONE)
+
+    def test_finish_with_error(self):
+        render_queue.enqueue(self.scenario)
+        render_queue.finish(render_queue.claim(), error=IOError("no board"))
+        status = render_queue.get_status(1)
+        self.assertEqual(status['state'], render_queue.FAILED)
+        self.assertEqual(status['error'], "no board")
+
+    def test_requeue_dead_worker(self):
+        render_queue.enqueue(self.scenario)
+        job = render_queue.claim()
+        job['pid'] = 999999
+        render_queue.write_job(render_queue.job_path(render_queue.RUNNING, 1), job)
+        with mock.patch.object(render_queue, 'process_alive', return_value=False):
+            self.assertEqual(render_queue.claim()['scenario'], 1)
+        self.assertEqual(render_queue.get_status(1)['state'], render_queue.RUNNING)
+
+    def test_worker_recorded(self):
+        render_queue.enqueue(self.scenario)
+        render_queue.claim()
+        with mock.patch('os.getpid', return_value=999999):
+            render_queue.set_worker(1)
+        self.assertEqual(render_queue.get_status(1)['pid'], 999999)
+        with mock.patch.object(render_queue, 'process_alive', return_value=False):
+            self.assertEqual(render_queue.requeue_stale(), 1)
+        self.assertEqual(render_queue.get_status(1)['state'], render_queue.PENDING)
+
+    def test_requeue_timeout(self):
+        render_queue.enqueue(self.scenario)
+        render_queue.claim()
+        self.assertEqual(render_queue.requeue_stale(), 0)
+        with mock.patch.object(render_queue, 'RENDER_TIMEOUT', -1):
+            self.assertEqual(render_queue.requeue_stale(), 1)
+        self.assertEqual(render_queue.get_status(1)['state'], render_queue.PENDING)
+
+    def test_queue_disabled_by_default(self):
+        self.assertFalse(render_queue.queue_enabled())
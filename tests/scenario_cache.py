@@ -0,0 +1,96 @@
+import shutil
+import tempfile
+
+from django.test import TestCase, override_settings
+from unittest import mock
+
+from django.contrib.auth.models import User
+
+import condottieri_scenarios.models as scenarios
+import condottieri_scenarios.snapshots as snapshots
+from condottieri_scenarios.scenario_cache import *
+
+LOCMEM = {'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    'LOCATION': 'scenario-cache-tests'}}
+
+@override_settings(CACHES=LOCMEM)
+class VersionedCacheTestCase(TestCase):
+    fixtures = ['users.yaml',]
+
+    @mock.patch("condottieri_scenarios.graphics.make_country_tokens")
+    def setUp(self, make_country_tokens_mock):
+        self.user = User.objects.first()
+        self.setting = scenarios.Setting.objects.create(title_en='Italy',
+            description_en='description', editor=self.user)
+        self.area = scenarios.Area.objects.create(setting=self.setting, name_en="Milan",
+            code="MIL", has_city=True)
+        self.country = scenarios.Country.objects.create(name_en="Milan", color="000000",
+            coat_of_arms="", editor=self.user)
+        self.scenario = scenarios.Scenario.objects.create(setting=self.setting,
+            title_en="S", description_en="", start_year=1454, editor=self.user)
+        self.contender = scenarios.Contender.objects.create(scenario=self.scenario,
+            country=self.country)
+        self.treasury = scenarios.Treasury.objects.create(contender=self.contender, ducats=5)
+        scenarios.Home.objects.create(contender=self.contender, area=self.area)
+        self.build = mock.Mock(side_effect=snapshots.build_snapshot)
+        self.cache = VersionedCache('test', self.build, check_interval=0)
+        self.cache.backend.clear()
+
+    def test_local_hit(self):
+        snapshot = self.cache.get(self.scenario.pk)
+        self.assertIs(self.cache.get(self.scenario.pk), snapshot)
+        self.assertEqual(self.build.call_count, 1)
+        self.assertEqual(self.cache.stats(), {'local_hits': 1, 'hits': 0, 'misses': 1, 'size': 1})
+
+    def test_shared_hit(self):
+        self.cache.get(self.scenario.pk)
+        self.cache.clear_local()
+        with self.assertNumQueries(0):
+            snapshot = self.cache.get(self.scenario.pk)
+        self.assertEqual(snapshot.get_country(self.country.static_name).ducats, 5)
+        self.assertEqual(self.build.call_count, 1)
+        self.assertEqual(self.cache.stats()['hits'], 1)
+
+    def test_invalidate(self):
+        version = self.cache.version(self.scenario.pk)
+        self.cache.get(self.scenario.pk)
+        self.cache.invalidate(self.scenario.pk)
+        self.assertNotEqual(self.cache.version(self.scenario.pk), version)
+        self.cache.get(self.scenario.pk)
+        self.cache.invalidate()
+        self.cache.get(self.scenario.pk)
+        self.assertEqual(self.build.call_count, 3)
+        self.assertEqual(self.cache.stats()['misses'], 3)
+
+    def test_lru(self):
+        cache = VersionedCache('test', lambda pk, version: pk, size=2)
+        for pk in (1, 2, 1, 3):
+            cache.get(pk)
+        self.assertEqual(list(cache.local), [1, 3])
+
+    def test_signals(self):
+        snapshot = snapshots.get_snapshot(self.scenario.pk)
+        self.assertEqual(snapshot.get_country(self.country.static_name).ducats, 5)
+        self.treasury.ducats = 7
+        self.treasury.save()
+        snapshot = snapshots.get_snapshot(self.scenario.pk)
+        self.assertEqual(snapshot.get_country(self.country.static_name).ducats, 7)
+        scenarios.Setup.objects.create(contender=self.contender, area=self.area, unit_type='A')
+        snapshot = snapshots.get_snapshot(self.scenario.pk)
+        self.assertEqual([str(u) for u in snapshot.get_country(self.country.static_name).setups],
+            ["Army in Milan"])
+
+    def test_file_backend(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            with override_settings(CACHES={'default': {
+                'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+                'LOCATION': tmpdir}}):
+                self.cache.get(self.scenario.pk)
+                self.cache.clear_local()
+                snapshot = self.cache.get(self.scenario.pk)
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertEqual([h.code for h in snapshot.get_country(self.country.static_name).homes],
+            ["MIL"])
+        self.assertEqual(self.cache.stats()['hits'], 1)
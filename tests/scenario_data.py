@@ -0,0 +1,235 @@
+import os
+import shutil
+import tempfile
+
+from django.test import TestCase
+from unittest import mock
+
+from django.contrib.auth.models import User
+
+import condottieri_scenarios.models as scenarios
+from condottieri_scenarios.scenario_data import *
+
+class ScenarioDataTestCase(TestCase):
+    fixtures = ['users.yaml',]
+
+    @mock.patch("condottieri_scenarios.graphics.make_country_tokens")
+    def setUp(self, make_country_tokens_mock):
+        self.user = User.objects.first()
+        self.setting = scenarios.Setting.objects.create(title_en = 'dummy setting',
+                description_en = 'description',
+                editor = self.user)
+        self.scenario = scenarios.Scenario.objects.create(setting = self.setting,
+                title_en = "dummy scenario",
+                description_en = "description",
+                start_year = 0,
+                editor = self.user)
+        self.country = scenarios.Country.objects.create(name_en = "Albacete",
+                color = "000000",
+                coat_of_arms = "",
+                editor = self.user)
+
+    def test_model_name(self):
+        self.assertEqual(model_name({'model': 'condottieri_scenarios.area'}), 'area')
+        self.assertEqual(get_model('condottieri_scenarios.area'), scenarios.Area)
+
+    def test_dependency_order(self):
+        order = dependency_order(['home', 'border', 'contender', 'area', 'scenario', 'setting'])
+        self.assertEqual(order, ['setting', 'area', 'border', 'scenario', 'contender', 'home'])
+        self.assertEqual(dependency_order(['religion', 'specialunit']), ['religion', 'specialunit'])
+
+    def test_select_records(self):
+        def record(model, pk, **fields):
+            return {'model': 'condottieri_scenarios.%s' % model, 'pk': pk, 'fields': fields}
+        buckets = {'setting': [record('setting', 1, slug='italy'), record('setting', 2, slug='spain')],
+            'area': [record('area', 1, setting=1), record('area', 2, setting='2')],
+            'border': [record('border', 1, from_area=2, to_area=2)],
+            'country': [record('country', 1)],
+            'scenario': [record('scenario', 1), record('scenario', 2, setting=2, name='b')],
+            'contender': [record('contender', 1, scenario=1, country=1),
+                record('contender', 2, scenario=2, country=1)],
+            'routestep': [record('routestep', 1, route=3, area=2)],
+            'traderoute': [record('traderoute', 3), record('traderoute', 4)]}
+        selection = select_records(buckets, settings=['spain'])
+        self.assertEqual(dict((name, [r['pk'] for r in records]) for name, records in selection.items()),
+            {'setting': [2], 'area': [2], 'border': [1], 'scenario': [2], 'contender': [2],
+                'routestep': [1], 'traderoute': [3]})
+        selection = select_records(buckets, scenarios=['b'])
+        self.assertEqual(list(selection.keys()), ['scenario', 'contender'])
+        selection = select_records(buckets, settings=['italy'])
+        self.assertEqual([r['pk'] for r in selection['scenario']], [1])
+
+    def test_unique_sets(self):
+        self.assertIn(('scenario_id', 'area_id'), unique_sets(scenarios.DisabledArea))
+
+    def test_rules(self):
+        rules = ScenarioRules()
+        area = scenarios.Area(pk=1, code="A", name_en="A", is_sea=False,
+            is_coast=False, has_city=True)
+        rules.add('area', area)
+        rules.add('contender', scenarios.Contender(pk=1, scenario_id=1, country_id=1))
+        rules.add('contender', scenarios.Contender(pk=2, scenario_id=1, country_id=None))
+        home = scenarios.Home(contender_id=1, area_id=1)
+        rules.check('home', home)
+        rules.add('home', home)
+        self.assertRaises(scenarios.HomeIsTaken, rules.check, 'home', home)
+        self.assertRaises(scenarios.HomeIsAutonomous, rules.check, 'home',
+            scenarios.Home(contender_id=2, area_id=1))
+        self.assertRaises(scenarios.AreaNotAllowed, rules.check, 'disabledarea',
+            scenarios.DisabledArea(scenario_id=1, area_id=1))
+
+    def test_load_remaps_keys(self):
+        loader = BulkLoader(self.user, '/nonexistent')
+        loader.pks['scenario'][1] = self.scenario.pk
+        loader.pks['country'][1] = self.country.pk
+        loader.load('contender', [{'model': 'condottieri_scenarios.contender',
+            'pk': 9001, 'fields': {'scenario': 1, 'country': 1}}])
+        self.assertIsNone(loader.resolve('area', 9001))
+        self.assertEqual(loader.resolve('contender', 9001), 9001)
+        self.assertEqual(scenarios.Contender.objects.get(pk=9001).scenario, self.scenario)
+
+    def test_muted_signals(self):
+        with muted_signals():
+            setting = scenarios.Setting.objects.create(title_en='muted', slug='muted',
+                description_en='description', editor=self.user)
+            self.assertFalse(scenarios.Configuration.objects.filter(setting=setting).exists())
+        setting = scenarios.Setting.objects.create(title_en='loud', slug='loud',
+            description_en='description', editor=self.user)
+        self.assertTrue(scenarios.Configuration.objects.filter(setting=setting).exists())
+
+    def test_finish(self):
+        areas = [scenarios.Area.objects.create(setting=self.setting, name_en="Area %s" % i,
+            code="A%s" % i) for i in range(3)]
+        loader = BulkLoader(self.user, '/nonexistent')
+        loader.preload({})
+        with muted_signals():
+            loader.load('setting', [{'model': 'condottieri_scenarios.setting', 'pk': 9001,
+                'fields': {'slug': 'loaded', 'title_en': 'loaded', 'description_en': ''}}])
+            loader.load('border', [{'model': 'condottieri_scenarios.border', 'pk': i + 1,
+                'fields': {'from_area': areas[0].pk, 'to_area': areas[i].pk}} for i in (1, 2)] +
+                [{'model': 'condottieri_scenarios.border', 'pk': 3,
+                'fields': {'from_area': areas[2].pk, 'to_area': areas[0].pk}}])
+            loader.finish()
+        self.assertEqual(scenarios.Border.objects.count(), 4)
+        self.assertTrue(scenarios.Border.objects.filter(from_area=areas[1], to_area=areas[0]).exists())
+        self.assertTrue(scenarios.Configuration.objects.filter(setting=9001).exists())
+
+    def test_preload_updates_rows(self):
+        contender = scenarios.Contender.objects.create(scenario=self.scenario, country=self.country)
+        treasury = scenarios.Treasury.objects.create(contender=contender, ducats=5)
+        loader = BulkLoader(self.user, '/nonexistent')
+        loader.preload({'treasury': [treasury.pk]})
+        self.assertEqual(loader.resolve('contender', contender.pk), contender.pk)
+        self.assertEqual(loader.autonomous[self.scenario.pk],
+            scenarios.Contender.objects.get(scenario=self.scenario, country__isnull=True).pk)
+        loader.load('treasury', [{'model': 'condottieri_scenarios.treasury',
+            'pk': treasury.pk, 'fields': {'contender': contender.pk, 'ducats': 12}}])
+        self.assertEqual(scenarios.Treasury.objects.get(pk=treasury.pk).ducats, 12)
+        self.assertEqual(loader.delete('treasury', [str(treasury.pk)]), 1)
+        self.assertFalse(scenarios.Treasury.objects.exists())
+        scenarios.Treasury.objects.create(contender=contender, ducats=5)
+        self.assertEqual(loader.delete('contender', [str(contender.pk)]), 1)
+        self.assertEqual(loader.deleted, {'treasury': 2, 'contender': 1})
+
+class ManifestTestCase(TestCase):
+
+    def record(self, model, pk, **fields):
+        return {'model': 'condottieri_scenarios.%s' % model, 'pk': pk, 'fields': fields}
+
+    def test_diff_manifest(self):
+        old = {'a.yaml': [self.record('area', 1, code='A'), self.record('area', 2, code='B')],
+            'b.yaml': [self.record('religion', 1, slug='r')],
+            'c.yaml': [self.record('area', 3, code='C')]}
+        manifest = dict((f, file_manifest(f, records)) for f, records in old.items())
+        new = {'a.yaml': [self.record('area', 1, code='X'), self.record('area', 3, code='C')]}
+        entries = {'a.yaml': file_manifest('a2', new['a.yaml']),
+            'c.yaml': manifest['c.yaml']}
+        upserts, deletes = diff_manifest(manifest, entries, new)
+        self.assertEqual(list(upserts.keys()), ['area'])
+        self.assertEqual([r['pk'] for r in upserts['area']], [1, 3])
+        self.assertEqual(sorted(deletes.items()), [('area', ['2']), ('religion', ['1'])])
+
+    def test_write_manifest(self):
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, 'scenarios', 'manifest.json')
+            self.assertEqual(read_manifest(path), {})
+            write_manifest({'a.yaml': {'sha1': 'x', 'records': {}}}, path)
+            self.assertEqual(read_manifest(path)['a.yaml']['sha1'], 'x')
+        finally:
+            shutil.rmtree(tmpdir)
+
+class ReadFilesTestCase(TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.paths = []
+        for i in range(3):
+            path = os.path.join(self.tmpdir, "%s_religion.yaml" % i)
+            with open(path, 'w') as f:
+                f.write("- model: condottieri_scenarios.religion\n  pk: %s\n  fields: {slug: r%s}\n" % (i, i))
+            self.paths.append(path)
+        path = os.path.join(self.tmpdir, "3_broken.xml")
+        with open(path, 'w') as f:
+            f.write("<django-objects")
+        self.paths.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_read_files(self):
+        for jobs in (1, 2):
+            results = list(read_files(self.paths, jobs))
+            self.assertEqual([path for path, records in results], self.paths)
+            self.assertEqual([records[0]['pk'] for path, records in results[:3]], [0, 1, 2])
+            self.assertIsInstance(results[3][1], Exception)
+
+    def test_iter_xml(self):
+        path = os.path.join(self.tmpdir, "objects.xml")
+        with open(path, 'w') as f:
+            f.write("""<?xml version="1.0" encoding="utf-8"?>
+<django-objects version="1.0">
+  <object model="condottieri_scenarios.area" pk="1">
+    <field name="name_en" type="CharField">Alpha</field>
+    <field name="name_es" type="CharField"></field>
+    <field name="religion" rel="ManyToOneRel" to="condottieri_scenarios.religion"><None></None></field>
+  </object>
+  <object model="condottieri_scenarios.area" pk="2">
+    <field name="borders" rel="ManyToManyRel" to="condottieri_scenarios.area"><object pk="1"></object></field>
+  </object>
+</django-objects>""")
+        records = list(iter_xml(path))
+        self.assertEqual(len(records), 2)
+        self.assertEqual(records[0]['fields'], {'name_en': 'Alpha', 'name_es': '', 'religion': None})
+        self.assertEqual(records[1], {'model': 'condottieri_scenarios.area', 'pk': '2',
+            'fields': {'borders': ['1']}})
+
+class DataCheckerTestCase(TestCase):
+
+    def record(self, model, pk, **fields):
+        return {'model': 'condottieri_scenarios.%s' % model, 'pk': pk, 'fields': fields}
+
+    def test_check(self):
+        buckets = {
+            'setting': [self.record('setting', 1, slug='italy', title_en='Italy')],
+            'area': [self.record('area', 1, setting=1, code='A', has_city=True, control_income=2),
+                self.record('area', 2, setting=1, code='B', is_sea=True, control_income=1),
+                self.record('area', 3, setting=1, code='C', control_income=1)],
+            'border': [self.record('border', 1, from_area=1, to_area=9)],
+            'scenario': [self.record('scenario', 1, setting=1, name='s', start_year=1)],
+            'contender': [self.record('contender', 1, scenario=1),
+                self.record('contender', 2, scenario=1, country=None)],
+            'disabledarea': [self.record('disabledarea', 1, scenario=1, area=3)],
+            'setup': [self.record('setup', 1, contender=1, area=3, unit_type='A'),
+                self.record('setup', 2, contender=1, area=2, unit_type='A')],
+        }
+        checker = DataChecker()
+        with self.assertNumQueries(0):
+            for name in dependency_order(buckets.keys()):
+                checker.load(name, buckets[name])
+        self.assertEqual([(level, name, pk) for level, name, pk, message in checker.problems], [
+            ('warning', 'area', 2),
+            ('warning', 'border', 1),
+            ('warning', 'contender', 2),
+            ('error', 'setup', 1),
+            ('error', 'setup', 2)])
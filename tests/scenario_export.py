@@ -0,0 +1,84 @@
+import os
+import shutil
+import tempfile
+
+from django.test import TestCase, override_settings
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.files.base import ContentFile
+
+import condottieri_scenarios.models as scenarios
+from condottieri_scenarios.scenario_data import BulkLoader, dependency_order, \
+    model_name, muted_signals, read_records
+from condottieri_scenarios.scenario_export import *
+
+class DataExporterTestCase(TestCase):
+    fixtures = ['users.yaml',]
+
+    @mock.patch("condottieri_scenarios.graphics.make_country_tokens")
+    def setUp(self, make_country_tokens_mock):
+        self.tmpdir = tempfile.mkdtemp()
+        self.media = override_settings(MEDIA_ROOT=os.path.join(self.tmpdir, 'media'))
+        self.media.enable()
+        self.user = User.objects.first()
+        self.setting = scenarios.Setting.objects.create(title_en='Italy',
+            description_en='description', editor=self.user)
+        self.areas = [scenarios.Area.objects.create(setting=self.setting, name_en="Area %s" % i,
+            code="A%s" % i, has_city=True, control_income=1) for i in range(3)]
+        scenarios.Border.objects.create(from_area=self.areas[0], to_area=self.areas[1])
+        religion = scenarios.Religion.objects.create(slug='catholic', name_en='Catòlica')
+        unit = scenarios.SpecialUnit.objects.create(static_title='Swiss', title_en='Swiss',
+            cost=1, power=1, loyalty=1)
+        self.country = scenarios.Country(name_en="Milan", color="000000",
+            static_name="milan", religion=religion, editor=self.user)
+        self.country.coat_of_arms.save("badge-milan.png", ContentFile(b"coat"))
+        self.country.special_units.add(unit)
+        self.scenario = scenarios.Scenario.objects.create(setting=self.setting, name='s',
+            title_en="S", description_en="", start_year=1454, editor=self.user)
+        contender = scenarios.Contender.objects.create(scenario=self.scenario, country=self.country)
+        scenarios.Home.objects.create(contender=contender, area=self.areas[0])
+        scenarios.Setup.objects.create(contender=contender, area=self.areas[0], unit_type='A')
+
+    def tearDown(self):
+        self.media.disable()
+        shutil.rmtree(self.tmpdir)
+
+    def export(self, name):
+        output = os.path.join(self.tmpdir, name)
+        files = DataExporter(output, batch_size=2).export()
+        contents = {}
+        for filename in files:
+            with open(os.path.join(output, filename), 'rb') as f:
+                contents[filename] = f.read()
+        return output, contents
+
+    def test_export(self):
+        output, contents = self.export('first')
+        self.assertEqual(sorted(contents), ['00_shared.yaml', '10_setting_italy.yaml', '20_scenario_s.yaml'])
+        records = read_records(os.path.join(output, '10_setting_italy.yaml'))
+        self.assertEqual([model_name(r) for r in records].count('border'), 2)
+        self.assertNotIn('editor', records[0]['fields'])
+        country = [r for r in read_records(os.path.join(output, '00_shared.yaml'))
+            if model_name(r) == 'country'][0]
+        self.assertEqual(country['fields']['special_units'], [1])
+        with open(os.path.join(output, IMAGES_DIR, 'badge-milan.png'), 'rb') as f:
+            self.assertEqual(f.read(), b"coat")
+
+    def test_round_trip(self):
+        output, first = self.export('first')
+        with muted_signals():
+            scenarios.Setting.objects.all().delete()
+            scenarios.Country.objects.all().delete()
+            scenarios.Religion.objects.all().delete()
+            scenarios.SpecialUnit.objects.all().delete()
+            buckets = {}
+            for filename in sorted(first):
+                for record in read_records(os.path.join(output, filename)):
+                    buckets.setdefault(model_name(record), []).append(record)
+            loader = BulkLoader(self.user, os.path.join(output, IMAGES_DIR))
+            for name in dependency_order(buckets.keys()):
+                loader.load(name, buckets[name])
+            loader.finish()
+        output, second = self.export('second')
+        self.assertEqual(first, second)
@@ -0,0 +1,75 @@
+import datetime
+import os
+import shutil
+import tempfile
+
+from django.test import TestCase
+
+from django.contrib.auth.models import User
+
+import condottieri_scenarios.models as scenarios
+from condottieri_scenarios.scenario_data import dependency_order, muted_signals
+from condottieri_scenarios.scenario_pack import *
+
+class ScenarioPackTestCase(TestCase):
+    fixtures = ['users.yaml',]
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'data.pack')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def record(self, model, pk, **fields):
+        return {'model': 'condottieri_scenarios.%s' % model, 'pk': pk, 'fields': fields}
+
+    def test_columns(self):
+        columns = {'i': [1, None, -3], 'b': [True, False, None],
+            'd': [datetime.date(1494, 9, 1), None, datetime.date(1, 1, 1)],
+            's': ['Nàpols', None, '']}
+        for kind, values in columns.items():
+            blobs, nulls = encode_column(kind, values)
+            self.assertEqual(decode_column(kind, blobs, nulls), values)
+        self.assertEqual(column_kind(scenarios.Area._meta.get_field('setting')), 'i')
+        self.assertEqual(column_kind(scenarios.Setting._meta.get_field('board')), 's')
+
+    def test_compile_and_restore(self):
+        buckets = {
+            'setting': [self.record('setting', 3, slug='italy', title_en='Italy', enabled='False')],
+            'area': [self.record('area', 1, setting=3, code='A', name_en='Alpha'),
+                self.record('area', 2, setting=3, code='B', name_en='Beta')],
+            'border': [self.record('border', 1, from_area=1, to_area=2, only_land=True)],
+            'scenario': [self.record('scenario', 5, setting=3, name='s', title_en='S', start_year=1494)],
+            'contender': [self.record('contender', 1, scenario=5, country=9)],
+        }
+        compiler = PackCompiler('/nonexistent')
+        with self.assertNumQueries(0):
+            for name in dependency_order(buckets.keys()):
+                compiler.load(name, buckets[name])
+            compiler.finish()
+        self.assertEqual([p[:3] for p in compiler.problems], [('warning', 'contender', 1)])
+        write_pack(self.path, compiler.tables(), compiler.files, {'a.yaml': {'sha1': 'x', 'records': {}}})
+        pack = ScenarioPack(self.path)
+        self.assertEqual(pack.manifest['a.yaml']['sha1'], 'x')
+        user = User.objects.first()
+        with muted_signals():
+            timings, countries = restore_pack(pack, user)
+        self.assertEqual(timings['border'][1], 2)
+        setting = scenarios.Setting.objects.get(pk=3)
+        self.assertFalse(setting.enabled)
+        self.assertEqual(setting.editor, user)
+        self.assertTrue(scenarios.Border.objects.filter(from_area=2, to_area=1, only_land=True).exists())
+        self.assertTrue(scenarios.Configuration.objects.filter(setting=setting).exists())
+        self.assertTrue(scenarios.Contender.objects.filter(scenario=5, country__isnull=True).exists())
+        self.assertEqual(scenarios.Area.objects.get(pk=2).name_en, 'Beta')
+        ## the sequences are reset after the rows inserted with their keys
+        self.assertGreater(scenarios.Area.objects.create(setting=setting, code='C').pk, 2)
+
+    def test_wrong_version(self):
+        with open(self.path, 'wb') as f:
+            f.write(PACK_MAGIC + PACK_PREAMBLE.pack(PACK_VERSION + 1, 0))
+        self.assertRaises(PackError, ScenarioPack, self.path)
+        with open(self.path, 'wb') as f:
+            f.write(b'- model: condottieri_scenarios.area')
+        self.assertRaises(PackError, ScenarioPack, self.path)
@@ -13,6 +13,11 @@ urlpatterns = [
 	path('create/', views.ScenarioCreateView.as_view(), name='scenario_create'),
 	path('detail/<slug:slug>/', views.ScenarioView.as_view(), name='scenario_detail'),
 	path('make_map/<slug:slug>/', views.ScenarioRedrawMapView.as_view(), name='scenario_make_map'),
+	path('map_status/<slug:slug>/', views.ScenarioMapStatusView.as_view(), name='scenario_map_status'),
+	path('map/<slug:slug>/', views.ScenarioMapImageView.as_view(), name='scenario_map_image'),
+	path('map/<slug:slug>/<slug:size>/', views.ScenarioMapImageView.as_view(), name='scenario_map_image'),
+	path('tiles/<slug:slug>/manifest.json', views.ScenarioTileView.as_view(), name='scenario_tile_manifest'),
+	path('tiles/<slug:slug>/<int:level>/<int:col>_<int:row>.jpg', views.ScenarioTileView.as_view(), name='scenario_tile'),
 	path('toggle/<slug:slug>/', views.ScenarioToggleView.as_view(), name='scenario_toggle'),
 	path('stats/<slug:slug>/', views.ScenarioView.as_view(template_name='condottieri_scenarios/scenario_stats.html'), name='scenario_stats'),
 	path('contenders/<slug:slug>/', views.ContenderEditView.as_view(), name='scenario_contender_edit'),
@@ -17,7 +17,10 @@
 ## AUTHOR: Jose Antonio Martin <jantonio.martin AT gmail DOT com>
 
 from datetime import datetime
+import json
+import os.path
 
+from django.views.generic.base import View
 from django.views.generic.list import ListView
 from django.views.generic.detail import DetailView
 from django.views.generic.edit import CreateView, UpdateView, DeleteView
@@ -33,11 +36,21 @@ from django.contrib import messages
 
 import condottieri_scenarios.models as models
 import condottieri_scenarios.forms as forms
+import condottieri_scenarios.render_queue as render_queue
+import condottieri_scenarios.graphics as graphics
 from condottieri_scenarios.graphics import make_scenario_map
 
 def reverse_lazy(name, *args, **kwargs):
 	return lazy(reverse, str)(name, args=args, kwargs=kwargs)
 
+def user_can_edit(user, obj):
+	""" Returns True if the user passes the checks of EditionAllowedMixin """
+	if not user.is_authenticated:
+		return False
+	if user.is_staff:
+		return True
+	return user.profile.is_editor and getattr(obj, 'editor', None) == user
+
 class CreationAllowedMixin(object):
 	""" A mixin requiring a user to be authenticated and being editor or admin """
 	def dispatch(self, request, *args, **kwargs):
@@ -139,6 +152,8 @@ class CountryView(DetailView):
 		if self.request.user.is_authenticated:
 			user_can_edit = self.request.user.profile.is_editor
 			context.update({'user_can_edit': user_can_edit})
+		if graphics.atlas_enabled():
+			context['token_index'] = graphics.country_token_index([self.object])
 		return context
 
 class CountryListView(ListView):
@@ -151,6 +166,12 @@ class CountryListView(ListView):
 			return models.Country.objects.all()
 		else:
 			return models.Country.objects.filter(Q(enabled=True)|Q(editor=self.request.user))
+
+	def get_context_data(self, **kwargs):
+		context = super(CountryListView, self).get_context_data(**kwargs)
+		if graphics.atlas_enabled():
+			context['token_index'] = graphics.country_token_index(context['object_list'])
+		return context
 	
 class SettingView(DetailView):
 	model = models.Setting
@@ -194,18 +215,22 @@ class ScenarioListView(ListView):
 	model = models.Scenario
 	
 	def get_queryset(self):
+		scenarios = models.Scenario.objects.with_stats().select_related('editor')
 		if not self.request.user.is_authenticated:
-			return models.Scenario.objects.filter(enabled=True)
+			return scenarios.filter(enabled=True)
 		if self.request.user.is_staff:
-			return models.Scenario.objects.all()
+			return scenarios
 		else:
-			return models.Scenario.objects.filter(Q(enabled=True)|Q(editor=self.request.user))
+			return scenarios.filter(Q(enabled=True)|Q(editor=self.request.user))
 	
 class ScenarioView(DetailView):
 	model = models.Scenario
 	slug_field = 'name'
 	context_object_name = 'scenario'
 
+	def get_queryset(self):
+		return models.Scenario.objects.with_stats()
+
 	def get_context_data(self, **kwargs):
 		context = super(ScenarioView, self).get_context_data(**kwargs)
 		if self.request.user.is_authenticated:
@@ -257,9 +282,95 @@ class ScenarioToggleView(EditionAllowedMixin, UpdateView):
 class ScenarioRedrawMapView(EditionAllowedMixin, ScenarioView):
 	def get(self, request, **kwargs):
 		obj = self.get_object()
-		make_scenario_map(obj)
+		if render_queue.queue_enabled():
+			render_queue.enqueue(obj)
+			messages.success(request, _("The map will be redrawn in a few moments"))
+		else:
+			make_scenario_map(obj)
 		return super(ScenarioRedrawMapView, self).get(request, **kwargs)
 
+	def get_context_data(self, **kwargs):
+		context = super(ScenarioRedrawMapView, self).get_context_data(**kwargs)
+		if render_queue.queue_enabled():
+			context['map_queued'] = True
+		return context
+
+class ScenarioMapStatusView(DetailView):
+	""" Returns the state of the last map render job of a scenario as JSON.
+	The error of a failed job is only shown to the users that can edit the
+	scenario. """
+	model = models.Scenario
+	slug_field = 'name'
+	status_fields = ('state', 'queued', 'started', 'finished')
+
+	def get(self, request, *args, **kwargs):
+		obj = self.get_object()
+		job = render_queue.get_status(obj.pk) or {'state': None}
+		status = dict((f, job[f]) for f in self.status_fields if f in job)
+		if 'error' in job and user_can_edit(request.user, obj):
+			status['error'] = job['error']
+		status['map_url'] = obj.map_image_url
+		return http.JsonResponse(status)
+
+class ScenarioTileView(View):
+	""" Serves the tiles of a scenario map and the manifest of the pyramid.
+
+	Tiles do not change while the fingerprint of the map stays the same, and
+	the tile URLs in the manifest include the fingerprint, so tiles are sent
+	with far future cache headers. No database query is needed.
+	"""
+	def get(self, request, slug, level=None, col=None, row=None):
+		## an unsaved scenario is enough to know where the tiles are
+		tiles_path = models.Scenario(name=slug).tiles_path
+		if level is None:
+			try:
+				with open(os.path.join(tiles_path, "manifest.json"), 'r') as f:
+					manifest = json.load(f)
+			except (IOError, OSError, ValueError):
+				raise http.Http404
+			base = request.path[:-len("manifest.json")]
+			manifest['tile_url'] = "%s{level}/{col}_{row}.jpg?v=%s" % (base,
+				(manifest.get('fingerprint') or '')[:12])
+			response = http.JsonResponse(manifest)
+			response['Cache-Control'] = 'no-cache'
+			return response
+		path = os.path.join(tiles_path, str(level), "%s_%s.jpg" % (col, row))
+		if not os.path.exists(path):
+			raise http.Http404
+		return image_response(request, path, immutable=True)
+
+def image_response(request, path, immutable=False):
+	""" Returns a response with the smallest format of an image that the
+	client accepts. """
+	path, content_type = graphics.negotiate_format(path, request.META.get('HTTP_ACCEPT', ''))
+	response = http.FileResponse(open(path, 'rb'), content_type=content_type)
+	response['Vary'] = 'Accept'
+	if immutable:
+		response['Cache-Control'] = 'public, max-age=31536000, immutable'
+	else:
+		response['Cache-Control'] = 'no-cache'
+	return response
+
+class ScenarioMapImageView(View):
+	""" Serves the map of a scenario, or one of its reduced sizes, in the
+	best format that the client accepts. When the URL has the current
+	fingerprint of the map, the image is sent with far future cache headers.
+	"""
+	def get(self, request, slug, size=None):
+		scenario = models.Scenario(name=slug)
+		if size is None:
+			path = scenario.map_path
+		elif size in graphics.map_sizes():
+			path = scenario.get_map_size_path(size)
+		else:
+			raise http.Http404
+		if not os.path.exists(path):
+			raise http.Http404
+		## an old or unknown version must not be cached under its URL
+		fingerprint = scenario.map_fingerprint
+		immutable = bool(fingerprint) and request.GET.get('v') == fingerprint[:12]
+		return image_response(request, path, immutable=immutable)
+
 class ScenarioCreateView(CreationAllowedMixin, CreateView):
 	model = models.Scenario
 	form_class = forms.CreateScenarioForm